@@ -0,0 +1,68 @@
+from servicenow_api_tools.clients.utils import (
+    count_trues, get_display_value, get_hash_value, unpack_link_fields)
+import click
+import pandas as pd
+import random
+import timeit
+
+
+def unpack_link_fields_applymap(input_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    The original applymap based implementation, kept here to compare against.
+    """
+    temp = input_df.applymap(
+        lambda x: "link" in x.keys() if isinstance(x, dict) else False
+    )
+    link_cols = temp.columns[temp.apply(count_trues) > 0].to_list()
+
+    for col in input_df.columns:
+        if col in link_cols:
+            input_df["_" + col] = get_hash_value(input_df[col])
+            input_df[col + "_display_value"] = get_display_value(input_df[col])
+            input_df[col] = input_df["_" + col]
+            input_df = input_df.drop(columns=["_" + col])
+        else:
+            input_df[col] = get_display_value(input_df[col])
+    return input_df
+
+
+def generate_batch(rows: int, columns: int, link_fraction: float) -> pd.DataFrame:
+    link_columns = int(columns * link_fraction)
+    records = []
+    for row in range(rows):
+        record = {}
+        for column in range(columns):
+            value = f"{random.getrandbits(128):032x}"
+            if column < link_columns:
+                record[f"field_{column}"] = {
+                    "display_value": f"Display {value[:8]}",
+                    "link": f"https://example.servicenowservices.com/api/now/table/t/{value}",
+                    "value": value,
+                }
+            else:
+                record[f"field_{column}"] = {"display_value": value[:8], "value": value[:8]}
+        records.append(record)
+    return pd.DataFrame(records, dtype="object")
+
+
+@click.command()
+@click.option('--rows', type=int, default=2000, help="Rows per batch.")
+@click.option('--columns', type=int, default=150, help="Columns per batch.")
+@click.option('--link-fraction', type=float, default=0.2,
+              help="Fraction of columns that are links.")
+@click.option('--repeat', type=int, default=3, help="Number of timed runs for each implementation.")
+def benchmark_unpack_link_fields(rows, columns, link_fraction, repeat):
+    """Compares unpack_link_fields against the original applymap implementation."""
+    batch = generate_batch(rows, columns, link_fraction)
+    pd.testing.assert_frame_equal(
+        unpack_link_fields(batch.copy()), unpack_link_fields_applymap(batch.copy()))
+
+    for name, function in [("applymap", unpack_link_fields_applymap),
+                           ("unpack_link_fields", unpack_link_fields)]:
+        timings = timeit.repeat(lambda: function(batch.copy()), number=1, repeat=repeat)
+        click.echo(f"{name}: best of {repeat}: {min(timings):.3f} seconds "
+                   f"({rows} rows x {columns} columns)")
+
+
+if __name__ == '__main__':
+    benchmark_unpack_link_fields()
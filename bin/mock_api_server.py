@@ -1,4 +1,4 @@
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from servicenow_api_tools.mock_api_server import ServicenowRestEndpointLocalDataset
 from functools import partial
 import json
@@ -7,18 +7,17 @@ import traceback
 
 
 class MockServicenowAPIServer(BaseHTTPRequestHandler):
-    def __init__(self, data_directory, schemas_directory, *args, **kwargs):
-        self.data_directory = data_directory
-        self.schemas_directory = schemas_directory
-        self.endpoint = ServicenowRestEndpointLocalDataset(
-            path=self.data_directory, schema_dir=self.schemas_directory)
+    def __init__(self, endpoint, *args, **kwargs):
+        # A new handler is created for every request, so the endpoint (and the dataset it has
+        # loaded) is created once by the server and shared.
+        self.endpoint = endpoint
         # BaseHTTPRequestHandler calls do_GET **inside** __init__ !!!
         # So we have to call super().__init__ after setting attributes.
         super().__init__(*args, **kwargs)
 
-    def do_GET(self):
+    def _respond(self, handle):
         try:
-            json_str = json.dumps(self.endpoint.get(self.path), indent=4, sort_keys=True)
+            json_str = json.dumps(handle(), indent=4, sort_keys=True)
         except Exception as e:
             print(f"Got exception: {str(e)}")
             print(" ======== START STACKTRACE ======== ")
@@ -37,17 +36,47 @@ class MockServicenowAPIServer(BaseHTTPRequestHandler):
         self.end_headers()
         self.wfile.write(json_str.encode(encoding='utf_8'))
 
+    def _read_body(self):
+        return json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+
+    def do_GET(self):
+        self._respond(lambda: self.endpoint.get(self.path))
+
+    def do_PUT(self):
+        # Updates only change the dataset in memory, they are gone when the server stops.
+        self._respond(lambda: self.endpoint.put(self.path, self._read_body()))
+
+    def do_POST(self):
+        self._respond(lambda: self.endpoint.post(self.path, self._read_body()))
+
 
 @click.command()
 @click.option('--hostname', type=str, default="localhost", help="Hostname to listen on.")
 @click.option('--port', type=int, default=8080, help="Port to listen on.")
 @click.option('--data-directory', required=True, type=str, help="Directory containing the dataset.")
 @click.option('--schemas-directory', required=True, type=str, help="Directory with table schemas.")
-def mock_api_server(hostname, port, data_directory, schemas_directory):
+@click.option('--validate/--skip-validation', default=True,
+              help="Check that every cell has a value and a display_value when loading.")
+@click.option('--snapshot/--no-snapshot', default=False,
+              help=("Save the loaded dataset next to the JSON files, and reuse it on later runs "
+                    "until they change."))
+@click.option('--trigram-index', multiple=True, type=str,
+              help=("A table.field to index for faster LIKE queries. Can be passed more than "
+                    "once."))
+def mock_api_server(hostname, port, data_directory, schemas_directory, validate, snapshot,
+                    trigram_index):
     """Runs a mock Servicenow server against a local dataset"""
+    trigram_index_fields = {}
+    for table_field in trigram_index:
+        (table, field) = table_field.split(".", 1)
+        trigram_index_fields.setdefault(table, []).append(field)
+    endpoint = ServicenowRestEndpointLocalDataset(
+        path=data_directory, schema_dir=schemas_directory, validate=validate, snapshot=snapshot,
+        trigram_index_fields=trigram_index_fields)
     # https://stackoverflow.com/a/52046062
-    handler = partial(MockServicenowAPIServer, data_directory, schemas_directory)
-    server = HTTPServer((hostname, port), handler)
+    handler = partial(MockServicenowAPIServer, endpoint)
+    # Requests are handled in their own threads, since the clients send several at once.
+    server = ThreadingHTTPServer((hostname, port), handler)
     click.echo("Server started http://%s:%s" % (hostname, port))
 
     try:
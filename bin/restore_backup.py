@@ -0,0 +1,41 @@
+from servicenow_api_tools.clients.clients import TableAPIUpdateClient
+from servicenow_api_tools.clients.endpoint import ServicenowRestEndpoint
+import click
+import sys
+
+
+@click.command()
+@click.option('--backup-path', required=True, type=str,
+              help='Timestamped backup directory with a manifest.json, written by exec_updates.')
+@click.option('--backup-directory', required=True, type=str,
+              help='Where to back up the current records before restoring.')
+@click.option('--instance', type=str,
+              help="ServiceNow instance to use, incompatible with --base-url.")
+@click.option('--base-url', type=str, help="Full ServiceNow URL, incompatible with --instance.")
+@click.option('--dry-run/--no-dry-run', default=True,
+              help='Only print what would be restored.')
+@click.option('--max-workers', type=int, default=8, help='Updates to send in parallel.')
+@click.option('--rate-per-second', type=float, default=10.0,
+              help='Most updates to start per second.')
+@click.option('--journal-path', type=str, default=None,
+              help='Log of finished updates, to resume an interrupted restore.')
+def restore_backup(backup_path, backup_directory, instance, base_url, dry_run, max_workers,
+                   rate_per_second, journal_path):
+    """Puts the fields changed by an update batch back to their values in its backup."""
+    if instance and base_url:
+        click.echo("Cannot pass both --instance or --base-url")
+        sys.exit(1)
+    if not (instance or base_url):
+        click.echo("Must pass either --instance or --base-url")
+        sys.exit(1)
+    update_client = TableAPIUpdateClient(
+        endpoint=ServicenowRestEndpoint(instance=instance, base_url=base_url))
+    report = update_client.restore_backup(
+        backup_path, backup_directory, dry_run=dry_run, max_workers=max_workers,
+        rate_per_second=rate_per_second, journal_path=journal_path)
+    if report is not None:
+        click.echo(report["status"].value_counts().to_string())
+
+
+if __name__ == '__main__':
+    restore_backup()
@@ -1,4 +1,5 @@
 from servicenow_api_tools.clients.clients import AggregateAPIClient
+from servicenow_api_tools.clients.cache import CachingServicenowRestEndpoint
 from servicenow_api_tools.clients.endpoint import ServicenowRestEndpoint
 import click
 import json
@@ -48,7 +49,12 @@ def format_result(result):
               default="false",
               help=('Controls output of display values versus ids. '
                     'Note that you can only query using IDs.'))
-def run_count_query(table, instance, base_url, group_by, query, display_value):
+@click.option('--cache-directory', type=str, default=None,
+              help='Reuse results from previous runs saved in this directory.')
+@click.option('--cache-ttl', type=float, default=300,
+              help='Seconds before results in --cache-directory are considered stale.')
+def run_count_query(table, instance, base_url, group_by, query, display_value, cache_directory,
+                    cache_ttl):
     """Helper script to quickly get all the possible values for a field."""
     if instance and base_url:
         click.echo("Cannot pass both --instance or --base-url")
@@ -56,10 +62,11 @@ def run_count_query(table, instance, base_url, group_by, query, display_value):
     if not (instance or base_url):
         click.echo("Must pass either --instance or --base-url")
         sys.exit(1)
-    ac = AggregateAPIClient(
-        endpoint=ServicenowRestEndpoint(
-            instance=instance,
-            base_url=base_url))
+    endpoint = ServicenowRestEndpoint(instance=instance, base_url=base_url)
+    if cache_directory:
+        endpoint = CachingServicenowRestEndpoint(
+            endpoint, ttl_seconds=cache_ttl, cache_directory=cache_directory)
+    ac = AggregateAPIClient(endpoint=endpoint)
     possibilities = ac.query(
         table=table, group_by=group_by.split(","), query=query, display_value=display_value)
     click.echo(format_result(possibilities))
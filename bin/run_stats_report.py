@@ -14,8 +14,10 @@ from servicenow_api_tools.clients import ServicenowRestEndpoint
               help="Run in \"debug mode\" to add debug columns with info used to calculate report",
               default=False)
 @click.option('--publish-directory', required=True, type=str, help="Directory to publish into")
+@click.option('--max-workers', type=int, default=8,
+              help="Maximum number of report queries to run at the same time.")
 def do_run_stats_report(instance, base_url, stats_report_definition_file, debug_mode,
-                        publish_directory):
+                        publish_directory, max_workers):
     """
     Runs the given stats report.
     """
@@ -30,7 +32,8 @@ def do_run_stats_report(instance, base_url, stats_report_definition_file, debug_
         stats_report_definition_file=stats_report_definition_file,
         endpoint=ServicenowRestEndpoint(
             instance=instance,
-            base_url=base_url))
+            base_url=base_url),
+        max_workers=max_workers)
     if debug_mode:
         report_name = f'{report_name} Debug Mode'
     publish_report_files(results, report_name, publish_directory)
@@ -1,10 +1,16 @@
-from .endpoint import ServicenowRestEndpoint
+from .endpoint import AsyncServicenowRestEndpoint, ServicenowRestEndpoint
 from .clients import (
     AggregateAPIClient,
     TableAPIClient,
     TableAPIUpdateClient)
+from .cache import CachingServicenowRestEndpoint
+from .bulk import BulkUpdateExecutor, TokenBucket
+from .async_clients import (
+    AsyncAggregateAPIClient,
+    AsyncTableAPIClient)
 from .querybuilder import (
     AggregateQueryBuilder,
+    BatchQueryBuilder,
     TableQueryBuilder,
     UpdateQueryBuilder)
 from .utils import load_credentials as load_api_credentials
@@ -12,10 +18,17 @@ from .utils import load_credentials as load_api_credentials
 # https://stackoverflow.com/questions/31079047/python-pep8-class-in-init-imported-but-not-used
 __all__ = [
     'ServicenowRestEndpoint',
+    'AsyncServicenowRestEndpoint',
+    'CachingServicenowRestEndpoint',
     'AggregateAPIClient',
     'TableAPIClient',
     'TableAPIUpdateClient',
+    'BulkUpdateExecutor',
+    'TokenBucket',
+    'AsyncAggregateAPIClient',
+    'AsyncTableAPIClient',
     'AggregateQueryBuilder',
+    'BatchQueryBuilder',
     'TableQueryBuilder',
     'UpdateQueryBuilder',
     'load_api_credentials',
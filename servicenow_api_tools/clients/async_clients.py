@@ -0,0 +1,124 @@
+from datetime import datetime
+from typing import Dict, List
+import asyncio
+import pandas as pd
+from servicenow_api_tools.clients import utils
+from servicenow_api_tools.clients.endpoint import AsyncServicenowRestEndpoint
+from servicenow_api_tools.clients.querybuilder import AggregateQueryBuilder
+from servicenow_api_tools.clients.querybuilder import TableQueryBuilder
+from servicenow_api_tools.utils import api_results_to_dataframe, get_module_logger
+
+
+class AsyncAggregateAPIClient:
+    """
+    asyncio version of AggregateAPIClient, returns the same results.
+    """
+    def __init__(self, endpoint: AsyncServicenowRestEndpoint):
+        self.logger = get_module_logger(__name__)
+        self.endpoint = endpoint
+
+    async def query(self, table: str, group_by: List[str] = None, query: str = None,
+                    having: str = None, display_value: str = None,
+                    return_count: bool = True) -> Dict:
+        aggregate_query = AggregateQueryBuilder(
+            table=table,
+            group_by=group_by,
+            query=query,
+            having=having,
+            display_value=display_value,
+            return_count=return_count)
+        self.logger.debug(f"Running query {aggregate_query}")
+
+        results = await self.endpoint.get(str(aggregate_query))
+
+        if not results:
+            msg = f"No result running query {aggregate_query}"
+            self.logger.error(msg)
+            raise Exception(msg)
+
+        if "error" in results:
+            msg = f"Failed running query {aggregate_query}: {results}"
+            self.logger.error(msg)
+            raise Exception(msg)
+
+        return results
+
+
+class AsyncTableAPIClient:
+    """
+    asyncio version of TableAPIClient, returns the same results.
+
+    All batches are requested at once, and the endpoint limits how many are in flight.
+    """
+    def __init__(self, endpoint: AsyncServicenowRestEndpoint):
+        self.logger = get_module_logger(__name__)
+        self.aggregate_client = AsyncAggregateAPIClient(endpoint)
+        self.endpoint = endpoint
+
+    async def _query(self, table: str, query: str = None, fields: List[str] = None,
+                     limit: int = None, offset: int = None, display_value: str = None,
+                     unpack_link_fields: bool = True,
+                     link_fields: utils.LinkFields = None) -> pd.DataFrame:
+        table_query = TableQueryBuilder(
+            table=table,
+            query=query,
+            fields=fields,
+            limit=limit,
+            offset=offset,
+            display_value=display_value)
+        self.logger.debug(f"Running query {table_query}")
+
+        results = await self.endpoint.get(str(table_query))
+
+        if "error" in results:
+            msg = f"Failed running query {table_query}: {results}"
+            self.logger.error(msg)
+            raise Exception(msg)
+
+        if unpack_link_fields:
+            if link_fields is not None:
+                return link_fields.unpack(results)
+            return utils.api_results_to_unpacked_dataframe(results)
+        return api_results_to_dataframe(results)
+
+    async def query(self, table: str, query: str = None, fields: List[str] = None,
+                    limit: int = None, offset: int = None, display_value: str = None,
+                    batch_size: int = 2000, unpack_link_fields: bool = True) -> pd.DataFrame:
+        """
+        Queries the ServiceNow API endpoint with the given parameters and returns the results as a
+        pandas DataFrame.
+        """
+        utils.check_unpack_link_fields(display_value, unpack_link_fields)
+        self.logger.debug(f"Running query: {query}")
+        number_of_records = int((await self.aggregate_client.query(
+            table=table,
+            query=query))["result"]["stats"]["count"])
+        if isinstance(limit, int):
+            number_of_records = min(number_of_records, limit)
+
+        self.logger.info(f"Pulling {number_of_records} records from {table} table from ServiceNow")
+
+        start_time = datetime.utcnow().timestamp()
+        link_fields = utils.LinkFields()
+        response_list = await asyncio.gather(*[
+            self._query(
+                table=table,
+                query=query,
+                fields=fields,
+                limit=batch_limit,
+                offset=batch_offset,
+                display_value=display_value,
+                unpack_link_fields=unpack_link_fields,
+                link_fields=link_fields)
+            for batch_offset, batch_limit in utils.split_offsets(batch_size, number_of_records)])
+        end_time = datetime.utcnow().timestamp()
+        self.logger.debug(f"Execution time {end_time - start_time} seconds")
+
+        nonzero_dataframes = [df for df in response_list if len(df) > 0]
+        if len(nonzero_dataframes) > 0:
+            result = pd.concat(nonzero_dataframes)
+        else:
+            result = pd.DataFrame()
+        utils.check_record_count(result.shape[0], number_of_records)
+
+        return result
@@ -0,0 +1,145 @@
+from datetime import datetime
+from typing import Any, Dict, List, Tuple
+import csv
+import gzip
+import json
+import os
+import pandas as pd
+import pathlib
+from servicenow_api_tools.utils import get_module_logger
+
+MANIFEST_FILE = "manifest.json"
+BACKUP_FORMATS = ["jsonl.gz", "csv", "parquet"]
+
+
+class BackupWriter:
+    """
+    Writes the original records of an update batch to <directory>/<timestamp>/<table>.<format>,
+    one batch of records at a time, so the records never have to be in memory all at once. A
+    backup started in the same second as another one gets a "_<n>" suffix on its timestamp.
+
+    The formats are gzipped JSON lines (the default), CSV, and Parquet, which needs pyarrow.
+
+    When closed without an error, it writes a manifest.json listing the file, row count and
+    updated fields of each table, which read_backup and TableAPIUpdateClient.restore_backup use.
+    Use it as a context manager, or call close when done.
+    """
+    def __init__(self, directory: str, backup_format: str = "jsonl.gz",
+                 updated_fields: Dict[str, List[str]] = None):
+        if backup_format not in BACKUP_FORMATS:
+            raise ValueError(f"Invalid backup format {backup_format}, must be one of "
+                             f"{BACKUP_FORMATS}")
+        if backup_format == "parquet":
+            try:
+                import pyarrow  # type: ignore # noqa: F401
+            except ImportError:
+                raise Exception(
+                    "Parquet backups require pyarrow, install it with \"pip install pyarrow\"")
+        self.logger = get_module_logger(__name__)
+        self.backup_format = backup_format
+        self.updated_fields = updated_fields or {}
+        self.path = self._make_directory(directory)
+        self.rows: Dict[str, int] = {}
+        self._files: Dict[str, Any] = {}
+        self._columns: Dict[str, List[str]] = {}
+
+    def _make_directory(self, directory: str) -> str:
+        # Backups started in the same second get a numbered suffix instead of overwriting each
+        # other. mkdir fails if the directory exists, even if another process just created it.
+        pathlib.Path(directory).mkdir(parents=True, exist_ok=True)
+        name = datetime.now().strftime("%Y-%m-%d_%H%M%S")
+        suffix = 0
+        while True:
+            path = os.path.join(directory, f"{name}_{suffix}" if suffix else name)
+            try:
+                pathlib.Path(path).mkdir()
+                return path
+            except FileExistsError:
+                suffix += 1
+
+    def _file_name(self, table: str) -> str:
+        return f"{table}.{self.backup_format}"
+
+    def _open(self, table: str, records: pd.DataFrame) -> Any:
+        path = os.path.join(self.path, self._file_name(table))
+        if self.backup_format == "jsonl.gz":
+            return gzip.open(path, 'wt', encoding='utf-8')
+        if self.backup_format == "csv":
+            return open(path, 'w', newline='', encoding='utf-8')
+        import pyarrow  # type: ignore
+        import pyarrow.parquet  # type: ignore
+        return pyarrow.parquet.ParquetWriter(
+            path, pyarrow.Table.from_pandas(records, preserve_index=False).schema)
+
+    def write(self, table: str, records: pd.DataFrame):
+        """Appends records to the backup of table."""
+        if table not in self._files:
+            self._files[table] = self._open(table, records)
+            self._columns[table] = list(records.columns)
+            self.rows[table] = 0
+            if self.backup_format == "csv":
+                csv.writer(self._files[table]).writerow(self._columns[table])
+        # Every batch of a table comes from the same query, but keep the columns in one order.
+        records = records.reindex(columns=self._columns[table])
+        f = self._files[table]
+        if self.backup_format == "jsonl.gz":
+            for record in records.to_dict('records'):
+                f.write(json.dumps(record, default=str) + "\n")
+        elif self.backup_format == "csv":
+            records.to_csv(f, header=False, index=False)
+        else:
+            import pyarrow  # type: ignore
+            f.write_table(pyarrow.Table.from_pandas(
+                records, schema=f.schema, preserve_index=False))
+        self.rows[table] += len(records)
+
+    def close(self, write_manifest: bool = True):
+        for f in self._files.values():
+            f.close()
+        self._files = {}
+        if not write_manifest:
+            return
+        manifest = {
+            "created_at": datetime.now().isoformat(),
+            "format": self.backup_format,
+            "tables": {
+                table: {
+                    "file": self._file_name(table),
+                    "rows": rows,
+                    "updated_fields": self.updated_fields.get(table, []),
+                }
+                for table, rows in self.rows.items()},
+        }
+        with open(os.path.join(self.path, MANIFEST_FILE), 'w') as f:
+            f.write(json.dumps(manifest, indent=4, sort_keys=True))
+        for table, rows in self.rows.items():
+            self.logger.info(f"Backed up {rows} rows for {table} to {self.path}.")
+
+    def __enter__(self) -> "BackupWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Without a manifest, an incomplete backup can't be restored by mistake.
+        self.close(write_manifest=exc_type is None)
+
+
+def read_backup(path: str) -> Tuple[Dict, Dict[str, pd.DataFrame]]:
+    """Returns the manifest and the records of each table of a backup written by BackupWriter."""
+    with open(os.path.join(path, MANIFEST_FILE), 'r') as f:
+        manifest = json.loads(f.read())
+    records = {}
+    for table, table_manifest in manifest["tables"].items():
+        file_path = os.path.join(path, table_manifest["file"])
+        if manifest["format"] == "jsonl.gz":
+            with gzip.open(file_path, 'rt', encoding='utf-8') as f:
+                records[table] = pd.DataFrame(
+                    [json.loads(line) for line in f], dtype="object")
+        elif manifest["format"] == "csv":
+            # Everything the API returns is a string, so don't let pandas guess types or NaNs.
+            records[table] = pd.read_csv(file_path, dtype=str, keep_default_na=False)
+        else:
+            records[table] = pd.read_parquet(file_path)
+        assert len(records[table]) == table_manifest["rows"], (
+            f"Expected {table_manifest['rows']} rows in {file_path}, "
+            f"found {len(records[table])}")
+    return (manifest, records)
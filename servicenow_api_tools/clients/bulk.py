@@ -0,0 +1,241 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Set, Tuple
+import hashlib
+import json
+import os
+import pandas as pd
+import pathlib
+import threading
+import time
+from servicenow_api_tools.clients.endpoint import ServicenowRestEndpoint
+from servicenow_api_tools.clients.querybuilder import BatchQueryBuilder
+from servicenow_api_tools.utils import get_module_logger
+
+REPORT_COLUMNS = ["table", "sys_id", "resource", "status", "attempts", "error"]
+
+
+class TokenBucket:
+    """
+    Allows rate_per_second operations on average, and bursts of up to burst operations.
+
+    acquire blocks until a token is available, and is safe to call from several threads.
+    """
+    def __init__(self, rate_per_second: float, burst: int = None):
+        assert rate_per_second > 0, "rate_per_second must be positive"
+        self.rate_per_second = rate_per_second
+        self.burst = burst if burst is not None else max(1, int(rate_per_second))
+        self._tokens = float(self.burst)
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.burst, self._tokens + (now - self._updated_at) * self.rate_per_second)
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait_seconds = (1 - self._tokens) / self.rate_per_second
+            time.sleep(wait_seconds)
+
+
+class UpdateJournal:
+    """
+    Append only log of the outcome of each update, one JSON object per line.
+
+    Every entry is flushed to disk before the update is reported as done, so after a crash the
+    journal lists every update that landed, plus at most the ones that were in flight.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        pathlib.Path(os.path.dirname(os.path.abspath(path))).mkdir(parents=True, exist_ok=True)
+
+    def completed(self) -> Set[str]:
+        """Returns the keys of the updates that succeeded in earlier runs."""
+        if not os.path.exists(self.path):
+            return set()
+        completed = set()
+        with open(self.path, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # The last line can be cut short if the process was killed while writing it.
+                    continue
+                if entry.get("status") == "updated":
+                    completed.add(entry["key"])
+        return completed
+
+    def record(self, entry: Dict):
+        with self._lock:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(entry, sort_keys=True) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+
+def update_key(update_op: Dict) -> str:
+    """Identifies an update by its resource and payload, so a changed payload is sent again."""
+    payload = json.dumps(update_op["obj"], sort_keys=True, default=str)
+    return hashlib.sha256(f'{update_op["resource"]}\n{payload}'.encode('utf-8')).hexdigest()
+
+
+class BulkUpdateExecutor:
+    """
+    Sends PUT requests for many records in parallel.
+
+    At most max_workers requests are in flight, and at most rate_per_second are started per second
+    (no limit if None). A request that raises or returns an error is retried up to max_retries
+    times, waiting backoff_seconds * 2 ** attempt in between.
+
+    If journal_path is set, the outcome of every update is appended to it, and updates that
+    already succeeded according to the journal are skipped, so an interrupted run can be started
+    again with the same updates.
+
+    If batch_size is more than 1, updates are sent batch_size at a time through the batch API, and
+    the rate limit applies to the batch requests. Only the updates in a batch that failed are
+    retried.
+    """
+    def __init__(self, endpoint: ServicenowRestEndpoint, max_workers: int = 8,
+                 rate_per_second: Optional[float] = 10.0, burst: int = None,
+                 max_retries: int = 3, backoff_seconds: float = 0.5, journal_path: str = None,
+                 batch_size: int = 1):
+        assert batch_size >= 1, "batch_size must be at least 1"
+        self.logger = get_module_logger(__name__)
+        self.endpoint = endpoint
+        self.max_workers = max_workers
+        self.rate_limiter = (
+            TokenBucket(rate_per_second, burst) if rate_per_second is not None else None)
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.journal = UpdateJournal(journal_path) if journal_path else None
+        self.batch_size = batch_size
+
+    def _new_report(self, update_op: Dict, status: str) -> Dict:
+        return {
+            "table": update_op.get("table"),
+            "sys_id": update_op["obj"].get("sys_id"),
+            "resource": update_op["resource"],
+            "status": status,
+            "attempts": 0,
+            "error": None,
+        }
+
+    def _finish(self, report: Dict, key: str) -> Dict:
+        if report["error"] is not None:
+            report["status"] = "failed"
+        if self.journal is not None:
+            self.journal.record(dict(report, key=key))
+        return report
+
+    def _put(self, update_op: Dict) -> Dict:
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+        result = self.endpoint.put(update_op["resource"], update_op["obj"])
+        if not result:
+            raise Exception(f'No result updating {update_op["resource"]}')
+        if "error" in result:
+            raise Exception(f'Failed updating {update_op["resource"]}: {result["error"]}')
+        return result
+
+    def _execute(self, update_op: Dict, key: str) -> Dict:
+        report = self._new_report(update_op, "updated")
+        for attempt in range(self.max_retries + 1):
+            report["attempts"] = attempt + 1
+            try:
+                self._put(update_op)
+                report["error"] = None
+                break
+            except Exception as e:
+                report["error"] = str(e)
+                self.logger.warning(
+                    f'Attempt {attempt + 1} updating {update_op["resource"]} failed: {e}')
+                if attempt < self.max_retries:
+                    time.sleep(self.backoff_seconds * (2 ** attempt))
+        return self._finish(report, key)
+
+    def _batch_error(self, response: Dict) -> Optional[str]:
+        if response["status_code"] is None:
+            return "Not serviced by the batch API"
+        body = response["body"] or {}
+        if response["status_code"] >= 400 or "error" in body:
+            return f'Failed with status {response["status_code"]}: {body.get("error")}'
+        return None
+
+    def _execute_batch(self, batch: List[Tuple[int, Dict, str]]) -> List[Tuple[int, Dict]]:
+        reports = {i: self._new_report(update_op, "updated") for i, update_op, _ in batch}
+        remaining = batch
+        for attempt in range(self.max_retries + 1):
+            batch_query = BatchQueryBuilder()
+            request_ids = []
+            for i, update_op, _ in remaining:
+                request_ids.append(
+                    batch_query.add_request("PUT", update_op["resource"], update_op["obj"]))
+                reports[i]["attempts"] = attempt + 1
+            failed = []
+            try:
+                if self.rate_limiter is not None:
+                    self.rate_limiter.acquire()
+                responses = self.endpoint.batch(batch_query)
+                for request_id, (i, update_op, key) in zip(request_ids, remaining):
+                    reports[i]["error"] = self._batch_error(
+                        responses.get(request_id, {"status_code": None, "body": None}))
+                    if reports[i]["error"] is not None:
+                        failed.append((i, update_op, key))
+            except Exception as e:
+                for i, update_op, key in remaining:
+                    reports[i]["error"] = str(e)
+                failed = remaining
+            if not failed:
+                break
+            self.logger.warning(
+                f"Attempt {attempt + 1} of a batch of {len(remaining)} updates had "
+                f"{len(failed)} failures")
+            remaining = failed
+            if attempt < self.max_retries:
+                time.sleep(self.backoff_seconds * (2 ** attempt))
+        return [(i, self._finish(reports[i], key)) for i, _, key in batch]
+
+    def run(self, update_ops: List[Dict]) -> pd.DataFrame:
+        """
+        Runs the updates, each a dict with the "resource" to PUT the "obj" to, and optionally the
+        "table" for the report.
+
+        Returns a report with one row per update, with status "updated", "failed", or "skipped"
+        if the journal says an earlier run already did it.
+        """
+        completed = self.journal.completed() if self.journal is not None else set()
+        keys = [update_key(update_op) for update_op in update_ops]
+        reports: List[Optional[Dict]] = [None] * len(update_ops)
+        to_run = []
+        for i, (update_op, key) in enumerate(zip(update_ops, keys)):
+            if key in completed:
+                reports[i] = self._new_report(update_op, "skipped")
+            else:
+                to_run.append(i)
+        self.logger.info(
+            f"Running {len(to_run)} updates, skipping {len(update_ops) - len(to_run)} "
+            "already done")
+
+        start_time = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            if self.batch_size > 1:
+                batches = [
+                    [(i, update_ops[i], keys[i]) for i in to_run[start:start + self.batch_size]]
+                    for start in range(0, len(to_run), self.batch_size)]
+                for batch_future in [pool.submit(self._execute_batch, b) for b in batches]:
+                    for i, batch_report in batch_future.result():
+                        reports[i] = batch_report
+            else:
+                futures = {i: pool.submit(self._execute, update_ops[i], keys[i]) for i in to_run}
+                for i, future in futures.items():
+                    reports[i] = future.result()
+        report = pd.DataFrame(reports, columns=REPORT_COLUMNS)
+        self.logger.info(
+            f"Ran {len(to_run)} updates in {time.monotonic() - start_time:.1f} seconds: "
+            f"{report['status'].value_counts().to_dict()}")
+        return report
@@ -0,0 +1,173 @@
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+import hashlib
+import json
+import os
+import pathlib
+import re
+import threading
+import time
+from servicenow_api_tools.clients.endpoint import ServicenowRestEndpoint
+from servicenow_api_tools.clients.runner import json_loads
+from servicenow_api_tools.utils import get_module_logger
+
+# The table a table API or stats API resource reads or writes, e.g. "activity" for
+# "/api/now/table/activity/<sys_id>" and "/api/now/stats/activity?sysparm_count=true".
+TABLE_RESOURCE_PATTERN = re.compile(r'^/api/now/(?:v\d+/)?(?:table|stats)/([^/?]+)')
+
+
+def _resource_table(resource: str) -> Optional[str]:
+    match = TABLE_RESOURCE_PATTERN.match(resource)
+    return match.group(1) if match else None
+
+
+class CachingServicenowRestEndpoint(ServicenowRestEndpoint):
+    """
+    Wraps another endpoint and caches the results of GET requests, keyed on the full URL and the
+    username, so a shared cache_directory never gives one user the results of another.
+
+    Entries expire after ttl_seconds, and the least recently used ones are evicted once there are
+    more than max_entries in memory. If cache_directory is set, entries are also written there, so
+    they can be reused by later processes. PUT and POST requests are never cached, and they expire
+    the cached table and stats results of the tables they write to, including the requests of a
+    batch API request. Writes made by other processes or users aren't seen until the TTL expires.
+
+    The base_url and credentials are the wrapped endpoint's. Expired entries in cache_directory
+    are deleted when they are next looked up.
+    """
+    def __init__(self, endpoint: ServicenowRestEndpoint, ttl_seconds: float = 300,
+                 max_entries: int = 1024, cache_directory: str = None):
+        super().__init__(
+            base_url=endpoint.base_url,
+            username=endpoint.username,
+            password=endpoint.password,
+            credentials_from_env=False)
+        self.logger = get_module_logger(__name__)
+        self.endpoint = endpoint
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.cache_directory = cache_directory
+        if cache_directory:
+            pathlib.Path(cache_directory).mkdir(parents=True, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+        # Entries are (time stored, serialized result), serialized so callers can't modify them.
+        self._entries: "OrderedDict[str, Tuple[float, bytes]]" = OrderedDict()
+        # When each table was last written to through this endpoint, entries for it requested
+        # before then are stale.
+        self._written_at: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def _cache_key(self, resource: str) -> str:
+        return f'{self.username}@{self.base_url}{resource}'
+
+    def _cache_file(self, key: str) -> str:
+        assert self.cache_directory
+        return os.path.join(
+            self.cache_directory, f'{hashlib.sha256(key.encode("utf-8")).hexdigest()}.json')
+
+    def _is_fresh(self, stored_at: float, table: Optional[str]) -> bool:
+        if table is not None and stored_at <= self._written_at.get(table, 0):
+            return False
+        return time.time() - stored_at < self.ttl_seconds
+
+    def _load(self, key: str, table: Optional[str]) -> Optional[bytes]:
+        with self._lock:
+            if key in self._entries:
+                (stored_at, data) = self._entries[key]
+                if self._is_fresh(stored_at, table):
+                    self._entries.move_to_end(key)
+                    return data
+                del self._entries[key]
+        if self.cache_directory:
+            cache_file = self._cache_file(key)
+            try:
+                with open(cache_file, 'rb') as f:
+                    entry = json_loads(f.read())
+            except FileNotFoundError:
+                return None
+            if entry["key"] != key:
+                return None
+            with self._lock:
+                fresh = self._is_fresh(entry["stored_at"], table)
+            if not fresh:
+                try:
+                    os.remove(cache_file)
+                except FileNotFoundError:
+                    # Another process got to it first.
+                    pass
+                return None
+            data = entry["result"].encode("utf-8")
+            self._store_in_memory(key, entry["stored_at"], data)
+            return data
+        return None
+
+    def _store_in_memory(self, key: str, stored_at: float, data: bytes):
+        with self._lock:
+            self._entries[key] = (stored_at, data)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _store(self, key: str, stored_at: float, data: bytes):
+        self._store_in_memory(key, stored_at, data)
+        if self.cache_directory:
+            cache_file = self._cache_file(key)
+            # Write and rename, so a concurrent reader never sees a partial file.
+            temp_file = f"{cache_file}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temp_file, 'w') as f:
+                f.write(json.dumps(
+                    {"key": key, "stored_at": stored_at, "result": data.decode("utf-8")}))
+            os.replace(temp_file, cache_file)
+
+    def _expire_table(self, resource: str):
+        table = _resource_table(resource)
+        if table is None:
+            return
+        with self._lock:
+            self._written_at[table] = time.time()
+        self.logger.debug(f"Expired cached results for {table}")
+
+    def get(self, resource: str):
+        key = self._cache_key(resource)
+        table = _resource_table(resource)
+        data = self._load(key, table)
+        if data is not None:
+            with self._lock:
+                self.hits += 1
+            self.logger.debug(f"Cache hit for {key}")
+            return json_loads(data)
+        with self._lock:
+            self.misses += 1
+        self.logger.debug(f"Cache miss for {key}")
+        # Entries count from when they were requested, so a result that was requested before a
+        # write and arrives after it is already stale.
+        requested_at = time.time()
+        result = self.endpoint.get(resource)
+        # Don't hold on to failures, the next request might work.
+        if result and "error" not in result:
+            self._store(key, requested_at, json.dumps(result).encode("utf-8"))
+        return result
+
+    def put(self, resource: str, obj: Dict):
+        try:
+            return self.endpoint.put(resource, obj)
+        finally:
+            self._expire_table(resource)
+
+    def post(self, resource: str, obj: Dict):
+        try:
+            return self.endpoint.post(resource, obj)
+        finally:
+            self._expire_table(resource)
+            for rest_request in (obj or {}).get("rest_requests", []):
+                if rest_request.get("method", "GET").upper() != "GET":
+                    self._expire_table(rest_request.get("url", ""))
+
+    def cache_stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries)}
+
+    def clear_cache(self):
+        with self._lock:
+            self._entries.clear()
@@ -1,18 +1,33 @@
-from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, as_completed, wait
 from datetime import datetime
 from functools import partial
-from typing import List, Tuple, Dict
+from itertools import islice
+from typing import (
+    TYPE_CHECKING, Deque, Dict, Iterator, List, Optional, Tuple, Union, overload)
 import json
 import os
 import pandas as pd
 import pathlib
 import traceback
+from servicenow_api_tools import operators
 from servicenow_api_tools.clients import utils
+from servicenow_api_tools.clients.backup import BackupWriter, read_backup
+from servicenow_api_tools.clients.bulk import REPORT_COLUMNS, BulkUpdateExecutor
+from servicenow_api_tools.clients.diff import CHANGE_COLUMNS, diff_updates
 from servicenow_api_tools.clients.endpoint import ServicenowRestEndpoint
 from servicenow_api_tools.clients.querybuilder import AggregateQueryBuilder
 from servicenow_api_tools.clients.querybuilder import TableQueryBuilder
 from servicenow_api_tools.clients.querybuilder import UpdateQueryBuilder
-from servicenow_api_tools.utils import api_results_to_dataframe, get_module_logger
+from servicenow_api_tools.utils import (
+    api_results_to_dataframe, dataframe_to_api_results, get_module_logger)
+
+# Keeps sys_idIN queries well under the URL length limits of the instance and of proxies.
+MAX_IN_QUERY_LENGTH = 4000
+
+if TYPE_CHECKING:
+    # Only needed for the TableAPIClient.query overloads, typing.Literal is not in python 3.7.
+    from typing_extensions import Literal
 
 
 class AggregateAPIClient:
@@ -52,14 +67,9 @@ class TableAPIClient:
         self.aggregate_client = AggregateAPIClient(endpoint)
         self.endpoint = endpoint
 
-    def _split_offsets(self, batch_size: int, max_rows: int) -> List[Tuple[int, int]]:
-        batch_offsets = []
-        for offset in range(0, max_rows, batch_size):
-            batch_offsets.append((offset, min(offset + batch_size, max_rows) - offset))
-        return batch_offsets
-
     def _pull_batch(
-            self, offset, limit, table, query_params, fields, unpack_link_fields, display_value):
+            self, offset, limit, table, query_params, fields, unpack_link_fields, display_value,
+            link_fields):
         self.logger.info(f"Pulling {table} rows {offset} to {offset+limit}")
 
         self.logger.debug(f"Query params: {query_params}")
@@ -70,13 +80,14 @@ class TableAPIClient:
             limit=limit,
             fields=fields,
             unpack_link_fields=unpack_link_fields,
-            display_value=display_value)
+            display_value=display_value,
+            link_fields=link_fields)
         self.logger.debug(f"Completed pull for {table} rows {offset} to {offset+limit}")
         return result
 
-    def _query(self, table: str, query: str = None, fields: List[str] = None, limit: int = None,
-               offset: int = None, display_value: str = None,
-               unpack_link_fields: bool = True) -> pd.DataFrame:
+    def _get_results(self, table: str, query: str = None, fields: List[str] = None,
+                     limit: int = None, offset: int = None,
+                     display_value: str = None) -> Dict[str, List[Dict]]:
         table_query = TableQueryBuilder(
             table=table,
             query=query,
@@ -92,77 +103,481 @@ class TableAPIClient:
             msg = f"Failed running query {table_query}: {results}"
             self.logger.error(msg)
             raise Exception(msg)
+        return results
 
-        response_dataframe = api_results_to_dataframe(results)
-
-        if len(response_dataframe) > 0 and unpack_link_fields:
+    def _results_to_dataframe(self, results: Dict[str, List[Dict]], unpack_link_fields: bool,
+                              link_fields: utils.LinkFields = None) -> pd.DataFrame:
+        if unpack_link_fields:
             # The "link fields" have the hash of the object and the display name in a sub object.
-            # This unpacks them and sets them as two top level columns of their own.
+            # This unpacks them and sets them as two top level columns of their own, building the
+            # columns straight from the records rather than from a DataFrame of dictionaries.
             #
             # NOTE: This assumes we are passing these to the API:
             #
             #           sysparm_display_value=all
             #           sysparm_exclude_reference_link=False
             #
-            response_dataframe = utils.unpack_link_fields(response_dataframe)
-        return response_dataframe
+            if link_fields is not None:
+                return link_fields.unpack(results)
+            return utils.api_results_to_unpacked_dataframe(results)
+        return api_results_to_dataframe(results)
 
-    def query(self, table: str, query: str = None, fields: List[str] = None, limit: int = None,
-              offset: int = None, display_value: str = None,
-              batch_size: int = 2000, max_workers: int = 8,
-              unpack_link_fields: bool = True) -> pd.DataFrame:
+    def _query(self, table: str, query: str = None, fields: List[str] = None, limit: int = None,
+               offset: int = None, display_value: str = None,
+               unpack_link_fields: bool = True,
+               link_fields: utils.LinkFields = None) -> pd.DataFrame:
+        results = self._get_results(
+            table=table,
+            query=query,
+            fields=fields,
+            limit=limit,
+            offset=offset,
+            display_value=display_value)
+        return self._results_to_dataframe(results, unpack_link_fields, link_fields)
+
+    def _split_keyset(self, keyset_field: str,
+                      max_workers: int) -> List[Tuple[Optional[str], Optional[str]]]:
         """
-        Queries the ServiceNow API endpoint with the given parameters and returns the results as a
-        pandas DataFrame.
+        Splits the key space into [lower, upper) ranges that can be paged through in parallel.
+
+        Only sys_id has a known key space, for any other field there is a single range.
         """
-        if unpack_link_fields:
-            assert display_value is None, (
-                "Passing display_value is currently not supported with unpack_link_fields. "
-                "The unpack_link_fields option sets {field_value} under \"{field_name}\" "
-                "and {field_display_value} under \"{field_name}_display_value\" in the dataframe.")
+        if keyset_field != "sys_id" or max_workers <= 1:
+            return [(None, None)]
+        # sys_ids are 32 character hex strings, so split on their first two hex digits.
+        bounds = sorted(set(f"{(256 * i) // max_workers:02x}" for i in range(1, max_workers)))
+        lowers: List[Optional[str]] = [None]
+        uppers: List[Optional[str]] = []
+        lowers.extend(bounds)
+        uppers.extend(bounds)
+        uppers.append(None)
+        return list(zip(lowers, uppers))
+
+    def _keyset_query(self, query_params: Optional[str], keyset_field: str,
+                      lower: Optional[str], upper: Optional[str],
+                      after: Optional[Tuple[str, str]]) -> str:
+        """
+        Builds the query for the page after the (key, sys_id) cursor, or the first page if there
+        is no cursor yet, of the rows with lower <= keyset_field < upper.
+
+        Empty keys sort before every other key, and can't be compared against, so a cursor on an
+        empty key asks for the other empty keys with ISEMPTY and the rest with ISNOTEMPTY.
+        """
+        predicates = [query_params] if query_params else []
+        if upper is not None:
+            predicates.append(operators.LESS_THAN(keyset_field, upper))
+        order_by = [operators.ORDER_BY(keyset_field)]
+        if keyset_field != "sys_id":
+            order_by.append(operators.ORDER_BY("sys_id"))
+        if after is None:
+            if lower is not None:
+                predicates.append(operators.GREATER_THAN_OR_EQUAL(keyset_field, lower))
+            return operators.AND(*predicates, *order_by)
+        (after_key, after_sys_id) = after
+        if keyset_field == "sys_id":
+            return operators.AND(
+                *predicates, operators.GREATER_THAN("sys_id", after_sys_id), *order_by)
+        # Either a later key, or the same key and a later sys_id. Each ^NQ query stands on its
+        # own, so both repeat the caller's query and the range.
+        if after_key:
+            later_key = operators.GREATER_THAN(keyset_field, after_key)
+            same_key = operators.IS(keyset_field, after_key)
+        else:
+            later_key = operators.NOT_EMPTY(keyset_field)
+            same_key = operators.EMPTY(keyset_field)
+        return operators.NEW_QUERY(
+            operators.AND(*predicates, later_key),
+            operators.AND(
+                *predicates,
+                same_key,
+                operators.GREATER_THAN("sys_id", after_sys_id),
+                *order_by))
+
+    def _iter_keyset_range(
+            self, table: str, query_params: Optional[str], keyset_field: str,
+            lower: Optional[str], upper: Optional[str], batch_size: int,
+            fields: Optional[List[str]], unpack_link_fields: bool,
+            display_value: Optional[str], link_fields: utils.LinkFields) -> Iterator[pd.DataFrame]:
+        """
+        Pages through the rows with lower <= keyset_field < upper in (keyset_field, sys_id) order,
+        asking for the rows after the last (key, sys_id) seen instead of using sysparm_offset.
+
+        The cursor uses the raw values from the API results, not the display values, which
+        can be formatted for the user's locale and timezone.
+        """
+        # The keys have to be in the results even if the caller didn't ask for them.
+        extra_fields = []
+        if fields:
+            extra_fields = [f for f in ["sys_id", keyset_field] if f not in fields]
+        request_fields = fields + extra_fields if fields else fields
+        extra_columns = extra_fields + [f"{f}_display_value" for f in extra_fields]
+        after: Optional[Tuple[str, str]] = None
+        while True:
+            self.logger.info(
+                f"Pulling {table} rows with {keyset_field} after {after} in [{lower}, {upper})")
+            results = self._get_results(
+                table=table,
+                query=self._keyset_query(query_params, keyset_field, lower, upper, after),
+                fields=request_fields,
+                limit=batch_size,
+                display_value=display_value)
+            records = results["result"]
+            if len(records) == 0:
+                return
+            after = (utils.get_link_field_value(records[-1][keyset_field]),
+                     utils.get_link_field_value(records[-1]["sys_id"]))
+
+            page = self._results_to_dataframe(results, unpack_link_fields, link_fields)
+            yield page.drop(columns=[c for c in extra_columns if c in page.columns])
+            if len(records) < batch_size:
+                return
+
+    def _iter_keyset_batches(
+            self, table: str, query: Optional[str], keyset_field: str, batch_size: int,
+            max_workers: int, fields: Optional[List[str]], unpack_link_fields: bool,
+            display_value: Optional[str]) -> Iterator[Tuple[int, pd.DataFrame]]:
+        """
+        Pages through every key range in parallel, yielding (range index, batch) as batches arrive.
+
+        Each range only ever has one page in flight, since the next request depends on the last
+        key of the previous page.
+        """
+        assert display_value in [None, "false", "all"], (
+            "Keyset pagination needs the raw field values, "
+            "so display_value must be one of None, \"false\" or \"all\"")
+        if query and "^NQ" in query:
+            # The cursor is ANDed onto the query, which would only apply it to the last ^NQ query.
+            raise ValueError(f"Keyset pagination doesn't support ^NQ in the query: {query}")
+        # Every range is part of the same query, so they share the link fields.
+        link_fields = utils.LinkFields()
+        ranges = [
+            self._iter_keyset_range(
+                table, query, keyset_field, lower, upper, batch_size, fields,
+                unpack_link_fields, display_value, link_fields)
+            for lower, upper in self._split_keyset(keyset_field, max_workers)]
+
+        self.logger.info(
+            f"Pulling {table} table from ServiceNow in {len(ranges)} {keyset_field} ranges")
+
+        start_time = datetime.utcnow().timestamp()
+        pending: Dict[Future, int] = {}
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            try:
+                for range_index, keyset_range in enumerate(ranges):
+                    pending[pool.submit(next, keyset_range, None)] = range_index
+                while pending:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        range_index = pending.pop(future)
+                        response_dataframe = future.result()
+                        if response_dataframe is None:
+                            continue
+                        pending[pool.submit(next, ranges[range_index], None)] = range_index
+                        yield (range_index, response_dataframe)
+            except Exception as e:
+                self.logger.error(f"Failure pulling {table}: {e}")
+                self.logger.error(traceback.format_exc())
+                raise
+            finally:
+                # Same as in iter_query, cancel before the with block waits for the queued pages.
+                for future in pending:
+                    future.cancel()
+
+        end_time = datetime.utcnow().timestamp()
+        self.logger.debug(f"Execution time {end_time - start_time} seconds")
+
+    def iter_query(self, table: str, query: str = None, fields: List[str] = None,
+                   limit: int = None, offset: int = None, display_value: str = None,
+                   batch_size: int = 2000, max_workers: int = 8,
+                   unpack_link_fields: bool = True,
+                   keyset_field: str = None) -> Iterator[pd.DataFrame]:
+        """
+        Same as query, but yields the results one batch at a time, in offset order, instead of
+        concatenating them into one DataFrame.
+
+        At most max_workers batches are requested ahead of the one being yielded, so memory use
+        scales with batch_size * max_workers instead of with the size of the table.
+
+        With keyset_field set, batches from different key ranges are yielded in the order they
+        arrive, see query.
+        """
+        utils.check_unpack_link_fields(display_value, unpack_link_fields)
+        if keyset_field:
+            assert limit is None and offset is None, (
+                "limit and offset are not supported with keyset pagination")
+            for _, response_dataframe in self._iter_keyset_batches(
+                    table, query, keyset_field, batch_size, max_workers, fields,
+                    unpack_link_fields, display_value):
+                yield response_dataframe
+            return
         self.logger.debug(f"Running query: {query}")
         number_of_records = int(self.aggregate_client.query(
             table=table,
             query=query)["result"]["stats"]["count"])
-        if type(limit) == int:
+        if isinstance(limit, int):
             number_of_records = min(number_of_records, limit)
-        batch_offsets = self._split_offsets(batch_size, number_of_records)
+        batch_offsets = iter(utils.split_offsets(batch_size, number_of_records))
+        pull_batch = partial(
+            self._pull_batch, table=table,
+            query_params=query,
+            fields=fields,
+            unpack_link_fields=unpack_link_fields,
+            display_value=display_value,
+            link_fields=utils.LinkFields())
 
         self.logger.info(f"Pulling {number_of_records} records from {table} table from ServiceNow")
 
         start_time = datetime.utcnow().timestamp()
-        try:
-            with ThreadPoolExecutor(max_workers=max_workers) as pool:
-                response_list = list(
-                    pool.map((lambda args, f=partial(
-                        self._pull_batch, table=table,
-                        query_params=query,
-                        fields=fields,
-                        unpack_link_fields=unpack_link_fields,
-                        display_value=display_value): f(*args)), batch_offsets))
-        except Exception as e:
-            self.logger.error(f"Failure pulling {table}: {e}")
-            self.logger.error(traceback.format_exc())
+        received = 0
+        pending: Deque[Future] = deque()
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            try:
+                for batch_offset, batch_limit in islice(batch_offsets, max_workers):
+                    pending.append(pool.submit(pull_batch, batch_offset, batch_limit))
+                while pending:
+                    response_dataframe = pending.popleft().result()
+                    # Keep the pool busy while the caller works on this batch.
+                    for batch_offset, batch_limit in islice(batch_offsets, 1):
+                        pending.append(pool.submit(pull_batch, batch_offset, batch_limit))
+                    received += len(response_dataframe)
+                    if len(response_dataframe) > 0:
+                        yield response_dataframe
+            except Exception as e:
+                self.logger.error(f"Failure pulling {table}: {e}")
+                self.logger.error(traceback.format_exc())
+                raise
+            finally:
+                # If the caller stopped iterating early, don't pull batches nobody will read. This
+                # has to happen before leaving the with block, which waits for every queued batch.
+                for future in pending:
+                    future.cancel()
 
         end_time = datetime.utcnow().timestamp()
         self.logger.debug(f"Execution time {end_time - start_time} seconds")
 
-        nonzero_dataframes = []
-        for response_dataframe in response_list:
-            if len(response_dataframe) > 0:
-                nonzero_dataframes.append(response_dataframe)
+        utils.check_record_count(received, number_of_records)
+
+    @overload
+    def query(self, table: str, query: str = None, fields: List[str] = None, limit: int = None,
+              offset: int = None, display_value: str = None,
+              batch_size: int = 2000, max_workers: int = 8,
+              unpack_link_fields: bool = True, keyset_field: str = None,
+              stream: "Literal[False]" = False) -> pd.DataFrame:
+        ...
+
+    @overload
+    def query(self, table: str, query: str = None, fields: List[str] = None, limit: int = None,
+              offset: int = None, display_value: str = None,
+              batch_size: int = 2000, max_workers: int = 8,
+              unpack_link_fields: bool = True, keyset_field: str = None, *,
+              stream: "Literal[True]") -> Iterator[pd.DataFrame]:
+        ...
+
+    def query(self, table: str, query: str = None, fields: List[str] = None, limit: int = None,
+              offset: int = None, display_value: str = None,
+              batch_size: int = 2000, max_workers: int = 8,
+              unpack_link_fields: bool = True, keyset_field: str = None,
+              stream: bool = False) -> Union[pd.DataFrame, Iterator[pd.DataFrame]]:
+        """
+        Queries the ServiceNow API endpoint with the given parameters and returns the results as a
+        pandas DataFrame.
+
+        By default this pages through the table with sysparm_offset. If keyset_field is set, it
+        instead orders by that field and asks for the rows after the last one seen, which keeps
+        deep pages as fast as the first one and doesn't skip or repeat rows when the table changes
+        during the pull. For sys_id, the key space is split into max_workers ranges that are pulled
+        in parallel, and the result is in sys_id order.
+
+        If stream is True, returns an iterator over the batches instead, see iter_query.
+        """
+        if keyset_field and not stream:
+            utils.check_unpack_link_fields(display_value, unpack_link_fields)
+            assert limit is None and offset is None, (
+                "limit and offset are not supported with keyset pagination")
+            keyset_batches = sorted(
+                self._iter_keyset_batches(
+                    table, query, keyset_field, batch_size, max_workers, fields,
+                    unpack_link_fields, display_value),
+                key=lambda batch: batch[0])
+            if len(keyset_batches) > 0:
+                return pd.concat([batch for _, batch in keyset_batches])
+            return pd.DataFrame()
+
+        batches = self.iter_query(
+            table=table,
+            query=query,
+            fields=fields,
+            limit=limit,
+            offset=offset,
+            display_value=display_value,
+            batch_size=batch_size,
+            max_workers=max_workers,
+            unpack_link_fields=unpack_link_fields,
+            keyset_field=keyset_field)
+        if stream:
+            return batches
+
+        nonzero_dataframes = list(batches)
         if len(nonzero_dataframes) > 0:
             result = pd.concat(nonzero_dataframes)
         else:
             result = pd.DataFrame()
-        assert ((result.shape[0] < number_of_records + 100)
-                and (result.shape[0] > number_of_records - 100)), (
-            "Expected count and recieved off by more than 100.  "
-            "This could either be a bug or because a lot changed while the query was running.  "
-            f"Actual: {result.shape[0]}, Initial Count: {number_of_records}")
+        return result
+
+    def _load_sync_state(self, table: str, store_path: str) -> Tuple[Dict, pd.DataFrame]:
+        state_path = os.path.join(store_path, f"{table}.watermark.json")
+        snapshot_path = os.path.join(store_path, f"{table}.json")
+        if not (os.path.exists(state_path) and os.path.exists(snapshot_path)):
+            return ({}, pd.DataFrame())
+        with open(state_path, 'r') as f:
+            state = json.loads(f.read())
+        with open(snapshot_path, 'r') as f:
+            snapshot = api_results_to_dataframe(json.loads(f.read()))
+        return (state, snapshot)
+
+    def _replace_file(self, path: str, content: str):
+        # A crash while writing leaves the old file in place, never a half written one.
+        temporary_path = f"{path}.tmp"
+        with open(temporary_path, 'w') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary_path, path)
+
+    def _save_sync_state(self, table: str, store_path: str, state: Dict, snapshot: pd.DataFrame):
+        pathlib.Path(store_path).mkdir(parents=True, exist_ok=True)
+        # Replace the snapshot before the watermark, so a crash in between means we pull too much
+        # next time instead of too little.
+        self._replace_file(
+            os.path.join(store_path, f"{table}.json"),
+            json.dumps(dataframe_to_api_results(snapshot)))
+        self._replace_file(
+            os.path.join(store_path, f"{table}.watermark.json"),
+            json.dumps(state, indent=4, sort_keys=True))
+
+    def _split_in_query(self, field: str, values: List[str],
+                        max_query_length: int) -> List[List[str]]:
+        chunks: List[List[str]] = []
+        length = 0
+        for value in values:
+            if not chunks or length + len(value) + 1 > max_query_length:
+                chunks.append([])
+                length = len(operators.IN(field, []))
+            chunks[-1].append(value)
+            length += len(value) + 1
+        return chunks
+
+    def iter_records_by_sys_id(
+            self, table: str, sys_ids: List[str], fields: List[str] = None,
+            max_workers: int = 8, max_query_length: int = MAX_IN_QUERY_LENGTH,
+            unpack_link_fields: bool = True) -> Iterator[pd.DataFrame]:
+        """
+        Same as get_records_by_sys_id, but yields the batches of records as they arrive.
+        """
+        if fields and "sys_id" not in fields:
+            fields = ["sys_id"] + fields
+        chunks = self._split_in_query("sys_id", list(dict.fromkeys(sys_ids)), max_query_length)
+        self.logger.info(
+            f"Looking up {len(sys_ids)} {table} records in {len(chunks)} sys_idIN queries")
+        link_fields = utils.LinkFields()
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = [
+                pool.submit(
+                    self._query, table=table, query=operators.IN("sys_id", chunk),
+                    fields=fields, limit=len(chunk), unpack_link_fields=unpack_link_fields,
+                    link_fields=link_fields)
+                for chunk in chunks]
+            try:
+                for future in as_completed(futures):
+                    batch = future.result()
+                    if len(batch) > 0:
+                        yield batch
+            finally:
+                for future in futures:
+                    future.cancel()
+
+    def get_records_by_sys_id(self, table: str, sys_ids: List[str], fields: List[str] = None,
+                              max_workers: int = 8,
+                              max_query_length: int = MAX_IN_QUERY_LENGTH,
+                              unpack_link_fields: bool = True) -> pd.DataFrame:
+        """
+        Looks up the records with the given sys_ids and returns them indexed by sys_id, in no
+        particular order. sys_ids that don't exist are missing from the result.
 
+        The sys_ids are split into sys_idIN queries of at most max_query_length characters,
+        which are run in parallel, one request each.
+        """
+        nonzero_batches = list(self.iter_records_by_sys_id(
+            table, sys_ids, fields=fields, max_workers=max_workers,
+            max_query_length=max_query_length, unpack_link_fields=unpack_link_fields))
+        if len(nonzero_batches) == 0:
+            return pd.DataFrame(columns=fields or ["sys_id"])
+        result = pd.concat(nonzero_batches)
+        result.index = pd.Index([utils.get_link_field_value(x) for x in result["sys_id"]])
         return result
 
+    def sync(self, table: str, store_path: str, query: str = None, fields: List[str] = None,
+             batch_size: int = 2000, max_workers: int = 8,
+             watermark_field: str = "sys_updated_on") -> pd.DataFrame:
+        """
+        Keeps a local snapshot of a table in store_path up to date and returns it.
+
+        The first call pulls the whole table. After that, only the rows with watermark_field at or
+        after the latest value seen in the last sync are pulled, and they replace the rows with
+        the same sys_id in the snapshot. If query or fields change, the whole table is pulled
+        again.
+
+        The watermark is the raw value of watermark_field, which is in UTC, and not the display
+        value, which is formatted for the user's locale and timezone.
+
+        NOTE: Deleted records don't change sys_updated_on, so they stay in the snapshot.
+        """
+        if query and "^NQ" in query:
+            # The watermark is ANDed onto the query, which would only apply it to the last ^NQ
+            # query.
+            raise ValueError(f"sync doesn't support ^NQ in the query: {query}")
+        if fields:
+            fields = fields + [f for f in ["sys_id", watermark_field] if f not in fields]
+        (state, snapshot) = self._load_sync_state(table, store_path)
+        watermark = state.get("watermark")
+        if state.get("query") != query or state.get("fields") != fields:
+            self.logger.info(f"No usable snapshot of {table} in {store_path}, pulling everything")
+            watermark = None
+            snapshot = pd.DataFrame()
+
+        delta_query = query
+        if watermark is not None:
+            delta_query = operators.AND(
+                *([query] if query else []),
+                operators.GREATER_THAN_OR_EQUAL(watermark_field, watermark))
+        packed_delta = self.query(
+            table=table,
+            query=delta_query,
+            fields=fields,
+            batch_size=batch_size,
+            max_workers=max_workers,
+            unpack_link_fields=False)
+        self.logger.info(
+            f"Pulled {len(packed_delta)} new or updated {table} rows since {watermark}")
+
+        if len(packed_delta) > 0:
+            # Unpacking keeps only the display value of fields that aren't links, so read the
+            # raw watermark values first.
+            watermark = utils.latest_datetime(
+                packed_delta[watermark_field].map(utils.get_link_field_value), watermark)
+            delta = utils.unpack_link_fields(packed_delta)
+            if len(snapshot) > 0:
+                snapshot = pd.concat([snapshot[~snapshot["sys_id"].isin(delta["sys_id"])], delta])
+            else:
+                snapshot = delta
+            snapshot = snapshot.reset_index(drop=True)
+
+        self._save_sync_state(
+            table, store_path,
+            {"watermark": watermark, "query": query, "fields": fields},
+            snapshot)
+        return snapshot
+
 
 class TableAPIUpdateClient:
     def __init__(self, endpoint: ServicenowRestEndpoint):
@@ -171,19 +586,35 @@ class TableAPIUpdateClient:
         self.endpoint = endpoint
         self.queued_updates: Dict[str, List[Dict]] = {}
 
-    def _get_original_records_for_queued_updates(self):
+    def _get_original_records_for_queued_updates(
+            self, max_workers: int = 8, max_query_length: int = MAX_IN_QUERY_LENGTH,
+            backup: BackupWriter = None) -> Dict[str, pd.DataFrame]:
+        """
+        Returns the current records for the queued updates of each table, indexed by sys_id.
+
+        The records have the raw values of each field, not the display values, since those are
+        what an update sets and what a restore has to put back. If backup is set, each batch of
+        records is written to it as it arrives.
+        """
         original_records = {}
         for table_name, updates in self.queued_updates.items():
             sys_ids = []
             for obj in updates:
                 sys_ids.append(obj['sys_id'])
-            result = self.table_client.query(
-                table=table_name,
-                query=f'sys_idIN{",".join(sys_ids)}')
+            batches = []
+            for packed_batch in self.table_client.iter_records_by_sys_id(
+                    table_name, sys_ids, max_workers=max_workers,
+                    max_query_length=max_query_length, unpack_link_fields=False):
+                batch = utils.link_field_values(packed_batch)
+                if backup is not None:
+                    backup.write(table_name, batch)
+                batches.append(batch)
+            result = pd.concat(batches) if batches else pd.DataFrame(columns=["sys_id"])
+            result.index = pd.Index(result["sys_id"].values)
             if result.shape[0] != len(sys_ids):
                 self.logger.error("Could not find records for sys_ids:")
                 for sys_id in sys_ids:
-                    if sys_id not in result['sys_id'].values:
+                    if sys_id not in result.index:
                         self.logger.error(f"\tsys_id: {sys_id}")
                 self.logger.error("Aborting.")
                 raise Exception("Could not find records for sys_ids.")
@@ -192,17 +623,12 @@ class TableAPIUpdateClient:
             original_records[table_name] = result
         return original_records
 
-    def _backup_records(self, records, backup_directory):
-        for table_name, table_records in records.items():
-            backup_directory = os.path.join(
-                backup_directory,
-                f'{datetime.now().strftime("%Y-%m-%d_%H%M%S")}',
-                f"{table_name}.xlsx")
-            pathlib.Path(backup_directory).mkdir(parents=True, exist_ok=True)
-            backup_path = os.path.join(backup_directory, f"{table_name}.xlsx")
-            table_records.to_excel(backup_path)
-            self.logger.info(
-                f"Backed up {table_records.shape[0]} rows for {table_name} to {backup_path}.")
+    def _queued_fields(self) -> Dict[str, List[str]]:
+        return {
+            table_name: [
+                field for field in dict.fromkeys(key for obj in updates for key in obj)
+                if field != "sys_id"]
+            for table_name, updates in self.queued_updates.items()}
 
     def queue_updates_dataframe(self, table_name: str, df: pd.DataFrame):
         """
@@ -227,34 +653,87 @@ class TableAPIUpdateClient:
             self.queued_updates[table_name] = []
         self.queued_updates[table_name].append(obj)
 
-    def _exec_updates_nocheck(self, update_ops: List[Dict]):
-        for update_op in update_ops:
-            self.endpoint.put(update_op["resource"], update_op["obj"])
-
-    def exec_updates(self, backup_directory, dry_run=True):
-        original_records = self._get_original_records_for_queued_updates()
-        self._backup_records(original_records, backup_directory)
-        update_ops = []
+    def _exec_updates_nocheck(self, update_ops: List[Dict], max_workers: int = 8,
+                              rate_per_second: Optional[float] = 10.0, max_retries: int = 3,
+                              journal_path: str = None, batch_size: int = 1) -> pd.DataFrame:
+        executor = BulkUpdateExecutor(
+            self.endpoint,
+            max_workers=max_workers,
+            rate_per_second=rate_per_second,
+            max_retries=max_retries,
+            journal_path=journal_path,
+            batch_size=batch_size)
+        return executor.run(update_ops)
+
+    def diff_queued_updates(
+            self, original_records: Dict[str, pd.DataFrame] = None) -> pd.DataFrame:
+        """
+        Returns one row per field the queued updates change, with the table, sys_id, field,
+        old_value and new_value, see diff_updates. Looks up the original records if they aren't
+        passed in, and compares against their raw values, so old_value is the stored value
+        rather than the display value.
+        """
+        if original_records is None:
+            original_records = self._get_original_records_for_queued_updates()
+        changes = [
+            diff_updates(table_name, updates, original_records[table_name])
+            for table_name, updates in self.queued_updates.items()]
+        if len(changes) == 0:
+            return pd.DataFrame(columns=CHANGE_COLUMNS)
+        return pd.concat(changes).reset_index(drop=True)
+
+    def exec_updates(self, backup_directory, dry_run=True, max_workers: int = 8,
+                     rate_per_second: Optional[float] = 10.0, max_retries: int = 3,
+                     journal_path: str = None, backup_format: str = "jsonl.gz",
+                     batch_size: int = 1):
+        """
+        Backs up the records the queued updates touch, shows what would change, and after
+        confirmation runs the updates.
+
+        The backup is written to a new timestamped directory in backup_directory, see
+        BackupWriter, and can be put back with restore_backup.
+
+        The updates are sent by max_workers threads, at most rate_per_second per second, each
+        retried up to max_retries times. If journal_path is set, the outcome of each update is
+        logged to it, and running the same updates again with the same journal_path only sends
+        the ones that haven't succeeded yet. With batch_size more than 1, batch_size updates are
+        sent in each request to the batch API. Returns a DataFrame with the outcome for each sys_id,
+        see BulkUpdateExecutor.run. Updates that wouldn't change anything are not sent, and have
+        the status "unchanged".
+        """
+        with BackupWriter(
+                backup_directory, backup_format, updated_fields=self._queued_fields()) as backup:
+            original_records = self._get_original_records_for_queued_updates(backup=backup)
+        changes = self.diff_queued_updates(original_records)
+        changed = set(zip(changes["table"], changes["sys_id"]))
+        update_ops: List[Dict] = []
+        unchanged: List[Dict] = []
         for table_name, updates in self.queued_updates.items():
             for obj in updates:
                 update_query = UpdateQueryBuilder(
                     table=table_name,
                     sys_id=obj['sys_id'])
-                update_ops.append({
+                update_op = {
+                    "table": table_name,
                     "resource": str(update_query),
                     "obj": obj,
-                })
-
-        for update_op in update_ops:
-            obj = update_op['obj']
-            old_record = original_records[table_name].loc[
-                original_records[table_name]['sys_id'] == obj['sys_id']]
-            assert old_record.shape[0] == 1, (
-                f"Expected one row for this sys_id, found {old_record.shape[1]}")
-            print(f'{update_op["resource"]}')
-            for key in obj.keys():
-                if obj[key] != old_record.iloc[0][key]:
-                    print(f'\t- {key}: "{old_record.iloc[0][key]}" -> "{obj[key]}"')
+                }
+                if (table_name, obj['sys_id']) in changed:
+                    update_ops.append(update_op)
+                else:
+                    unchanged.append(update_op)
+
+        resources = {
+            (update_op["table"], update_op["obj"]["sys_id"]): update_op["resource"]
+            for update_op in update_ops}
+        last_record = None
+        for change in changes.itertuples(index=False):
+            if (change.table, change.sys_id) != last_record:
+                last_record = (change.table, change.sys_id)
+                print(resources[last_record])
+            print(f'\t- {change.field}: "{change.old_value}" -> "{change.new_value}"')
+        if unchanged:
+            print(f"Skipping {len(unchanged)} updates that don't change anything")
         if dry_run:
             print("dry_run=True in exec_updates function, will only print what would be updated")
         utils.query_yes_no("Does this update look correct?")
@@ -262,7 +741,43 @@ class TableAPIUpdateClient:
             print("dry_run=True in exec_updates function, not executing. Update payload:")
             print(json.dumps(update_ops, indent=4, sort_keys=True))
         else:
-            return self._exec_updates_nocheck(update_ops)
+            report = self._exec_updates_nocheck(
+                update_ops,
+                max_workers=max_workers,
+                rate_per_second=rate_per_second,
+                max_retries=max_retries,
+                journal_path=journal_path,
+                batch_size=batch_size)
+            unchanged_report = pd.DataFrame([
+                {
+                    "table": update_op["table"],
+                    "sys_id": update_op["obj"]["sys_id"],
+                    "resource": update_op["resource"],
+                    "status": "unchanged",
+                    "attempts": 0,
+                    "error": None,
+                }
+                for update_op in unchanged], columns=REPORT_COLUMNS)
+            return pd.concat([report, unchanged_report]).reset_index(drop=True)
+
+    def restore_backup(self, backup_path: str, backup_directory: str, dry_run=True, **kwargs):
+        """
+        Puts the fields that were updated back to their values in a backup written by
+        exec_updates, where backup_path is the timestamped directory with the manifest.
+
+        This queues the restore as updates and runs them with exec_updates, so the current
+        records are backed up to backup_directory first, and records that were never changed
+        are skipped. Other keyword arguments are passed on to exec_updates.
+        """
+        (manifest, records) = read_backup(backup_path)
+        for table_name, table_manifest in manifest["tables"].items():
+            fields = [
+                field for field in table_manifest["updated_fields"]
+                if field in records[table_name].columns]
+            if not fields:
+                continue
+            self.queue_updates_dataframe(table_name, records[table_name][["sys_id"] + fields])
+        return self.exec_updates(backup_directory, dry_run=dry_run, **kwargs)
 
 
 class DescsribeAPIClient:
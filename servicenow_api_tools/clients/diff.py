@@ -0,0 +1,49 @@
+from typing import Dict, List
+import numpy as np
+import pandas as pd
+
+CHANGE_COLUMNS = ["table", "sys_id", "field", "old_value", "new_value"]
+
+
+def diff_updates(table: str, updates: List[Dict], originals: pd.DataFrame) -> pd.DataFrame:
+    """
+    Compares updates, dicts with a sys_id and the fields to set, with the original records indexed
+    by sys_id. The originals need the raw values of each field, like the updates have, and not the
+    display values.
+
+    Returns one row per field an update actually changes, in the order of the updates. Fields an
+    update doesn't set, and fields it sets to the value they already have, are left out, so
+    updates that don't change anything have no rows at all. A field the original records don't
+    have counts as changed.
+    """
+    if len(updates) == 0:
+        return pd.DataFrame(columns=CHANGE_COLUMNS)
+    new = pd.DataFrame.from_records(updates)
+    # Tell fields an update doesn't set apart from fields it sets to None.
+    present = pd.DataFrame.from_records(
+        [dict.fromkeys(update, True) for update in updates], columns=new.columns).notna()
+    sys_ids = new["sys_id"].to_numpy()
+    old = originals.reindex(sys_ids)
+    positions = np.arange(len(new))
+    changes = []
+    for field in new.columns:
+        if field == "sys_id":
+            continue
+        new_values = new[field].values.astype(object)
+        if field in old.columns:
+            old_values = old[field].values.astype(object)
+        else:
+            old_values = np.full(len(new), None, dtype=object)
+        changed = present[field].values & (old_values != new_values)
+        changes.append(pd.DataFrame({
+            "position": positions[changed],
+            "table": table,
+            "sys_id": sys_ids[changed],
+            "field": field,
+            "old_value": old_values[changed],
+            "new_value": new_values[changed],
+        }))
+    if len(changes) == 0:
+        return pd.DataFrame(columns=CHANGE_COLUMNS)
+    return pd.concat(changes).sort_values(
+        "position", kind="mergesort")[CHANGE_COLUMNS].reset_index(drop=True)
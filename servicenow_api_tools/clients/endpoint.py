@@ -1,21 +1,33 @@
 from servicenow_api_tools.clients import utils, runner
+from servicenow_api_tools.clients.querybuilder import BatchQueryBuilder
+import asyncio
 import urllib.request
 import urllib3  # type: ignore
-from typing import Dict
+from typing import Any, Dict, Optional
+
+try:
+    import aiohttp  # type: ignore
+except ImportError:
+    # Only needed for AsyncServicenowRestEndpoint.
+    aiohttp = None  # type: ignore
+
+
+def _get_base_url(base_url: Optional[str], instance: Optional[str]) -> str:
+    if instance:
+        assert not base_url, "Cannot set both instance and base_url"
+        return f'https://{instance}.servicenowservices.com'
+    elif base_url:
+        assert not instance, "Cannot set both instance and base_url"
+        return base_url
+    else:
+        raise Exception("Must set either instance or base_url")
 
 
 class ServicenowRestEndpoint:
     def __init__(self, base_url: str = None, instance: str = None,
                  username: str = None, password: str = None,
                  credentials_from_env: bool = True, max_connections: int = 10):
-        if instance:
-            assert not base_url, "Cannot set both instance and base_url"
-            self.base_url = f'https://{instance}.servicenowservices.com'
-        elif base_url:
-            assert not instance, "Cannot set both instance and base_url"
-            self.base_url = base_url
-        else:
-            raise Exception("Must set either instance or base_url")
+        self.base_url = _get_base_url(base_url, instance)
         (self.username, self.password) = utils.load_credentials(
             username, password, credentials_from_env)
         self.proxies = urllib.request.getproxies()
@@ -43,3 +55,71 @@ class ServicenowRestEndpoint:
         return runner.make_request(
             self.http_client, self.username, self.password,
             "POST", full_url, obj)
+
+    def batch(self, batch_query: BatchQueryBuilder) -> Dict[str, Dict]:
+        """
+        Sends all the requests in batch_query as one request to the batch API, and returns the
+        response to each by request id, see BatchQueryBuilder.decode_response.
+        """
+        return batch_query.decode_response(self.post(str(batch_query), batch_query.body()))
+
+
+class AsyncServicenowRestEndpoint:
+    """
+    asyncio version of ServicenowRestEndpoint, using aiohttp.
+
+    At most max_concurrency requests are in flight at once, the rest wait on a semaphore. Use it
+    as an async context manager, or call close when done, to close the underlying session.
+    """
+    def __init__(self, base_url: str = None, instance: str = None,
+                 username: str = None, password: str = None,
+                 credentials_from_env: bool = True, max_concurrency: int = 100):
+        if aiohttp is None:
+            raise Exception(
+                "AsyncServicenowRestEndpoint requires aiohttp, install it with "
+                "\"pip install aiohttp\"")
+        self.base_url = _get_base_url(base_url, instance)
+        (self.username, self.password) = utils.load_credentials(
+            username, password, credentials_from_env)
+        self.max_concurrency = max_concurrency
+        # These have to be created inside the running event loop, so they are created on first use.
+        self._session: Any = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    async def _request(self, method: str, resource: str, obj: Dict = None):
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_concurrency),
+                # Picks up the same proxy environment variables as urllib.request.getproxies.
+                trust_env=True)
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        assert self._semaphore is not None
+        full_url = f'{self.base_url}{resource}'
+        async with self._semaphore:
+            return await runner.make_async_request(
+                self._session, self.username, self.password,
+                method, full_url, obj)
+
+    async def get(self, resource: str):
+        return await self._request("GET", resource)
+
+    async def put(self, resource: str, obj: Dict):
+        return await self._request("PUT", resource, obj)
+
+    async def post(self, resource: str, obj: Dict):
+        return await self._request("POST", resource, obj)
+
+    async def batch(self, batch_query: BatchQueryBuilder) -> Dict[str, Dict]:
+        return batch_query.decode_response(await self.post(str(batch_query), batch_query.body()))
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+            self._semaphore = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
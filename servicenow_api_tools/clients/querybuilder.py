@@ -1,4 +1,6 @@
-from typing import List
+from typing import Dict, List, Optional
+import base64
+import json
 
 
 class AggregateQueryBuilder:
@@ -75,3 +77,64 @@ class UpdateQueryBuilder:
 
     def __str__(self):
         return self.query
+
+
+class BatchQueryBuilder:
+    """
+    Packs requests to other REST APIs into one request to the batch API.
+
+    https://developer.servicenow.com/dev.do#!/reference/api/rome/rest/batch-api
+    """
+    def __init__(self, batch_request_id: str = "1"):
+        self.query = '/api/now/v1/batch'
+        self.batch_request_id = batch_request_id
+        self.rest_requests: List[Dict] = []
+
+    def add_request(self, method: str, url: str, obj: Dict = None,
+                    request_id: str = None) -> str:
+        """Adds a request for url, a resource like the other builders build. Returns its id."""
+        if request_id is None:
+            request_id = str(len(self.rest_requests) + 1)
+        rest_request = {
+            "id": request_id,
+            "method": method,
+            "url": url,
+            "headers": [
+                {"name": "Content-Type", "value": "application/json"},
+                {"name": "Accept", "value": "application/json"},
+            ],
+            "exclude_response_headers": True,
+        }
+        if obj is not None:
+            rest_request["body"] = base64.b64encode(json.dumps(obj).encode('utf-8')).decode('ascii')
+        self.rest_requests.append(rest_request)
+        return request_id
+
+    def body(self) -> Dict:
+        return {"batch_request_id": self.batch_request_id, "rest_requests": self.rest_requests}
+
+    def decode_response(self, response: Dict) -> Dict[str, Dict]:
+        """
+        Returns {"status_code": ..., "body": ...} for each request id, with the decoded JSON body of
+        its response.
+
+        Requests the instance didn't get to are in unserviced_requests, they get None for both.
+        """
+        if "error" in response:
+            raise Exception(f"Failed running batch {self.batch_request_id}: {response}")
+        results: Dict[str, Dict] = {}
+        for serviced in response.get("serviced_requests", []):
+            body: Optional[Dict] = None
+            if serviced.get("body"):
+                body = json.loads(base64.b64decode(serviced["body"]))
+            results[serviced["id"]] = {"status_code": serviced["status_code"], "body": body}
+        for unserviced in response.get("unserviced_requests", []):
+            request_id = unserviced["id"] if isinstance(unserviced, dict) else unserviced
+            results[request_id] = {"status_code": None, "body": None}
+        return results
+
+    def __len__(self):
+        return len(self.rest_requests)
+
+    def __str__(self):
+        return self.query
@@ -1,14 +1,29 @@
 from urllib3.util import Retry, make_headers  # type: ignore
+import asyncio
 import json
 
+# Use a faster JSON decoder if one is installed, they all accept the raw response bytes.
+try:
+    from orjson import loads as json_loads  # type: ignore
+except ImportError:
+    try:
+        from ujson import loads as json_loads  # type: ignore
+    except ImportError:
+        from json import loads as json_loads  # type: ignore
 
-def make_request(http_client, username: str, password: str, method: str, url: str, obj=None):
+
+def _make_headers(username: str, password: str, method: str, obj=None):
     headers = make_headers(basic_auth=f"{username}:{password}")
     headers["Accept"] = "application/json"
     headers["Content-Type"] = "application/json"
 
     if (method == "POST" or method == "PUT") and obj is None:
         raise ValueError(f"An obj must be provided for {method} requests")
+    return headers
+
+
+def make_request(http_client, username: str, password: str, method: str, url: str, obj=None):
+    headers = _make_headers(username, password, method, obj)
 
     if obj:
         response = http_client.request(
@@ -25,4 +40,27 @@ def make_request(http_client, username: str, password: str, method: str, url: st
             headers=headers,
             retries=Retry(total=6, backoff_factor=0.2),
         )
-    return json.loads(response.data.decode("utf-8"))
+    # No need to decode to a str first, the decoders all handle UTF-8 bytes.
+    return json_loads(response.data)
+
+
+async def make_async_request(session, username: str, password: str, method: str, url: str,
+                             obj=None, retries: int = 6, backoff_factor: float = 0.2):
+    """
+    Same as make_request, but with an aiohttp.ClientSession.
+
+    Like the urllib3 Retry in make_request, this only retries connection errors, with exponential
+    backoff.
+    """
+    import aiohttp  # type: ignore
+
+    headers = _make_headers(username, password, method, obj)
+    body = json.dumps(obj) if obj else None
+    for attempt in range(retries + 1):
+        try:
+            async with session.request(method, url, headers=headers, data=body) as response:
+                return json_loads(await response.read())
+        except aiohttp.ClientConnectionError:
+            if attempt == retries:
+                raise
+            await asyncio.sleep(backoff_factor * (2 ** attempt))
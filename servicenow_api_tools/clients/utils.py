@@ -1,6 +1,9 @@
+from itertools import repeat
+from operator import itemgetter
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
 import os
-from typing import Tuple
 import sys
+import threading
 import pandas as pd
 
 
@@ -33,31 +36,172 @@ def get_display_value(series):
     return output
 
 
-def unpack_link_fields(input_df: pd.DataFrame) -> pd.DataFrame:
+def get_link_field_value(cell):
+    """
+    Returns the raw value of a cell, whether or not it is still a value/display_value dictionary.
+    """
+    return cell["value"] if isinstance(cell, dict) else cell
+
+
+def latest_datetime(values: Iterable, latest: Optional[str] = None) -> Optional[str]:
+    """
+    Returns the latest of latest and the raw date/time values ("2021-01-19 20:00:00"), compared
+    as date/times rather than as strings. The value is returned as it was passed in, so it can go
+    back into a query. Empty values, and values that aren't date/times, are left out.
+    """
+    candidates = pd.Series(list(values) + ([latest] if latest is not None else []), dtype=object)
+    times = pd.to_datetime(candidates, errors="coerce")
+    if times.notna().sum() == 0:
+        return latest
+    return candidates[times.idxmax()]
+
+
+_get_value = itemgetter("value")
+_get_display_value = itemgetter("display_value")
+
+
+def _unpack_cells(column: str, cells: Sequence, link_fields: Optional[List[str]],
+                  columns: Dict[str, List], display_value_columns: Dict[str, List]):
+    try:
+        # Fast path for when every cell is a value/display_value dictionary, which is what the API
+        # returns unless the field is missing from some records.
+        display_values = list(map(_get_display_value, cells))
+        all_dicts = True
+    except TypeError:
+        display_values = [x["display_value"] if isinstance(x, dict) else "" for x in cells]
+        all_dicts = False
+    if link_fields is not None:
+        is_link = column in link_fields
+    elif all_dicts:
+        is_link = any(map(dict.__contains__, cells, repeat("link")))
+    else:
+        is_link = any(isinstance(x, dict) and "link" in x for x in cells)
+    if is_link:
+        if all_dicts:
+            columns[column] = list(map(_get_value, cells))
+        else:
+            columns[column] = [x["value"] if isinstance(x, dict) else "" for x in cells]
+        display_value_columns[column + "_display_value"] = display_values
+    else:
+        columns[column] = display_values
+
+
+def unpack_link_fields(input_df: pd.DataFrame, link_fields: List[str] = None) -> pd.DataFrame:
     """
     Find columns that have 'link' in their value, indicating that it is linked Might be more robust
     than hardcoding in json, as this will update if any new fields are linked
 
+    Link columns get the value under their own name and the display value under
+    "{column}_display_value", every other column gets the display value. If link_fields is passed
+    (for example from the fields catalog), those are the link columns and no detection is done.
+
     NOTE: This assumes we are passing these to the API:
 
         sysparm_display_value=all
         sysparm_exclude_reference_link=False
 
     """
-    temp = input_df.applymap(
-        lambda x: "link" in x.keys() if isinstance(x, dict) else False
-    )
-    link_cols = temp.columns[temp.apply(count_trues) > 0].to_list()
-
+    columns: Dict[str, List] = {}
+    display_value_columns: Dict[str, List] = {}
     for col in input_df.columns:
-        if col in link_cols:
-            input_df["_" + col] = get_hash_value(input_df[col])
-            input_df[col + "_display_value"] = get_display_value(input_df[col])
-            input_df[col] = input_df["_" + col]
-            input_df = input_df.drop(columns=["_" + col])
-        else:
-            input_df[col] = get_display_value(input_df[col])
-    return input_df
+        # Plain lists are much faster to walk than Series.apply or applymap.
+        _unpack_cells(col, input_df[col].tolist(), link_fields, columns, display_value_columns)
+    columns.update(display_value_columns)
+    return pd.DataFrame(columns, index=input_df.index)
+
+
+def detect_link_fields(records: List[Dict]) -> List[str]:
+    """Returns the fields that have a link in any of the records."""
+    link_fields: Dict[str, None] = {}
+    for record in records:
+        for field, cell in record.items():
+            if isinstance(cell, dict) and "link" in cell:
+                link_fields[field] = None
+    return list(link_fields)
+
+
+class LinkFields:
+    """
+    The link fields of a query that is pulled in several batches. They are detected in the first
+    batch that has records, and the other batches are unpacked with the same ones instead of
+    looking through every cell again.
+
+    NOTE: A reference field that is empty in every record of the first batch has no links to
+    detect, so in the other batches it only gets its display value, like any other field.
+    """
+    def __init__(self):
+        self.fields: Optional[List[str]] = None
+        self._lock = threading.Lock()
+
+    def unpack(self, results: Dict[str, List[Dict]]) -> pd.DataFrame:
+        """Same as api_results_to_unpacked_dataframe, with the link fields of the query."""
+        if self.fields is None and len(results["result"]) > 0:
+            # Batches arrive on several threads, only the first one has to look.
+            with self._lock:
+                if self.fields is None:
+                    self.fields = detect_link_fields(results["result"])
+        return api_results_to_unpacked_dataframe(results, self.fields)
+
+
+def link_field_values(input_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Replaces every value/display_value dictionary with its raw value, so each column has what the
+    instance stores rather than what it shows the user, which can be formatted for their locale
+    and timezone, or be the label of a choice.
+    """
+    return pd.DataFrame(
+        {col: [get_link_field_value(x) for x in input_df[col].tolist()]
+         for col in input_df.columns},
+        index=input_df.index, columns=input_df.columns)
+
+
+def api_results_to_unpacked_dataframe(
+        results: Dict[str, List[Dict]], link_fields: List[str] = None) -> pd.DataFrame:
+    """
+    Same as unpack_link_fields(api_results_to_dataframe(results)), but builds the columns straight
+    from the records instead of going through a DataFrame of dictionaries first.
+    """
+    records = results["result"]
+    if len(records) == 0:
+        return pd.DataFrame()
+    fields = list(records[0])
+    if all(list(record) == fields for record in records):
+        # Every record has the same fields in the same order, so transpose them in one pass.
+        field_cells: Iterable[Tuple[str, Sequence]] = zip(
+            fields, zip(*[record.values() for record in records]))
+    else:
+        records_df = pd.DataFrame(records, dtype="object")
+        field_cells = ((field, records_df[field].tolist()) for field in records_df.columns)
+    columns: Dict[str, List] = {}
+    display_value_columns: Dict[str, List] = {}
+    for field, cells in field_cells:
+        _unpack_cells(field, cells, link_fields, columns, display_value_columns)
+    columns.update(display_value_columns)
+    return pd.DataFrame(columns)
+
+
+def split_offsets(batch_size: int, max_rows: int) -> List[Tuple[int, int]]:
+    """Splits max_rows rows into (offset, limit) batches of at most batch_size rows."""
+    batch_offsets = []
+    for offset in range(0, max_rows, batch_size):
+        batch_offsets.append((offset, min(offset + batch_size, max_rows) - offset))
+    return batch_offsets
+
+
+def check_unpack_link_fields(display_value: Optional[str], unpack_link_fields: bool):
+    if unpack_link_fields:
+        assert display_value is None, (
+            "Passing display_value is currently not supported with unpack_link_fields. "
+            "The unpack_link_fields option sets {field_value} under \"{field_name}\" "
+            "and {field_display_value} under \"{field_name}_display_value\" in the dataframe.")
+
+
+def check_record_count(received: int, number_of_records: int):
+    assert ((received < number_of_records + 100)
+            and (received > number_of_records - 100)), (
+        "Expected count and received off by more than 100.  "
+        "This could either be a bug or because a lot changed while the query was running.  "
+        f"Actual: {received}, Initial Count: {number_of_records}")
 
 
 def load_credentials(username: str = None, password: str = None,
@@ -1,6 +1,6 @@
 from .introspection import (
     get_mappings_for_table, introspect_api_for_schema,
-    id_to_name, name_to_id)
+    id_to_name, name_to_id, MappingIndex)
 
 # https://stackoverflow.com/questions/31079047/python-pep8-class-in-init-imported-but-not-used
 __all__ = [
@@ -8,4 +8,5 @@ __all__ = [
     'introspect_api_for_schema',
     'id_to_name',
     'name_to_id',
+    'MappingIndex',
 ]
@@ -1,4 +1,6 @@
-from typing import Dict, List, Union
+from typing import Dict, Iterable, List, Optional, Union
+from servicenow_api_tools import operators
+from servicenow_api_tools.clients import utils
 from servicenow_api_tools.clients.endpoint import ServicenowRestEndpoint
 from servicenow_api_tools.clients.clients import AggregateAPIClient, TableAPIClient
 from servicenow_api_tools.schema.schema import load_fields_catalog
@@ -137,10 +139,7 @@ def introspect_api_for_schema(
     return schemas
 
 
-def get_mappings_for_table(
-        table: str,
-        endpoint: ServicenowRestEndpoint,
-        schemas_dir: str) -> Dict:
+def _get_table_display_value_field(table: str, schemas_dir: str) -> str:
     catalog = load_fields_catalog(table, schemas_dir)
     display_value_fields = []
     for field, field_info in catalog.items():
@@ -148,15 +147,96 @@ def get_mappings_for_table(
             display_value_fields.append(field)
     assert len(display_value_fields) == 1, (
         f"Table must have exactly one display value, found: {display_value_fields}")
+    return display_value_fields[0]
+
+
+class MappingIndex:
+    """
+    Mapping between the sys_ids of a table and their display values, pulled once and kept in memory.
+
+    Lookups in both directions are dict lookups, so translating many ids or names costs one pull
+    of the table instead of one per lookup. Call refresh() to pull only the rows with
+    watermark_field at or after the latest raw date/time value seen so far.
+
+    If several records have the same display value, name lookups return the first one pulled.
+    """
+    def __init__(self, table: str, endpoint: ServicenowRestEndpoint, schemas_dir: str,
+                 watermark_field: str = "sys_updated_on"):
+        self.table = table
+        self.display_value_field = _get_table_display_value_field(table, schemas_dir)
+        self.watermark_field = watermark_field
+        self.table_client = TableAPIClient(endpoint=endpoint)
+        self._watermark: Optional[str] = None
+        self._id_to_name: Dict[str, str] = {}
+        self._name_to_id: Dict[str, str] = {}
+        self.refresh()
+
+    def refresh(self) -> int:
+        """Pulls new and updated rows into the index, and returns how many there were."""
+        fields = ["sys_id", self.display_value_field]
+        if self.watermark_field not in fields:
+            fields.append(self.watermark_field)
+        query = None
+        if self._watermark is not None:
+            query = operators.GREATER_THAN_OR_EQUAL(self.watermark_field, self._watermark)
+        rows = self.table_client.query(
+            table=self.table, query=query, fields=fields, unpack_link_fields=False)
+        if len(rows) == 0:
+            return 0
+        # Unpacking keeps only the display value of fields that aren't links, and the watermark
+        # has to be the raw value to work in the next query.
+        watermarks = rows[self.watermark_field].map(utils.get_link_field_value)
+        rows = utils.unpack_link_fields(rows)
+
+        renamed = False
+        for (sys_id, name) in zip(rows["sys_id"], rows[self.display_value_field]):
+            if sys_id in self._id_to_name and self._id_to_name[sys_id] != name:
+                renamed = True
+            self._id_to_name[sys_id] = name
+        if renamed:
+            # The old name might still belong to another record, so rebuild from scratch rather
+            # than just dropping it.
+            self._name_to_id = {}
+        for (sys_id, name) in self._id_to_name.items():
+            self._name_to_id.setdefault(name, sys_id)
+
+        self._watermark = utils.latest_datetime(watermarks, self._watermark)
+        logger.debug(f"Loaded {len(rows)} {self.table} mappings, watermark {self._watermark}")
+        return len(rows)
+
+    def id_to_name(self, id: str) -> str:
+        return self._id_to_name[id]
+
+    def name_to_id(self, name: str) -> str:
+        if name not in self._name_to_id:
+            raise Exception(f"Could not map {name} to sys_id")
+        return self._name_to_id[name]
+
+    def ids_to_names(self, ids: Iterable[str]) -> Dict[str, str]:
+        return {id: self.id_to_name(id) for id in ids}
+
+    def names_to_ids(self, names: Iterable[str]) -> Dict[str, str]:
+        names = list(names)
+        missing = [name for name in names if name not in self._name_to_id]
+        if missing:
+            raise Exception(f"Could not map {missing} to sys_id")
+        return {name: self._name_to_id[name] for name in names}
+
+    def mappings(self) -> Dict[str, str]:
+        """Returns a copy of the sys_id to display value mapping."""
+        return dict(self._id_to_name)
+
+
+def get_mappings_for_table(
+        table: str,
+        endpoint: ServicenowRestEndpoint,
+        schemas_dir: str) -> Dict:
+    display_value_field = _get_table_display_value_field(table, schemas_dir)
     tc = TableAPIClient(endpoint=endpoint)
     rows = tc.query(
         table=table,
-        fields=["sys_id", display_value_fields[0]])
-    result = {}
-    for row in rows.to_dict('records'):
-        assert type(row) is dict
-        result[row['sys_id']] = row[display_value_fields[0]]
-    return result
+        fields=["sys_id", display_value_field])
+    return dict(zip(rows['sys_id'], rows[display_value_field]))
 
 
 def get_updated_fields_catalog(catalog_directory: str, *args, **kwargs) -> Dict[str, Dict]:
@@ -172,6 +252,7 @@ def name_to_id(
         endpoint: ServicenowRestEndpoint,
         schemas_dir: str,
         name: str) -> str:
+    """Pulls the whole table, so use a MappingIndex when translating more than one name."""
     mappings = get_mappings_for_table(table, endpoint, schemas_dir)
     for sys_id, found_display_name in mappings.items():
         if name == found_display_name:
@@ -184,5 +265,6 @@ def id_to_name(
         endpoint: ServicenowRestEndpoint,
         schemas_dir: str,
         id: str) -> str:
+    """Pulls the whole table, so use a MappingIndex when translating more than one id."""
     mappings = get_mappings_for_table(table, endpoint, schemas_dir)
     return mappings[id]
@@ -1,6 +1,7 @@
-from .endpoint import ServicenowRestEndpointLocalDataset
+from .endpoint import AsyncServicenowRestEndpointLocalDataset, ServicenowRestEndpointLocalDataset
 
 # https://stackoverflow.com/questions/31079047/python-pep8-class-in-init-imported-but-not-used
 __all__ = [
     'ServicenowRestEndpointLocalDataset',
+    'AsyncServicenowRestEndpointLocalDataset',
 ]
@@ -0,0 +1,168 @@
+"""
+Reading and writing the tables of a local dataset.
+
+A table is stored either as "<table>.json", in the format returned by the table API with
+sysparm_display_value=all, or as a "<table>.columns" directory with one NumPy array per field for
+the values, one for the display values, and one for the links of fields that have them. The
+arrays are memory mapped when loaded, so only the columns a query touches are read from disk.
+String columns whose lengths vary too much to store fixed width, like free text, are pickled
+and read in full instead.
+"""
+from dataclasses import dataclass
+from operator import itemgetter
+from typing import Dict, List, Optional, Tuple
+import json
+import numpy as np
+import os
+import pathlib
+from servicenow_api_tools.clients.runner import json_loads
+from servicenow_api_tools.utils import remove_suffix
+
+JSON_SUFFIX = ".json"
+COLUMNAR_SUFFIX = ".columns"
+# String columns are stored fixed width unless that takes more than this many times the space of
+# the strings themselves.
+MAX_PADDING_RATIO = 2
+
+_get_value = itemgetter('value')
+_get_display_value = itemgetter('display_value')
+
+
+@dataclass
+class DatasetTable:
+    """
+    The columns of a table. Links only has the fields that have links, with an empty string for
+    rows that don't.
+    """
+    values: Dict[str, np.ndarray]
+    display_values: Dict[str, np.ndarray]
+    links: Dict[str, np.ndarray]
+
+
+def _unpack_cells(column: str, cells: List,
+                  validate: bool) -> Tuple[List, List, Optional[List]]:
+    try:
+        values = list(map(_get_value, cells))
+        display_values = list(map(_get_display_value, cells))
+    except (KeyError, TypeError):
+        if validate:
+            raise Exception(
+                f"Column: {column} has malformed values!\n"
+                "Required to be objects with 'value' and 'display_value' keys!")
+        cells = [cell if isinstance(cell, dict) else {} for cell in cells]
+        values = [cell.get('value', "") for cell in cells]
+        display_values = [cell.get('display_value', "") for cell in cells]
+    links = None
+    if any('link' in cell for cell in cells):
+        links = [cell.get('link', "") for cell in cells]
+    return (values, display_values, links)
+
+
+def api_results_to_dataset_table(results: Dict, validate: bool = True) -> DatasetTable:
+    """
+    Converts table API results with display_value=all to columns.
+
+    If validate is False, cells without a value or display_value are treated as empty instead of
+    raising.
+    """
+    records = results['result']
+    fields: Dict[str, None] = {}
+    for record in records:
+        fields.update(dict.fromkeys(record))
+    table = DatasetTable(values={}, display_values={}, links={})
+    for field in fields:
+        cells = [record.get(field) for record in records]
+        (values, display_values, links) = _unpack_cells(field, cells, validate)
+        table.values[field] = np.array(values, dtype=object)
+        table.display_values[field] = np.array(display_values, dtype=object)
+        if links is not None:
+            table.links[field] = np.array(links, dtype=object)
+    return table
+
+
+def read_json_table(path: str, validate: bool = True) -> DatasetTable:
+    with open(path, 'rb') as f:
+        return api_results_to_dataset_table(json_loads(f.read()), validate=validate)
+
+
+def take(column: np.ndarray, rows: np.ndarray) -> np.ndarray:
+    """Returns the given rows of a column, decoding strings stored as UTF-8."""
+    selected = column[rows]
+    if selected.dtype.kind == 'S':
+        return np.char.decode(selected, 'utf-8')
+    return selected
+
+
+def _to_storable(array: np.ndarray) -> np.ndarray:
+    # Strings (as UTF-8, which is much smaller than NumPy's fixed width unicode) and ints get fixed
+    # width arrays, which can be memory mapped. Anything else has to be pickled.
+    items = array.tolist()
+    if all(type(item) is str for item in items):
+        encoded = [item.encode('utf-8') for item in items]
+        lengths = [len(item) for item in encoded]
+        # Every cell is padded to the longest one, so a few long values in a free text column
+        # can make it bigger than the JSON. Those columns are pickled instead.
+        if len(encoded) * max(lengths, default=0) <= MAX_PADDING_RATIO * sum(lengths):
+            return np.array(encoded, dtype=bytes)
+        return np.array(items, dtype=object)
+    if all(type(item) is int for item in items):
+        return np.array(items, dtype=np.int64)
+    return np.array(items, dtype=object)
+
+
+def _load_array(path: str, mmap: bool) -> np.ndarray:
+    if mmap:
+        try:
+            return np.load(path, mmap_mode='r')
+        except ValueError:
+            # Arrays of Python objects can't be memory mapped.
+            pass
+    return np.load(path, allow_pickle=True)
+
+
+def write_columnar_table(path: str, table: DatasetTable):
+    pathlib.Path(path).mkdir(parents=True, exist_ok=True)
+    for field in table.values:
+        np.save(os.path.join(path, f"{field}.value.npy"), _to_storable(table.values[field]))
+        np.save(os.path.join(path, f"{field}.display_value.npy"),
+                _to_storable(table.display_values[field]))
+        if field in table.links:
+            np.save(os.path.join(path, f"{field}.link.npy"), _to_storable(table.links[field]))
+    with open(os.path.join(path, "fields.json"), 'w') as f:
+        f.write(json.dumps(
+            {"fields": list(table.values), "links": list(table.links)}, indent=4))
+
+
+def read_columnar_table(path: str, mmap: bool = True) -> DatasetTable:
+    with open(os.path.join(path, "fields.json"), 'r') as f:
+        fields = json.loads(f.read())
+    return DatasetTable(
+        values={
+            field: _load_array(os.path.join(path, f"{field}.value.npy"), mmap)
+            for field in fields["fields"]},
+        display_values={
+            field: _load_array(os.path.join(path, f"{field}.display_value.npy"), mmap)
+            for field in fields["fields"]},
+        links={
+            field: _load_array(os.path.join(path, f"{field}.link.npy"), mmap)
+            for field in fields["links"]})
+
+
+def table_name(file_name: str) -> Optional[str]:
+    """Returns the table stored in a file of a dataset directory, or None if it isn't one."""
+    for suffix in [JSON_SUFFIX, COLUMNAR_SUFFIX]:
+        if file_name.endswith(suffix):
+            return remove_suffix(file_name, suffix)
+    return None
+
+
+def write_dataset(dataset: Dict[str, Dict], directory: str, columnar: bool = False):
+    """Writes table API results with display_value=all for each table to a dataset directory."""
+    for table, results in dataset.items():
+        if columnar:
+            write_columnar_table(
+                os.path.join(directory, f"{table}{COLUMNAR_SUFFIX}"),
+                api_results_to_dataset_table(results))
+        else:
+            with open(os.path.join(directory, f"{table}{JSON_SUFFIX}"), 'w') as f:
+                f.write(json.dumps(results, indent=4, sort_keys=True))
@@ -1,13 +1,27 @@
-from typing import Dict
+from typing import Dict, List
+import base64
+import json
 import logging
+import servicenow_api_tools.mock_api_server.parsers as parsers
 import servicenow_api_tools.mock_api_server.query as query
-from servicenow_api_tools.clients import ServicenowRestEndpoint
+from servicenow_api_tools.clients import AsyncServicenowRestEndpoint, ServicenowRestEndpoint
+
+# The host the links in generated datasets point to.
+LOCAL_DATASET_BASE_URL = "https://localdataset.local"
 
 
 class ServicenowRestEndpointLocalDataset(ServicenowRestEndpoint):
-    def __init__(self, path: str, schema_dir: str):
+    def __init__(self, path: str, schema_dir: str, validate: bool = True, snapshot: bool = False,
+                 trigram_index_fields: Dict[str, List[str]] = None):
+        # Nothing is sent anywhere, but wrappers like CachingServicenowRestEndpoint expect the
+        # connection settings of an endpoint.
+        super().__init__(
+            base_url=LOCAL_DATASET_BASE_URL, username="local", password="local",
+            credentials_from_env=False)
         self.logger = logging.getLogger(__name__)
-        self.runner = query.LocalDatasetQueryRunner(path, schema_dir)
+        self.runner = query.LocalDatasetQueryRunner(
+            path, schema_dir, validate=validate, snapshot=snapshot,
+            trigram_index_fields=trigram_index_fields)
         self.path = path
 
     def get(self, url: str) -> Dict:
@@ -16,7 +30,63 @@ class ServicenowRestEndpointLocalDataset(ServicenowRestEndpoint):
         return self.runner.query(url)
 
     def put(self, url: str, obj: Dict) -> Dict:
-        raise Exception("PUT not yet implemented on local dataset rest endpoint")
+        """Updates a record of the dataset, in memory only, see LocalDatasetQueryRunner.update."""
+        (table, sys_id) = parsers.parse_record_url(url)
+        return self.runner.update(table, sys_id, obj)
 
     def post(self, url: str, obj: Dict) -> Dict:
+        if parsers.is_batch_url(url):
+            return self._batch(obj)
         raise Exception("POST not yet implemented on local dataset rest endpoint")
+
+    def _batch(self, batch_request: Dict) -> Dict:
+        """Runs each request of a batch API request in order, the way the instance does."""
+        serviced_requests = []
+        for rest_request in batch_request["rest_requests"]:
+            obj: Dict = (json.loads(base64.b64decode(rest_request["body"]))
+                         if rest_request.get("body") else {})
+            try:
+                if rest_request["method"] == "GET":
+                    result = self.get(rest_request["url"])
+                elif rest_request["method"] == "PUT":
+                    result = self.put(rest_request["url"], obj)
+                else:
+                    result = self.post(rest_request["url"], obj)
+                status_code = 404 if "error" in result else 200
+            except Exception as e:
+                self.logger.debug(f"Failed batch request {rest_request['id']}: {e}")
+                result = {"error": {"message": str(e)}, "status": "failure"}
+                status_code = 500
+            serviced_requests.append({
+                "id": rest_request["id"],
+                "status_code": status_code,
+                "body": base64.b64encode(json.dumps(result).encode('utf-8')).decode('ascii'),
+            })
+        return {
+            "batch_request_id": batch_request.get("batch_request_id"),
+            "serviced_requests": serviced_requests,
+            "unserviced_requests": [],
+        }
+
+
+class AsyncServicenowRestEndpointLocalDataset(AsyncServicenowRestEndpoint):
+    """
+    asyncio version of ServicenowRestEndpointLocalDataset, for testing the async clients.
+    """
+    def __init__(self, path: str, schema_dir: str, validate: bool = True, snapshot: bool = False,
+                 trigram_index_fields: Dict[str, List[str]] = None):
+        self.endpoint = ServicenowRestEndpointLocalDataset(
+            path, schema_dir, validate=validate, snapshot=snapshot,
+            trigram_index_fields=trigram_index_fields)
+
+    async def get(self, url: str) -> Dict:
+        return self.endpoint.get(url)
+
+    async def put(self, url: str, obj: Dict) -> Dict:
+        return self.endpoint.put(url, obj)
+
+    async def post(self, url: str, obj: Dict) -> Dict:
+        return self.endpoint.post(url, obj)
+
+    async def close(self):
+        pass
@@ -1,75 +1,125 @@
+from functools import lru_cache
 from lark import Lark, Tree
 import urllib.parse as parse
-from typing import Dict
+from typing import Dict, Tuple
 from servicenow_api_tools.utils import remove_prefix
 
 
+# NOTE: All the grammars are LALR(1). VALUE overlaps with most other terminals, which works because
+# LALR uses a contextual lexer that only tries the terminals the parser expects next.
+#
+# NOTE: The value for "is" is optional. "=" with nothing is a synonym for EMPTY.
+#
+# NOTE: "^" chains always nest to the left, an "or" has at least two matchers, and "^NQ" only
+# joins whole queries at the top, so a query has only one parse tree. "^OR" is a regex that
+# doesn't match the start of "^ORDERBY", which the lexer would otherwise split as "^OR" "DERBY".
+_QUERY_PARSER = Lark(r"""
+    matcher: empty
+           | not_empty
+           | contains
+           | not_contains
+           | is
+           | is_not
+           | date_between
+           | in
+           | greater_than
+           | greater_than_or_equal
+           | less_than
+           | less_than_or_equal
+           | order_by
+           | order_by_desc
+
+    query: matcher
+         | or
+         | and
+         | new_query
+
+    new_query: and_query ( "^NQ" and_query )+
+    and_query: matcher -> query
+             | or -> query
+             | and -> query
+    or: matcher ( _OR matcher )+
+    and: and_query "^" conjunct
+    conjunct: matcher -> query
+            | or -> query
+    empty: DOTTED_FIELD "ISEMPTY"
+    not_empty: DOTTED_FIELD "ISNOTEMPTY"
+    contains: DOTTED_FIELD "LIKE" VALUE
+    not_contains: DOTTED_FIELD "NOTLIKE" VALUE
+    is: DOTTED_FIELD "=" VALUE?
+    is_not: DOTTED_FIELD "!=" VALUE
+    date_between: DOTTED_FIELD "BETWEEN" VALUE "@" VALUE
+    in: DOTTED_FIELD "IN" NOCOMMA_VALUE ( "," NOCOMMA_VALUE )*
+    greater_than: DOTTED_FIELD ">" COMPARISON_VALUE
+    greater_than_or_equal: DOTTED_FIELD ">=" COMPARISON_VALUE
+    less_than: DOTTED_FIELD "<" COMPARISON_VALUE
+    less_than_or_equal: DOTTED_FIELD "<=" COMPARISON_VALUE
+    order_by: "ORDERBY" DOTTED_FIELD
+    order_by_desc: "ORDERBYDESC" DOTTED_FIELD
+
+    _OR: /\^OR(?!DERBY)/
+    DOTTED_FIELD: FIELD ( "." FIELD)*
+    FIELD: /[a-z_]+/
+    VALUE: /[^\^@]+/
+    COMPARISON_VALUE: /[^\^@=][^\^@]*/
+    NOCOMMA_VALUE: /[^\^@^,]+/""", start='query', parser='lalr')
+
+_FIELDS_PARSER = Lark(r"""
+    fields: DOTTED_FIELD ( "," DOTTED_FIELD )*
+    DOTTED_FIELD: FIELD ( "." FIELD)*
+    FIELD: /[a-z_]+/
+    """, start='fields', parser='lalr')
+
+# https://developer.servicenow.com/dev.do#!/reference/api/rome/rest/c_AggregateAPI
+_HAVING_PARSER = Lark(r"""
+    having: AGGREGATE "^" DOTTED_FIELD "^" OPERATOR "^" NUMBER
+    AGGREGATE: "count" | "sum" | "avg" | "min" | "max"
+    OPERATOR: ">=" | "<=" | "!=" | ">" | "<" | "="
+    NUMBER: /-?[0-9]+(\.[0-9]+)?/
+    DOTTED_FIELD: FIELD ( "." FIELD)*
+    FIELD: /[a-z_]+/
+    """, start='having', parser='lalr')
+
+_OFFSET_PARSER = Lark(r"""
+    offset: OFFSET
+    OFFSET: /[0-9]+/
+    """, start='offset', parser='lalr')
+
+_LIMIT_PARSER = Lark(r"""
+    limit: LIMIT
+    LIMIT: /[0-9]+/
+    """, start='limit', parser='lalr')
+
+
+@lru_cache(maxsize=1024)
 def parse_sysparm_query(query: str) -> Tree:
-    # NOTE: The value for "is" is optional. "=" with nothing is a synonym for EMPTY.
-    parser = Lark(r"""
-        matcher: empty
-               | not_empty
-               | contains
-               | not_contains
-               | is
-               | is_not
-               | date_between
-               | in
-
-        query: matcher
-             | or
-             | and
-
-        or: matcher ( "^OR" matcher )*
-        and: query ( "^" query )*
-        empty: DOTTED_FIELD "ISEMPTY"
-        not_empty: DOTTED_FIELD "ISNOTEMPTY"
-        contains: DOTTED_FIELD "LIKE" VALUE
-        not_contains: DOTTED_FIELD "NOTLIKE" VALUE
-        is: DOTTED_FIELD "=" VALUE?
-        is_not: DOTTED_FIELD "!=" VALUE
-        date_between: DOTTED_FIELD "BETWEEN" VALUE "@" VALUE
-        in: DOTTED_FIELD "IN" NOCOMMA_VALUE ( "," NOCOMMA_VALUE )*
-
-        DOTTED_FIELD: FIELD ( "." FIELD)*
-        FIELD: /[a-z_]+/
-        VALUE: /[^\^@]+/
-        NOCOMMA_VALUE: /[^\^@^,]+/""", start='query')
-    return parser.parse(query)
+    """
+    Parses a sysparm_query string. Results are cached, so the returned tree must not be modified.
+    """
+    return _QUERY_PARSER.parse(query)
 
 
+@lru_cache(maxsize=1024)
 def parse_sysparm_fields(fields: str) -> Tree:
-    parser = Lark(r"""
-        fields: DOTTED_FIELD ( "," DOTTED_FIELD )*
-        DOTTED_FIELD: FIELD ( "." FIELD)*
-        FIELD: /[a-z_]+/
-        """, start='fields')
-    return parser.parse(fields)
+    return _FIELDS_PARSER.parse(fields)
 
 
+@lru_cache(maxsize=1024)
 def parse_sysparm_group_by(fields: str) -> Tree:
-    parser = Lark(r"""
-        fields: DOTTED_FIELD ( "," DOTTED_FIELD )*
-        DOTTED_FIELD: FIELD ( "." FIELD)*
-        FIELD: /[a-z_]+/
-        """, start='fields')
-    return parser.parse(fields)
+    return _FIELDS_PARSER.parse(fields)
+
+
+@lru_cache(maxsize=1024)
+def parse_sysparm_having(having: str) -> Tree:
+    return _HAVING_PARSER.parse(having)
 
 
 def parse_sysparm_offset(offset: str) -> Tree:
-    parser = Lark(r"""
-        offset: OFFSET
-        OFFSET: /[0-9]+/
-        """, start='offset')
-    return parser.parse(offset)
+    return _OFFSET_PARSER.parse(offset)
 
 
 def parse_sysparm_limit(limit: str) -> Tree:
-    parser = Lark(r"""
-        limit: LIMIT
-        LIMIT: /[0-9]+/
-        """, start='limit')
-    return parser.parse(limit)
+    return _LIMIT_PARSER.parse(limit)
 
 
 def parse_stats_query_url(url: str) -> Dict:
@@ -87,6 +137,9 @@ def parse_stats_query_url(url: str) -> Dict:
         "query": (
             parse_sysparm_query(params['sysparm_query'][0]) if
             'sysparm_query' in params else None),
+        "having": (
+            parse_sysparm_having(params['sysparm_having'][0]) if
+            'sysparm_having' in params else None),
         "display_value": (
             params['sysparm_display_value'][0] if
             'sysparm_display_value' in params else None),
@@ -127,3 +180,16 @@ def parse_url(url: str) -> Dict:
         return parse_stats_query_url(url)
     else:
         raise Exception(f"Invalid path: {split.path}")
+
+
+def parse_record_url(url: str) -> Tuple[str, str]:
+    """Returns the table and sys_id of a /api/now/table/<table>/<sys_id> url."""
+    split = parse.urlsplit(url)
+    parts = remove_prefix(split.path, "/api/now/table/").split("/")
+    if not split.path.startswith("/api/now/table/") or len(parts) != 2 or not all(parts):
+        raise Exception(f"Invalid record path: {split.path}")
+    return (parts[0], parts[1])
+
+
+def is_batch_url(url: str) -> bool:
+    return parse.urlsplit(url).path.rstrip("/") == "/api/now/v1/batch"
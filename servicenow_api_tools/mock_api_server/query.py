@@ -1,218 +1,438 @@
+from collections import defaultdict
+from functools import reduce
 from lark import Tree, Token
-from typing import Dict, List
-import datetime
+from typing import Dict, List, Optional, Tuple
 import json
 import logging
+import numpy as np
+import operator
 import os
 import pandas as pd
+import pickle
+import threading
+import servicenow_api_tools.mock_api_server.dataset as dataset
 import servicenow_api_tools.mock_api_server.parsers as parsers
 from servicenow_api_tools.schema.schema import load_fields_catalog
-from servicenow_api_tools.utils import dataframe_to_api_results, api_results_to_dataframe
-from servicenow_api_tools.utils import remove_suffix
 
 logging.basicConfig()
 logger = logging.getLogger(__name__)
 
+SNAPSHOT_SUFFIX = ".snapshot"
+# Snapshots are written to "<table>.json.snapshot.<pid>.tmp" and then renamed.
+SNAPSHOT_TEMP_SUFFIX = ".tmp"
+
+_HAVING_OPERATORS = {
+    ">": operator.gt,
+    ">=": operator.ge,
+    "<": operator.lt,
+    "<=": operator.le,
+    "=": operator.eq,
+    "!=": operator.ne,
+}
+
+
+def _take_resolved(column: np.ndarray, rows: np.ndarray) -> np.ndarray:
+    """
+    Returns the given rows of a column, where rows come from LocalDatasetQueryRunner._resolve_rows
+    and are -1 for rows whose dotted field walks through an empty link. Those get an empty value,
+    like they do on a real instance.
+    """
+    values = dataset.take(column, np.maximum(rows, 0))
+    missing = rows < 0
+    if not missing.any():
+        return values
+    return np.where(missing, "", values.astype(object))
+
+
+def _trigrams(text: str) -> List[str]:
+    return list({text[i:i + 3] for i in range(len(text) - 2)})
+
+
+def _build_trigram_index(values: np.ndarray) -> Dict[str, np.ndarray]:
+    """Maps each lowercase trigram in a column to the sorted positions of the rows containing it."""
+    postings: Dict[str, List[int]] = defaultdict(list)
+    for (row, value) in enumerate(values.tolist()):
+        for trigram in _trigrams(str(value).lower()):
+            postings[trigram].append(row)
+    return {trigram: np.array(rows) for trigram, rows in postings.items()}
+
+
+def _trigram_candidates(index: Dict[str, np.ndarray], value: str) -> np.ndarray:
+    """Returns the rows that contain every trigram of value, which is at least three characters."""
+    trigrams = _trigrams(value)
+    if any(trigram not in index for trigram in trigrams):
+        return np.array([], dtype=int)
+    postings = [index[trigram] for trigram in trigrams]
+    return reduce(
+        lambda x, y: np.intersect1d(x, y, assume_unique=True), sorted(postings, key=len))
+
 
 class LocalDatasetQueryRunner():
-    def __init__(self, data_directory: str, schema_directory: str):
-        self.dataset = self._load_data(data_directory)
-        self.index = self._build_index(self.dataset)
+    """
+    Runs API queries against a dataset directory, with one table per "<table>.json" file or
+    "<table>.columns" directory (see the dataset module).
+
+    Loading JSON tables checks that every cell has a value and a display_value, which can be
+    turned off with validate=False. With snapshot=True, each JSON table is also saved next to its
+    file as a ".snapshot" pickle, which later loads use instead of parsing the JSON again, until
+    the JSON file changes.
+
+    LIKE and NOTLIKE look at every row, unless the field is in trigram_index_fields (a list of
+    fields for each table), in which case only the rows with all the trigrams of the value are
+    checked. Like on an instance, they match reference fields on their display values.
+    """
+    def __init__(self, data_directory: str, schema_directory: str, validate: bool = True,
+                 snapshot: bool = False, trigram_index_fields: Dict[str, List[str]] = None):
+        self.tables = self._load_data(data_directory, validate, snapshot)
+        self.index = self._build_index(self.tables)
+        self.positions = self._build_positions(self.index)
+        self.trigram_indexes = self._build_trigram_indexes(trigram_index_fields or {})
         self.schema_directory = schema_directory
-
-    def _build_index(self, dataset: Dict[str, pd.DataFrame]) -> Dict[str, pd.DataFrame]:
-
-        index: Dict[str, pd.DataFrame] = {}
-        for table, df in dataset.items():
-            for column in df.columns:
-                assert (df[column].apply(
-                        lambda x: ((type(x) == dict)
-                                   and ('value' in x)
-                                   and ('display_value' in x))).all()), (
-                    f"Column: {column} has malformed values!\n"
-                    "Required to be objects with 'value' and 'display_value' keys!")
-            index[table] = df[['sys_id']].applymap(lambda x: x['value'])
+        self._references: Dict[Tuple[str, str], str] = {}
+        self._update_lock = threading.Lock()
+        self._link_prefixes: Dict[Tuple[str, str], str] = {}
+        self._display_value_fields: Dict[str, Optional[str]] = {}
+
+    def _build_index(self, tables: Dict[str, dataset.DatasetTable]) -> Dict[str, pd.DataFrame]:
+        index = {}
+        for table, columns in tables.items():
+            sys_ids = columns.values['sys_id']
+            index[table] = pd.DataFrame({'sys_id': dataset.take(sys_ids, np.arange(len(sys_ids)))})
         return index
 
-    def _load_data(self, data_directory: str) -> Dict[str, pd.DataFrame]:
+    def _build_positions(self, index: Dict[str, pd.DataFrame]) -> Dict[str, pd.Index]:
+        """Hash index from sys_id to row position, for each table."""
+        return {table: pd.Index(df['sys_id']) for table, df in index.items()}
+
+    def _build_trigram_indexes(
+            self, fields: Dict[str, List[str]]) -> Dict[Tuple[str, str], Dict[str, np.ndarray]]:
+        indexes = {}
+        for table, table_fields in fields.items():
+            if table not in self.tables:
+                raise Exception(f"Table {table} not in dataset")
+            for field in table_fields:
+                values = self._like_source(table, field)
+                indexes[(table, field)] = _build_trigram_index(
+                    dataset.take(values, np.arange(len(values))))
+        return indexes
+
+    def _load_json_table(self, data_file: str, validate: bool,
+                         snapshot: bool) -> dataset.DatasetTable:
+        stat = os.stat(data_file)
+        source = {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size}
+        snapshot_file = f"{data_file}{SNAPSHOT_SUFFIX}"
+        if snapshot and os.path.exists(snapshot_file):
+            try:
+                with open(snapshot_file, 'rb') as f:
+                    saved = pickle.load(f)
+                if saved["source"] == source and (saved["validated"] or not validate):
+                    logger.debug(f"Loaded {data_file} from {snapshot_file}")
+                    return saved["table"]
+            except Exception as e:
+                # Probably written by a different version of this library, it's rebuilt below.
+                logger.warning(f"Could not load {snapshot_file}: {e}")
+
+        table = dataset.read_json_table(data_file, validate=validate)
+        if snapshot:
+            temp_file = f"{snapshot_file}.{os.getpid()}{SNAPSHOT_TEMP_SUFFIX}"
+            with open(temp_file, 'wb') as f:
+                pickle.dump(
+                    {"source": source, "validated": validate, "table": table},
+                    f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_file, snapshot_file)
+        return table
+
+    def _load_data(self, data_directory: str, validate: bool,
+                   snapshot: bool) -> Dict[str, dataset.DatasetTable]:
         data_files = os.listdir(data_directory)
-        dataset = {}
+        tables = {}
         for data_file in data_files:
             data_file_fullpath = os.path.join(data_directory, data_file)
-            if not data_file.endswith(".json"):
-                raise Exception(f"Found non json data file: {data_file_fullpath}")
-            table_name = remove_suffix(data_file, ".json")
-            with open(data_file_fullpath, 'r') as f:
-                dataset[table_name] = api_results_to_dataframe(json.loads(f.read()))
-        return dataset
-
-    def _get_dotted_field_value(self, table: str, field: str, sys_id: str,
-                                display_value: str = "false",
-                                # We need this because when qe are actually doing a query we want to
-                                # compare against the actual IDs.
-                                id_only_for_link_fields: bool = True):
-        assert type(sys_id) == str, f"Passed sys_id is not a string: {sys_id}"
-        if table not in self.dataset:
-            raise Exception(f"Table {table} not in dataset")
-        if table not in self.index:
-            raise Exception(f"Table {table} not in index")
-        row = self.dataset[table].loc[self.index[table]['sys_id'] == sys_id]
-        assert row.shape[0] == 1, f"Did not find exactly one row: {row}"
-        if "." in field:
-            link = field.split(".")[0]
-            link_sys_id = row[link].values[0]['value']
+            if data_file.endswith(SNAPSHOT_SUFFIX):
+                continue
+            if f"{SNAPSHOT_SUFFIX}." in data_file and data_file.endswith(SNAPSHOT_TEMP_SUFFIX):
+                # Left behind by a load that was interrupted while saving a snapshot, or being
+                # written by a concurrent load, so it isn't safe to delete.
+                continue
+            table_name = dataset.table_name(data_file)
+            if table_name is None:
+                raise Exception(f"Found non dataset file: {data_file_fullpath}")
+            if table_name in tables:
+                raise Exception(f"Found more than one file for table {table_name}")
+            if data_file.endswith(dataset.COLUMNAR_SUFFIX):
+                tables[table_name] = dataset.read_columnar_table(data_file_fullpath)
+            else:
+                tables[table_name] = self._load_json_table(data_file_fullpath, validate, snapshot)
+        return tables
+
+    def _get_reference_table(self, table: str, link: str) -> str:
+        if (table, link) not in self._references:
             catalog = load_fields_catalog(table, self.schema_directory)
-            assert 'reference' in catalog[link], f"Walking non-link field: {catalog[field]}"
-            link_table = catalog[link]['reference']
-            remaining_fields = ".".join(field.split(".")[1:])
-            return self._get_dotted_field_value(
-                link_table, remaining_fields, link_sys_id, display_value, False)
-        else:
-            # https://community.servicenow.com/community?id=community_question&sys_id=fd76cfe1db1cdbc01dcaf3231f9619cc
-            if display_value == "false":
-                if id_only_for_link_fields:
-                    return row[field].apply(lambda x: x['value'])
-                else:
-                    return row[field].apply(
-                        lambda x:
-                        {
-                            "value": x['value'],
-                            "link": x['link'],
-                        } if "link" in x else x['value']
-                    )
-            elif display_value == "true":
-                return row[field].apply(
-                    lambda x:
-                    {
-                        "display_value": x['display_value'],
-                        "link": x['link'],
-                    } if "link" in x else x['display_value']
-                )
-            elif display_value == "all":
-                return row[field]
+            assert 'reference' in catalog.get(link, {}), (
+                f"Walking non-link field: {table}.{link}: {catalog.get(link)}")
+            self._references[(table, link)] = catalog[link]['reference']
+        return self._references[(table, link)]
+
+    def _get_display_value_field(self, table: str) -> Optional[str]:
+        if table not in self._display_value_fields:
+            catalog = load_fields_catalog(table, self.schema_directory)
+            self._display_value_fields[table] = next(
+                (name for name, info in catalog.items() if info.get('is_table_display_value')),
+                None)
+        return self._display_value_fields[table]
+
+    def _resolve_rows(self, table: str, field: str,
+                      rows: np.ndarray) -> Tuple[str, str, np.ndarray]:
+        """
+        Follows a possibly dotted field from the given row positions of the table.
+
+        Returns the table and field at the end of the path, and the row positions in that table,
+        which are -1 where a link along the way is empty or points to a missing record.
+        """
+        if table not in self.tables:
+            raise Exception(f"Table {table} not in dataset")
+        while "." in field:
+            (link, field) = field.split(".", 1)
+            link_table = self._get_reference_table(table, link)
+            if link_table not in self.positions:
+                raise Exception(f"Table {link_table} not in dataset")
+            link_sys_ids = dataset.take(self.tables[table].values[link], np.maximum(rows, 0))
+            link_rows = self.positions[link_table].get_indexer(link_sys_ids)
+            rows = np.where(rows < 0, -1, link_rows)
+            table = link_table
+        return (table, field, rows)
+
+    def _get_field_values(self, table: str, field: str, rows: np.ndarray) -> pd.Series:
+        """Returns the values of a field, possibly a dotted one, for the given row positions."""
+        if table not in self.tables:
+            raise Exception(f"Table {table} not in dataset")
+        if "." not in field:
+            return pd.Series(dataset.take(self.tables[table].values[field], rows), dtype=object)
+        (leaf_table, leaf_field, leaf_rows) = self._resolve_rows(table, field, rows)
+        return pd.Series(
+            _take_resolved(self.tables[leaf_table].values[leaf_field], leaf_rows), dtype=object)
+
+    def _get_field_cells(self, table: str, field: str, rows: np.ndarray) -> List:
+        """Returns the raw cells of a field, possibly a dotted one, for the given row positions."""
+        (leaf_table, leaf_field, rows) = self._resolve_rows(table, field, rows)
+        columns = self.tables[leaf_table]
+        found = np.maximum(rows, 0)
+        values = dataset.take(columns.values[leaf_field], found).tolist()
+        display_values = dataset.take(columns.display_values[leaf_field], found).tolist()
+        links = (dataset.take(columns.links[leaf_field], found).tolist()
+                 if leaf_field in columns.links else [""] * len(rows))
+        cells = []
+        for (row, value, display_value, link) in zip(rows, values, display_values, links):
+            if row < 0:
+                cells.append({"value": "", "display_value": ""})
+            elif link:
+                cells.append({"display_value": display_value, "link": link, "value": value})
             else:
-                raise Exception(f"Invalid parameter for display_value: {display_value}")
+                cells.append({"display_value": display_value, "value": value})
+        return cells
 
-    def _matcher(self, table: str, tree: Tree) -> pd.DataFrame:
+    def _matcher(self, table: str, tree: Tree, rows: np.ndarray) -> np.ndarray:
+        """Returns whether each of the given rows matches."""
         logger.debug(f"_matcher: {tree.data}")
         assert len(tree.children) == 1
         for child in tree.children:
             assert isinstance(child, Tree)
             if child.data == 'empty':
-                return self._empty(table, child)
+                return self._empty(table, child, rows)
             elif child.data == 'not_empty':
-                return self._not_empty(table, child)
+                return self._not_empty(table, child, rows)
             elif child.data == 'contains':
-                return self._contains(table, child)
+                return self._contains(table, child, rows)
             elif child.data == 'not_contains':
-                return self._not_contains(table, child)
+                return self._not_contains(table, child, rows)
             elif child.data == 'is':
-                return self._is(table, child)
+                return self._is(table, child, rows)
             elif child.data == 'is_not':
-                return self._is_not(table, child)
+                return self._is_not(table, child, rows)
             elif child.data == 'date_between':
-                return self._date_between(table, child)
+                return self._date_between(table, child, rows)
             elif child.data == 'in':
-                return self._in(table, child)
+                return self._in(table, child, rows)
+            elif child.data in ['greater_than', 'greater_than_or_equal',
+                                'less_than', 'less_than_or_equal']:
+                return self._compare(table, child, rows)
+            elif child.data in ['order_by', 'order_by_desc']:
+                # Ordering doesn't filter anything, it's applied to the final result in query.
+                return np.ones(len(rows), dtype=bool)
             else:
                 raise Exception(f"_matcher: Found invalid node in parse tree: {child.data}")
         assert False, "Should not be able to get here, should have at least one child."
 
-    def _or(self, table: str, tree: Tree) -> pd.DataFrame:
+    def _or(self, table: str, tree: Tree, rows: np.ndarray) -> np.ndarray:
+        """
+        Returns the rows matching any of the matchers.
+
+        Each matcher only looks at the rows that none of the ones before it matched, so the
+        cheapest and least selective go first.
+        """
         logger.debug(f"_or: {tree.data}")
-        dfs = []
+        matchers = []
         for child in tree.children:
             assert isinstance(child, Tree)
-            if child.data == 'matcher':
-                dfs.append(self._matcher(table, child))
-            else:
+            if child.data != 'matcher':
                 raise Exception(f"_or: Found invalid node in parse tree: {child.data}")
-        return pd.concat(dfs).drop_duplicates().reset_index(drop=True)
-
-    def _and(self, table: str, tree: Tree) -> pd.DataFrame:
-        logger.debug(f"_and: {tree.data}")
-        result = None
-        for child in tree.children:
-            assert isinstance(child, Tree)
-            if child.data == 'query':
-                if result is None:
-                    result = self._query(table, child)
-                else:
-                    result = result.merge(
-                        self._query(table, child)['sys_id'], on="sys_id", how="inner")
+            matchers.append(child)
+        matched = np.zeros(len(rows), dtype=bool)
+        for matcher in sorted(matchers, key=self._or_cost):
+            remaining = ~matched
+            matched[remaining] = self._matcher(table, matcher, rows[remaining])
+        return rows[matched]
+
+    def _and(self, table: str, conjuncts: List[Tree], rows: np.ndarray) -> np.ndarray:
+        """
+        Returns the rows matching all of the matcher and or nodes.
+
+        Each node only looks at the rows that all the ones before it matched, so the cheapest and
+        most selective go first.
+        """
+        logger.debug(f"_and: {len(conjuncts)} conjuncts")
+        for conjunct in sorted(conjuncts, key=self._and_cost):
+            if conjunct.data == 'or':
+                rows = self._or(table, conjunct, rows)
             else:
-                raise Exception(f"_and: Found invalid node in parse tree: {child.data}")
-        assert result is not None, (
-            "Did not find any children of and, this shouldn't be allowed in the grammar")
-        return result
+                rows = rows[self._matcher(table, conjunct, rows)]
+        return rows
+
+    # How many rows a matcher is likely to keep, from fewest to most.
+    _MATCHER_SELECTIVITY = {
+        'is': 0, 'in': 0,
+        'greater_than': 1, 'greater_than_or_equal': 1, 'less_than': 1, 'less_than_or_equal': 1,
+        'date_between': 1,
+        'contains': 2, 'not_contains': 2,
+        'is_not': 3, 'empty': 3, 'not_empty': 3,
+        'order_by': 4, 'order_by_desc': 4,
+    }
+
+    def _matcher_cost(self, tree: Tree) -> Tuple[int, int]:
+        """Estimated cost of a matcher node, as (link hops, how many rows it's likely to keep)."""
+        assert isinstance(tree.children[0], Tree)
+        matcher = tree.children[0]
+        hops = str(matcher.children[0]).count(".") if matcher.children else 0
+        return (hops, self._MATCHER_SELECTIVITY.get(matcher.data, 0))
+
+    def _and_cost(self, tree: Tree) -> Tuple[int, int]:
+        if tree.data == 'or':
+            # An or has to check all its matchers against the rows that don't match yet.
+            return max(self._matcher_cost(child) for child in tree.children
+                       if isinstance(child, Tree))
+        return self._matcher_cost(tree)
+
+    def _or_cost(self, tree: Tree) -> Tuple[int, int]:
+        (hops, selectivity) = self._matcher_cost(tree)
+        return (hops, -selectivity)
+
+    def _conjuncts(self, tree: Tree) -> List[Tree]:
+        """Flattens nested and nodes into the matcher and or nodes that all have to match."""
+        assert len(tree.children) == 1
+        child = tree.children[0]
+        assert isinstance(child, Tree)
+        if child.data == 'and':
+            conjuncts = []
+            for query in child.children:
+                assert isinstance(query, Tree)
+                if query.data != 'query':
+                    raise Exception(f"_and: Found invalid node in parse tree: {query.data}")
+                conjuncts.extend(self._conjuncts(query))
+            return conjuncts
+        elif child.data in ['matcher', 'or']:
+            return [child]
+        else:
+            raise Exception(f"_query: Found invalid node in parse tree: {child.data}")
 
-    def _empty(self, table: str, tree: Tree) -> pd.DataFrame:
+    def _empty(self, table: str, tree: Tree, rows: np.ndarray) -> np.ndarray:
         logger.debug(f"_empty: {tree.data}")
         assert len(tree.children) == 1, "_empty should have two children: {tree.children}"
-
-        def _empty_filter(row, field):
-            # https://stackoverflow.com/a/26658301
-            row_value = self._get_dotted_field_value(table, field, row['sys_id'])
-            if row_value.values[0]:
-                return False
-            else:
-                return True
-
         field = None
         for child in tree.children:
             assert isinstance(child, Token)
             if child.type == "DOTTED_FIELD":
                 field = str(child)
         assert field
-        matcher = self.index[table].apply(_empty_filter, field=field, axis=1)
-        return self.index[table][matcher]
+        return ~self._get_field_values(table, field, rows).to_numpy(dtype=bool)
 
-    def _not_empty(self, table: str, tree: Tree) -> pd.DataFrame:
+    def _not_empty(self, table: str, tree: Tree, rows: np.ndarray) -> np.ndarray:
         logger.debug(f"_not_empty: {tree.data}")
         assert len(tree.children) == 1, "_not_empty should have two children: {tree.children}"
-
-        def _not_empty_filter(row, field):
-            # https://stackoverflow.com/a/26658301
-            row_value = self._get_dotted_field_value(table, field, row['sys_id'])
-            if row_value.values[0]:
-                return True
-            else:
-                return False
-
         field = None
         for child in tree.children:
             assert isinstance(child, Token)
             if child.type == "DOTTED_FIELD":
                 field = str(child)
         assert field
-        matcher = self.index[table].apply(_not_empty_filter, field=field, axis=1)
-        return self.index[table][matcher]
+        return self._get_field_values(table, field, rows).to_numpy(dtype=bool)
 
-    def _contains(self, table: str, tree: Tree) -> pd.DataFrame:
+    def _like_value(self, tree: Tree) -> Tuple[str, str]:
+        field = None
+        value = None
+        for child in tree.children:
+            assert isinstance(child, Token)
+            if child.type == "DOTTED_FIELD":
+                field = str(child)
+            if child.type == "VALUE":
+                value = str(child)
+        assert field
+        assert value
+        return (field, value)
+
+    def _like_source(self, table: str, field: str) -> np.ndarray:
+        """The column LIKE matches against, the display values for reference fields."""
+        columns = self.tables[table]
+        if field in columns.links:
+            return columns.display_values[field]
+        return columns.values[field]
+
+    def _like(self, table: str, field: str, value: str, rows: np.ndarray) -> np.ndarray:
+        """Case insensitive substring match, using a trigram index if there is one."""
+        value = value.lower()
+        if len(value) >= 3 and self.trigram_indexes:
+            # An update changes the values and then drops the index of the field, so hold the
+            # update lock from looking up the index to matching the values.
+            with self._update_lock:
+                (leaf_table, leaf_field, leaf_rows) = self._resolve_rows(table, field, rows)
+                trigram_index = self.trigram_indexes.get((leaf_table, leaf_field))
+                if trigram_index is not None:
+                    return self._like_candidates(table, field, value, rows, np.isin(
+                        leaf_rows, _trigram_candidates(trigram_index, value)))
+        return self._like_candidates(
+            table, field, value, rows, np.ones(len(rows), dtype=bool))
+
+    def _like_candidates(self, table: str, field: str, value: str, rows: np.ndarray,
+                         candidates: np.ndarray) -> np.ndarray:
+        """Matches the candidate rows, the others don't match."""
+        (leaf_table, leaf_field, leaf_rows) = self._resolve_rows(table, field, rows[candidates])
+        values = pd.Series(
+            _take_resolved(self._like_source(leaf_table, leaf_field), leaf_rows), dtype=object)
+        matched = np.zeros(len(rows), dtype=bool)
+        matched[candidates] = values.astype(str).str.lower().str.contains(
+            value, regex=False).to_numpy(dtype=bool)
+        return matched
+
+    def _contains(self, table: str, tree: Tree, rows: np.ndarray) -> np.ndarray:
         logger.debug(f"_contains: {tree.data}")
         assert len(tree.children) == 2, "_contains should have two children: {tree.children}"
-        raise Exception("Not Yet Implemented")
+        (field, value) = self._like_value(tree)
+        return self._like(table, field, value, rows)
 
-    def _not_contains(self, table: str, tree: Tree) -> pd.DataFrame:
+    def _not_contains(self, table: str, tree: Tree, rows: np.ndarray) -> np.ndarray:
         logger.debug(f"_not_contains: {tree.data}")
         assert len(tree.children) == 2, "_not_contains should have two children: {tree.children}"
-        raise Exception("Not Yet Implemented")
+        (field, value) = self._like_value(tree)
+        return ~self._like(table, field, value, rows)
+
+    def _lowercase_values(self, table: str, field: str, rows: np.ndarray) -> pd.Series:
+        # XXX: I needed this string conversion for "active=true". Does it cause other problems?
+        return self._get_field_values(table, field, rows).astype(str).str.lower()
 
-    def _is(self, table: str, tree: Tree) -> pd.DataFrame:
+    def _is(self, table: str, tree: Tree, rows: np.ndarray) -> np.ndarray:
         logger.debug(f"_is: {tree.data}")
         # Not having a value is a synonym for empty string
         assert len(tree.children) == 2 or len(tree.children) == 1, (
             "_is should have one or two children: {tree.children}")
-
-        def _is_filter(row, field, value):
-            # https://stackoverflow.com/a/26658301
-            row_value = self._get_dotted_field_value(table, field, row['sys_id'])
-            # XXX: I needed this string conversion for "active=true". Does it cause other problems?
-            if str(row_value.values[0]).lower() == str(value).lower():
-                return True
-            else:
-                return False
-
         field = None
         value = None
         for child in tree.children:
@@ -225,21 +445,10 @@ class LocalDatasetQueryRunner():
             value = ""
         assert field is not None
         assert value is not None
-        matcher = self.index[table].apply(_is_filter, field=field, value=value, axis=1)
-        return self.index[table][matcher]
+        return (self._lowercase_values(table, field, rows) == value.lower()).to_numpy()
 
-    def _is_not(self, table: str, tree: Tree) -> pd.DataFrame:
+    def _is_not(self, table: str, tree: Tree, rows: np.ndarray) -> np.ndarray:
         assert len(tree.children) == 2, "_is_not should have two children: {tree.children}"
-
-        def _is_not_filter(row, field, value):
-            # https://stackoverflow.com/a/26658301
-            row_value = self._get_dotted_field_value(table, field, row['sys_id'])
-            # XXX: I needed this string conversion for "active=true". Does it cause other problems?
-            if str(row_value.values[0]).lower() != str(value).lower():
-                return True
-            else:
-                return False
-
         field = None
         value = None
         for child in tree.children:
@@ -250,25 +459,11 @@ class LocalDatasetQueryRunner():
                 value = str(child)
         assert field
         assert value
-        matcher = self.index[table].apply(_is_not_filter, field=field, value=value, axis=1)
-        return self.index[table][matcher]
+        return (self._lowercase_values(table, field, rows) != value.lower()).to_numpy()
 
-    def _date_between(self, table: str, tree: Tree) -> pd.DataFrame:
+    def _date_between(self, table: str, tree: Tree, rows: np.ndarray) -> np.ndarray:
         logger.debug(f"_date_between: {tree.data}")
         assert len(tree.children) == 3, "_date_between should have three children: {tree.children}"
-
-        def _date_between_filter(row, field, values):
-            assert len(values) == 2
-            from_date = datetime.datetime.strptime(str(values[0]), "%Y-%m-%d")
-            to_date = datetime.datetime.strptime(str(values[1]), "%Y-%m-%d")
-            # https://stackoverflow.com/a/26658301
-            row_value = self._get_dotted_field_value(table, field, row['sys_id'])
-            field_date = datetime.datetime.strptime(str(row_value.values[0]), "%Y-%m-%d")
-            if from_date < field_date and field_date < to_date:
-                return True
-            else:
-                return False
-
         field = None
         values = []
         for child in tree.children:
@@ -279,23 +474,15 @@ class LocalDatasetQueryRunner():
                 values.append(str(child))
         assert field
         assert len(values) == 2
-        matcher = self.index[table].apply(
-            _date_between_filter, field=field, values=values, axis=1)
-        return self.index[table][matcher]
+        from_date = pd.to_datetime(values[0], format="%Y-%m-%d")
+        to_date = pd.to_datetime(values[1], format="%Y-%m-%d")
+        field_dates = pd.to_datetime(
+            self._get_field_values(table, field, rows).astype(str), format="%Y-%m-%d")
+        return ((from_date < field_dates) & (field_dates < to_date)).to_numpy()
 
-    def _in(self, table: str, tree: Tree) -> pd.DataFrame:
+    def _in(self, table: str, tree: Tree, rows: np.ndarray) -> np.ndarray:
         logger.debug(f"_in: {tree.data}")
         assert len(tree.children) > 1, "_in should have at least two children: {tree.children}"
-
-        def _in_filter(row, field, values):
-            # https://stackoverflow.com/a/26658301
-            row_value = self._get_dotted_field_value(table, field, row['sys_id'])
-            # XXX: I needed this string conversion for "active=true". Does it cause other problems?
-            if str(row_value.values[0]).lower() in [str(v).lower() for v in values]:
-                return True
-            else:
-                return False
-
         logger.debug(tree.children)
         field = None
         values = []
@@ -305,48 +492,114 @@ class LocalDatasetQueryRunner():
                 assert field is None
                 field = str(child)
             if child.type == "NOCOMMA_VALUE":
-                values.append(str(child))
+                values.append(str(child).lower())
         assert field
         assert values
-        matcher = self.index[table].apply(_in_filter, field=field, values=values, axis=1)
-        return self.index[table][matcher]
+        return self._lowercase_values(table, field, rows).isin(values).to_numpy()
+
+    def _compare(self, table: str, tree: Tree, rows: np.ndarray) -> np.ndarray:
+        logger.debug(f"_compare: {tree.data}")
+        assert len(tree.children) == 2, "_compare should have two children: {tree.children}"
+
+        comparisons = {
+            'greater_than': lambda x, y: x > y,
+            'greater_than_or_equal': lambda x, y: x >= y,
+            'less_than': lambda x, y: x < y,
+            'less_than_or_equal': lambda x, y: x <= y,
+        }
+
+        field = None
+        value = None
+        for child in tree.children:
+            assert isinstance(child, Token)
+            if child.type == "DOTTED_FIELD":
+                field = str(child)
+            if child.type == "COMPARISON_VALUE":
+                value = str(child)
+        assert field
+        assert value is not None
+        # NOTE: Everything is compared as strings, which works for sys_ids and for ISO dates.
+        return comparisons[tree.data](
+            self._get_field_values(table, field, rows).astype(str), value).to_numpy()
 
-    def _query(self, table: str, tree: Tree) -> pd.DataFrame:
+    def _order_by(self, table: str, tree: Tree, rows: np.ndarray) -> np.ndarray:
+        if tree is None:
+            return rows
+        order_by_nodes = [
+            subtree for subtree in tree.iter_subtrees_topdown()
+            if subtree.data in ['order_by', 'order_by_desc']]
+        # The first ORDERBY is the primary sort key, so apply stable sorts starting from the last.
+        for order_by_node in reversed(order_by_nodes):
+            logger.debug(f"_order_by: {order_by_node.data}")
+            field = str(order_by_node.children[0])
+            keys = np.asarray(self._get_field_values(table, field, rows).astype(str), dtype=str)
+            if order_by_node.data == 'order_by':
+                order = np.argsort(keys, kind='stable')
+            else:
+                # Sort the reversed keys so that equal keys stay in their original order.
+                order = len(keys) - 1 - np.argsort(keys[::-1], kind='stable')[::-1]
+            rows = rows[order]
+        return rows
+
+    def _query(self, table: str, tree: Tree) -> np.ndarray:
+        """Returns the positions of the rows of the table that match the query, in table order."""
+        if table not in self.index:
+            raise Exception(f"Table {table} not in dataset")
+        rows = np.arange(len(self.index[table]))
         if not tree:
-            return self.index[table]
+            return rows
         logger.debug(f"_query: {tree.data}")
-        assert len(tree.children) == 1
-        assert isinstance(tree.children[0], Tree)
-        if tree.children[0].data == 'matcher':
-            return self._matcher(table, tree.children[0])
-        elif tree.children[0].data == 'or':
-            return self._or(table, tree.children[0])
-        elif tree.children[0].data == 'and':
-            return self._and(table, tree.children[0])
-        else:
-            raise Exception(f"_query: Found invalid node in parse tree: {tree.children[0].data}")
-
-    def _fields(self, table: str, tree: Tree, sys_ids: List[str],
-                display_value: str) -> pd.DataFrame:
+        child = tree.children[0]
+        assert isinstance(child, Tree)
+        if child.data == 'new_query':
+            # Each ^NQ query is matched on its own, and the result has the rows any of them match.
+            matched = [self._query(table, query) for query in child.children
+                       if isinstance(query, Tree)]
+            return reduce(np.union1d, matched)
+        # Rows that are filtered out early are not looked at again, but the remaining matchers
+        # still run on the empty set of rows, so they still complain about invalid fields.
+        return self._and(table, self._conjuncts(tree), rows)
+
+    def _get_field_column(self, table: str, field: str, rows: np.ndarray,
+                          display_value: str) -> List:
+        """Returns a field, possibly a dotted one, of the given rows as the API formats it."""
+        if display_value == "all":
+            return self._get_field_cells(table, field, rows)
+        # https://community.servicenow.com/community?id=community_question&sys_id=fd76cfe1db1cdbc01dcaf3231f9619cc
+        key = "value" if display_value == "false" else "display_value"
+        (leaf_table, leaf_field, leaf_rows) = self._resolve_rows(table, field, rows)
+        columns = self.tables[leaf_table]
+        source = columns.values if display_value == "false" else columns.display_values
+        column = _take_resolved(source[leaf_field], leaf_rows).tolist()
+        if leaf_field not in columns.links:
+            return column
+        missing = leaf_rows < 0
+        links = dataset.take(columns.links[leaf_field], np.maximum(leaf_rows, 0)).tolist()
+        return [
+            {key: value, "link": link} if link and not is_missing else value
+            for (value, link, is_missing) in zip(column, links, missing.tolist())]
+
+    def _fields(self, table: str, tree: Optional[Tree], rows: np.ndarray,
+                display_value: str) -> List[Dict]:
+        """Returns the records of the given rows, with only the requested fields."""
         fields = []
         if tree:
             logger.debug(f"_fields: {tree.data}")
             for child in tree.children:
                 fields.append(str(child))
         else:
-            fields = list(self.dataset[table].columns)
-        rows = []
-        for sys_id in sys_ids:
-            row = []
-            for field in fields:
-                row.append(self._get_dotted_field_value(table, field, sys_id,
-                           display_value=display_value, id_only_for_link_fields=False).values[0])
-            rows.append(row)
-        return pd.DataFrame(columns=fields, data=rows)
-
-    def _offset(self, tree: Tree, df: pd.DataFrame) -> pd.DataFrame:
+            fields = list(self.tables[table].values)
+        if len(rows) == 0:
+            return []
+        if display_value not in ["all", "true", "false"]:
+            raise Exception(f"Invalid parameter for display_value: {display_value}")
+        columns = [
+            self._get_field_column(table, field, rows, display_value) for field in fields]
+        return [dict(zip(fields, values)) for values in zip(*columns)]
+
+    def _offset(self, tree: Tree, rows: np.ndarray) -> np.ndarray:
         if tree is None:
-            return df
+            return rows
         logger.debug(f"_offset: {tree.data}")
         assert len(tree.children) == 1, "_offset should have one child: {tree.children}"
         offset = None
@@ -355,11 +608,11 @@ class LocalDatasetQueryRunner():
             if child.type == "OFFSET":
                 offset = int(str(child))
         assert offset is not None
-        return df.iloc[offset:]
+        return rows[offset:]
 
-    def _limit(self, tree: Tree, df: pd.DataFrame) -> pd.DataFrame:
+    def _limit(self, tree: Tree, rows: np.ndarray) -> np.ndarray:
         if tree is None:
-            return df
+            return rows
         logger.debug(f"_limit: {tree.data}")
         assert len(tree.children) == 1, "_limit should have one child: {tree.children}"
         limit = None
@@ -368,47 +621,71 @@ class LocalDatasetQueryRunner():
             if child.type == "LIMIT":
                 limit = int(str(child))
         assert limit
-        return df.iloc[:limit]
-
-    def _group_by(self, tree: Tree, df: pd.DataFrame, display_value: str) -> Dict:
+        return rows[:limit]
+
+    def _group_columns(self, table: str, field: str, rows: np.ndarray,
+                       display_value: str) -> List[np.ndarray]:
+        """
+        Returns the columns a field is grouped on: the display value, if display_value asks for
+        it, then the value.
+
+        Groups are always on the value, so two records with the same display value (two people
+        with the same name, for example) are still two groups, like on an instance.
+        """
+        (leaf_table, leaf_field, leaf_rows) = self._resolve_rows(table, field, rows)
+        columns = self.tables[leaf_table]
+        selected = []
+        if display_value in ["all", "true"]:
+            selected.append(columns.display_values[leaf_field])
+        selected.append(columns.values[leaf_field])
+        return [_take_resolved(column, leaf_rows).astype(object) for column in selected]
+
+    def _having(self, tree: Optional[Tree], counts: pd.Series) -> pd.Series:
+        if tree is None:
+            return counts
+        logger.debug(f"_having: {tree.data}")
+        (aggregate, _, comparison, threshold) = [str(child) for child in tree.children]
+        if aggregate != "count":
+            raise Exception(f"Unsupported having aggregate: {aggregate}")
+        return counts[_HAVING_OPERATORS[comparison](counts, float(threshold))]
+
+    def _group_by(self, table: str, tree: Tree, having: Optional[Tree], rows: np.ndarray,
+                  display_value: str) -> Dict:
         logger.debug(f"_group_by: {tree.data}")
-        fields = []
-        for child in tree.children:
-            fields.append(str(child))
-        # If we passed "all" for display value, these are dictionaries, so we must convert to JSON
-        # to avoid "unhashable type" errors when trying to group with pandas.
-        #
-        # If we pass "true" or "false" for display value, we actually still have trouble because
-        # link fields are still dictionaries from the api, but other things aren't.
-        value_counts = df.applymap(
-            lambda x: json.dumps({"x": x})
-        ).value_counts(subset=fields, sort=False)
+        fields = [str(child) for child in tree.children]
         result: Dict = {}
         result['result'] = []
-        for item in value_counts.items():
+        if len(rows) == 0:
+            return result
+        if display_value not in ["all", "true", "false"]:
+            raise Exception(f"Invalid display value: {display_value}")
+        columns = []
+        for field in fields:
+            columns.extend(self._group_columns(table, field, rows, display_value))
+        keys = pd.DataFrame(dict(enumerate(columns)))
+        counts = self._having(having, keys.groupby(
+            list(keys.columns), sort=False, dropna=False).size())
+        per_field = 1 if display_value == "false" else 2
+        groups = []
+        for (key, count) in counts.items():
+            if not isinstance(key, tuple):
+                key = (key,)
+            groups.append((key, count))
+        # Groups come out in the order of their JSON encoded values, which is what the API results
+        # in the tests were recorded with.
+        groups.sort(key=lambda group: [json.dumps(value) for value in group[0]])
+        for (key, count) in groups:
             groupby_fields = []
-            for field, value in zip(fields, list(item[0])):
-                groupby_field = {"field": field}
-                unpacked_values = json.loads(value)["x"]
+            for (i, field) in enumerate(fields):
+                values = key[i * per_field:(i + 1) * per_field]
                 if display_value == "all":
-                    groupby_field["display_value"] = unpacked_values["display_value"]
-                    groupby_field["value"] = unpacked_values["value"]
-                elif display_value == "true":
-                    if type(unpacked_values) == dict:
-                        groupby_field["value"] = unpacked_values["display_value"]
-                    else:
-                        groupby_field["value"] = unpacked_values
-                elif display_value == "false":
-                    if type(unpacked_values) == dict:
-                        groupby_field["value"] = unpacked_values["value"]
-                    else:
-                        groupby_field["value"] = unpacked_values
+                    groupby_fields.append(
+                        {"field": field, "display_value": values[0], "value": values[1]})
                 else:
-                    raise Exception(f"Invalid display value: {display_value}")
-                groupby_fields.append(groupby_field)
+                    groupby_fields.append({"field": field, "value": values[0]})
             result['result'].append({
                 "stats": {
-                    "count": item[1]
+                    "count": int(count)
                 },
                 "groupby_fields": groupby_fields
             })
@@ -422,25 +699,84 @@ class LocalDatasetQueryRunner():
             parsed['display_value'])
         assert display_value is not None
         if parsed['endpoint'] == "table":
-            result = self._query(parsed['table'], parsed['query'])
-            result = self._offset(parsed['offset'], result)
-            result = self._limit(parsed['limit'], result)
-            result = self._fields(
-                parsed['table'], parsed['fields'], result['sys_id'].to_list(),
-                display_value=display_value)
-            result = result.reset_index(drop=True)
-            return dataframe_to_api_results(result)
+            # Only the rows of the requested page are ever looked up for the output fields.
+            rows = self._query(parsed['table'], parsed['query'])
+            rows = self._order_by(parsed['table'], parsed['query'], rows)
+            rows = self._offset(parsed['offset'], rows)
+            rows = self._limit(parsed['limit'], rows)
+            return {"result": self._fields(
+                parsed['table'], parsed['fields'], rows, display_value=display_value)}
         elif parsed['endpoint'] == "stats":
-            result = self._query(parsed['table'], parsed['query'])
-            assert 'having' not in parsed or parsed['having'] is None
+            rows = self._query(parsed['table'], parsed['query'])
             if parsed['group_by'] is None:
+                if parsed['having'] is not None:
+                    raise Exception("sysparm_having requires sysparm_group_by")
                 return {"result": {"stats": {
-                        "count": result.shape[0]
+                        "count": len(rows)
                         }}}
             else:
-                result = self._fields(
-                    parsed['table'], parsed['group_by'], result['sys_id'].to_list(),
-                    display_value=display_value)
-                return self._group_by(parsed['group_by'], result, display_value)
+                return self._group_by(
+                    parsed['table'], parsed['group_by'], parsed['having'], rows, display_value)
         else:
             raise Exception(f"Invalid endpoint {parsed['endpoint']}")
+
+    def _writable_column(self, columns: Dict[str, np.ndarray], field: str) -> np.ndarray:
+        # Loaded columns can be memory mapped or fixed width, so the first write makes a copy.
+        column = columns[field]
+        if column.dtype != object or not column.flags.writeable:
+            column = np.array(dataset.take(column, np.arange(len(column))).tolist(), dtype=object)
+            columns[field] = column
+        return column
+
+    def _reference_cell(self, table: str, field: str, sys_id: str) -> Tuple[str, str]:
+        """Returns the display value and link of a reference to sys_id."""
+        if not sys_id:
+            return ("", "")
+        link_table = self._get_reference_table(table, field)
+        display_field = self._get_display_value_field(link_table)
+        display_value = ""
+        row = (self.positions[link_table].get_indexer([sys_id])[0]
+               if link_table in self.positions else -1)
+        if row >= 0 and display_field:
+            display_value = str(dataset.take(
+                self.tables[link_table].display_values[display_field], np.array([row]))[0])
+        if (table, field) not in self._link_prefixes:
+            # Point the link at the same host as the links already in the dataset.
+            links = self.tables[table].links[field]
+            existing = next((str(link) for link in dataset.take(links, np.arange(len(links)))
+                             if link), f"/api/now/table/{link_table}/")
+            self._link_prefixes[(table, field)] = existing.rsplit('/', 1)[0]
+        return (display_value, f"{self._link_prefixes[(table, field)]}/{sys_id}")
+
+    def update(self, table: str, sys_id: str, obj: Dict) -> Dict:
+        """
+        Sets the fields in obj on a record, in memory only, and returns the record like a PUT to
+        the table API does. Fields the table doesn't have are ignored.
+
+        A reference field gets the display value of the record it now points to, any other field
+        gets the value as its display value.
+        """
+        if table not in self.tables:
+            raise Exception(f"Table {table} not in dataset")
+        row = self.positions[table].get_indexer([sys_id])[0]
+        if row < 0:
+            return {
+                "error": {
+                    "message": "No Record found",
+                    "detail": f"Record {sys_id} doesn't exist in {table}"},
+                "status": "failure"}
+        columns = self.tables[table]
+        with self._update_lock:
+            for field, value in obj.items():
+                if field == "sys_id" or field not in columns.values:
+                    continue
+                self._writable_column(columns.values, field)[row] = value
+                if field in columns.links:
+                    (display_value, link) = self._reference_cell(table, field, value)
+                    self._writable_column(columns.links, field)[row] = link
+                else:
+                    display_value = value
+                self._writable_column(columns.display_values, field)[row] = display_value
+                if self.trigram_indexes.pop((table, field), None) is not None:
+                    logger.warning(f"Dropped the trigram index on {table}.{field} after an update")
+        return {"result": self._fields(table, None, np.array([row]), "false")[0]}
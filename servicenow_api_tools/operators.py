@@ -2,10 +2,18 @@
 # https://docs.servicenow.com/bundle/rome-platform-user-interface/page/use/common-ui-elements/reference/r_OpAvailableFiltersQueries.html
 OR = lambda *subqueries: "^OR".join(subqueries) # noqa
 AND = lambda *subqueries: "^".join(subqueries) # noqa
+NEW_QUERY = lambda *subqueries: "^NQ".join(subqueries) # noqa
 EMPTY = lambda field: f"{field}ISEMPTY" # noqa
 NOT_EMPTY = lambda field: f"{field}ISNOTEMPTY" # noqa
 CONTAINS = lambda field, value: f"{field}LIKE{value}" # noqa
 NOT_CONTAINS = lambda field, value: f"{field}NOTLIKE{value}" # noqa
 IS = lambda field, value: f"{field}={value}" # noqa
 IS_NOT = lambda field, value: f"{field}!={value}" # noqa
+IN = lambda field, values: f"{field}IN{','.join(values)}" # noqa
 DATE_BETWEEN = lambda field, date_start, date_end: f"{field}BETWEEN{date_start}@{date_end}" # noqa
+GREATER_THAN = lambda field, value: f"{field}>{value}" # noqa
+GREATER_THAN_OR_EQUAL = lambda field, value: f"{field}>={value}" # noqa
+LESS_THAN = lambda field, value: f"{field}<{value}" # noqa
+LESS_THAN_OR_EQUAL = lambda field, value: f"{field}<={value}" # noqa
+ORDER_BY = lambda field: f"ORDERBY{field}" # noqa
+ORDER_BY_DESC = lambda field: f"ORDERBYDESC{field}" # noqa
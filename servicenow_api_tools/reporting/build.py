@@ -1,3 +1,4 @@
+from concurrent.futures import ThreadPoolExecutor
 from servicenow_api_tools.clients import AggregateAPIClient
 from servicenow_api_tools.clients import ServicenowRestEndpoint
 from servicenow_api_tools.reporting.definitions import (
@@ -173,50 +174,82 @@ def process_column_results(results: List[Tuple[StatsReportColumn, List[Tuple[str
         return process_column_results_ungrouped(results)
 
 
+def _run_operation(
+        ac: AggregateAPIClient,
+        op: StatsReportOperation,
+        groupby_fields: Dict[str, List[str]] = {}) -> Dict:
+    if groupby_fields:
+        return ac.query(table=op.table, query=op.query,
+                        group_by=groupby_fields[op.table],
+                        display_value="true")
+    else:
+        return ac.query(table=op.table, query=op.query, display_value="true")
+
+
 def run_query(
         endpoint: ServicenowRestEndpoint,
         column: StatsReportColumn,
         groupby_fields: Dict[str, List[str]] = {}) -> List[Tuple[str, Dict]]:
     ac = AggregateAPIClient(endpoint=endpoint)
-    if groupby_fields:
-        results = []
-        for op in column.operations:
-            result = ac.query(table=op.table, query=op.query,
-                              group_by=groupby_fields[op.table],
-                              display_value="true")
-            results.append((op.operation, result))
-        return results
-    else:
-        results = []
+    results = []
+    for op in column.operations:
+        results.append((op.operation, _run_operation(ac, op, groupby_fields)))
+    return results
+
+
+def run_queries(
+        endpoint: ServicenowRestEndpoint,
+        columns: List[StatsReportColumn],
+        groupby_fields: Dict[str, List[str]] = {},
+        max_workers: int = 8) -> List[Tuple[StatsReportColumn, List[Tuple[str, Dict]]]]:
+    """
+    Same as calling run_query for every column, but runs up to max_workers of the operations
+    across all the columns at the same time.
+
+    Operations with the same table and query (PLUS and MINUS alike) only run once, and every column
+    that uses them gets the same result.
+    """
+    def _operation_key(op: StatsReportOperation) -> Tuple[str, str]:
+        return (op.table, op.query)
+
+    unique_operations: Dict[Tuple[str, str], StatsReportOperation] = {}
+    for column in columns:
         for op in column.operations:
-            result = ac.query(table=op.table, query=op.query, display_value="true")
-            results.append((op.operation, result))
-        return results
+            unique_operations.setdefault(_operation_key(op), op)
+
+    ac = AggregateAPIClient(endpoint=endpoint)
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        operation_results = dict(zip(
+            unique_operations.keys(),
+            pool.map(lambda op: _run_operation(ac, op, groupby_fields),
+                     unique_operations.values())))
+    return [
+        (column, [(op.operation, operation_results[_operation_key(op)])
+                  for op in column.operations])
+        for column in columns]
 
 
 def build_report(
         endpoint: ServicenowRestEndpoint,
-        report: StatsReport) -> pd.DataFrame:
-    query_results = []
+        report: StatsReport,
+        max_workers: int = 8) -> pd.DataFrame:
     if report.groupby_options:
-        for column in report.columns:
-            query_results.append(
-                (column,
-                 run_query(endpoint, column,
-                           groupby_fields=report.groupby_options.fields)))
+        query_results = run_queries(
+            endpoint, report.columns,
+            groupby_fields=report.groupby_options.fields,
+            max_workers=max_workers)
         return process_column_results(
             query_results,
             group_name=report.groupby_options.column_name,
             group_mappings=report.groupby_options.mappings)
     else:
-        for column in report.columns:
-            query_results.append((column, run_query(endpoint, column)))
+        query_results = run_queries(endpoint, report.columns, max_workers=max_workers)
         return process_column_results(query_results)
 
 
 def build_per_day_report(
         endpoint: ServicenowRestEndpoint,
-        query: str, time_field: str, table: str) -> pd.DataFrame:
+        query: str, time_field: str, table: str, max_workers: int = 8) -> pd.DataFrame:
     past_week_days = [
         (datetime.datetime.now() - datetime.timedelta(i)).strftime('%Y-%m-%d') for i in range(0, 7)]
     columns = []
@@ -228,4 +261,5 @@ def build_per_day_report(
         endpoint,
         StatsReport(
             report_name="Last 7 Days ({query})",
-            columns=columns))
+            columns=columns),
+        max_workers=max_workers)
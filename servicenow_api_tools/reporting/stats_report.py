@@ -10,13 +10,15 @@ import pandas as pd
 
 def run_stats_report(
         stats_report_definition_file: str,
-        endpoint: ServicenowRestEndpoint) -> Tuple[str, pd.DataFrame]:
+        endpoint: ServicenowRestEndpoint,
+        max_workers: int = 8) -> Tuple[str, pd.DataFrame]:
     definition = None
     with open(stats_report_definition_file, 'r') as f:
         definition = load_stats_report(json.loads(f.read()))
     results = build_report(
         endpoint=endpoint,
-        report=definition)
+        report=definition,
+        max_workers=max_workers)
 
     def add_date_to_first_column(df: pd.DataFrame) -> pd.DataFrame:
         date = datetime.datetime.utcnow().isoformat()
@@ -1,8 +1,24 @@
+from contextlib import asynccontextmanager
+from typing import Dict, List, Tuple
 from unittest import TestCase
+import asyncio
+import json
+import os
+import pandas as pd
+import pytest
+import time
 from servicenow_api_tools.utils import dataframe_to_api_results
-from servicenow_api_tools.clients import TableAPIClient, AggregateAPIClient
+from servicenow_api_tools.clients import runner, utils
+from servicenow_api_tools.clients.backup import BackupWriter, read_backup
+from servicenow_api_tools.clients import (
+    TableAPIClient, AggregateAPIClient, AsyncTableAPIClient, AsyncAggregateAPIClient,
+    AsyncServicenowRestEndpoint,
+    CachingServicenowRestEndpoint, BulkUpdateExecutor, TableAPIUpdateClient, TokenBucket,
+    BatchQueryBuilder, TableQueryBuilder, UpdateQueryBuilder)
+import servicenow_api_tools.mock_api_server.query as query
 from .utils import (
-    get_local_endpoint, write_result_or_print, read_result,
+    RecordingEndpoint, copy_dataset_with_localized_datetimes, set_choice_labels,
+    get_local_endpoint, get_async_local_endpoint, write_result_or_print, read_result,
     write_count_result_or_print, read_count_result,
     ACTIVITY_TYPE_TEST_SYS_ID,
     PERSON_TEST_SYS_IDS
@@ -45,3 +61,548 @@ def test_aggregate_client():
     expected = read_count_result()
     write_count_result_or_print(result, expected)
     TestCase().assertDictEqual(expected, result)
+
+
+def test_table_client_stream():
+    client = TableAPIClient(endpoint=get_local_endpoint())
+    expected = client.query(table="activity", fields=["sys_id", "activity_type"])
+    batches = list(client.query(
+        table="activity", fields=["sys_id", "activity_type"], batch_size=3, max_workers=2,
+        stream=True))
+    assert [len(batch) for batch in batches] == [3, 3, 3, 1]
+    pd.testing.assert_frame_equal(
+        pd.concat(batches).reset_index(drop=True), expected.reset_index(drop=True))
+
+
+def test_table_client_detects_link_fields_once(monkeypatch):
+    client = TableAPIClient(endpoint=get_local_endpoint())
+    expected = client.query(table="activity", batch_size=100)
+    detected = []
+    detect_link_fields = utils.detect_link_fields
+    monkeypatch.setattr(utils, "detect_link_fields", lambda records: (
+        detected.append(len(records)) or detect_link_fields(records)))
+    result = client.query(table="activity", batch_size=3, max_workers=2)
+    pd.testing.assert_frame_equal(result.reset_index(drop=True), expected.reset_index(drop=True))
+    result = client.query(table="activity", batch_size=3, max_workers=2, keyset_field="sys_id")
+    assert sorted(result["sys_id"]) == sorted(expected["sys_id"])
+    assert len(detected) == 2
+
+
+def test_table_client_stream_stops_early():
+    endpoint = RecordingEndpoint()
+    batches = TableAPIClient(endpoint=endpoint).iter_query(
+        table="activity", batch_size=1, max_workers=2)
+    next(batches)
+    batches.close()
+    # The count query, the batch that was read, and at most the two that were in flight.
+    assert len(endpoint.urls) <= 4
+
+
+def test_table_client_keyset():
+    client = TableAPIClient(endpoint=get_local_endpoint())
+    expected = client.query(table="activity", fields=["activity_type"])
+    result = client.query(
+        table="activity", fields=["activity_type"], batch_size=2, max_workers=3,
+        keyset_field="sys_id")
+    assert list(result.columns) == list(expected.columns)
+    assert sorted(result["activity_type"]) == sorted(expected["activity_type"])
+
+
+def test_table_client_keyset_non_unique_field():
+    endpoint = RecordingEndpoint()
+    client = TableAPIClient(endpoint=endpoint)
+    expected = client.query(table="activity", query="active=true")
+    endpoint.urls = []
+    result = client.query(
+        table="activity", query="active=true", batch_size=2, keyset_field="active")
+    assert sorted(result["sys_id"]) == sorted(expected["sys_id"])
+    # Pages don't grow to take in every row with the same key.
+    assert all(url.endswith("&sysparm_limit=2") for url in endpoint.urls)
+    assert len(endpoint.urls) == len(expected) // 2 + 1
+
+
+def test_table_client_keyset_uses_raw_values(tmp_path):
+    endpoint = RecordingEndpoint(path=copy_dataset_with_localized_datetimes(
+        str(tmp_path), "activity", "sys_created_on"))
+    client = TableAPIClient(endpoint=endpoint)
+    expected = client.query(table="activity")
+    endpoint.urls = []
+    result = client.query(table="activity", batch_size=2, keyset_field="sys_created_on")
+    assert sorted(result["sys_id"]) == sorted(expected["sys_id"])
+    assert len(endpoint.urls) == len(set(endpoint.urls)) == len(expected) // 2 + 1
+    assert all(" PM" not in url and " AM" not in url for url in endpoint.urls)
+
+
+def test_table_client_keyset_empty_keys(tmp_path):
+    path = copy_dataset_with_localized_datetimes(str(tmp_path), "activity", "sys_created_on")
+    with open(os.path.join(path, "activity.json"), 'r') as f:
+        results = json.loads(f.read())
+    for record in results["result"][:5]:
+        record["sys_created_on"] = {"display_value": "", "value": ""}
+    with open(os.path.join(path, "activity.json"), 'w') as f:
+        f.write(json.dumps(results))
+    endpoint = RecordingEndpoint(path=path)
+    client = TableAPIClient(endpoint=endpoint)
+    expected = client.query(table="activity")
+    endpoint.urls = []
+    result = client.query(table="activity", batch_size=2, keyset_field="sys_created_on")
+    assert sorted(result["sys_id"]) == sorted(expected["sys_id"])
+    assert any("sys_created_onISEMPTY" in url for url in endpoint.urls)
+    assert any("sys_created_onISNOTEMPTY" in url for url in endpoint.urls)
+
+    with pytest.raises(ValueError, match="NQ"):
+        client.query(table="activity", query="active=true^NQactive=false",
+                     keyset_field="sys_created_on")
+
+
+def test_table_client_sync(tmp_path):
+    client = TableAPIClient(endpoint=RecordingEndpoint(path=copy_dataset_with_localized_datetimes(
+        str(tmp_path), "activity", "sys_updated_on")))
+    store_path = str(tmp_path / "store")
+    expected = client.query(table="activity").reset_index(drop=True)
+    snapshot = client.sync(table="activity", store_path=store_path)
+    pd.testing.assert_frame_equal(snapshot, expected)
+
+    # The watermark is the latest raw value, not the latest display value.
+    state_path = tmp_path / "store" / "activity.watermark.json"
+    state = json.loads(state_path.read_text())
+    assert state["watermark"] == "2021-01-20 17:00:00"
+
+    # Mark a local row to see whether the next sync pulls it again. Nothing changed since the
+    # last sync, so only the rows at the watermark come back.
+    snapshot_path = tmp_path / "store" / "activity.json"
+    stale = json.loads(snapshot_path.read_text())
+    stale["result"][0]["active"] = "stale"
+    snapshot_path.write_text(json.dumps(stale))
+    snapshot = client.sync(table="activity", store_path=store_path)
+    assert snapshot["active"][0] == "stale"
+    assert len(snapshot) == len(expected)
+    assert json.loads(state_path.read_text())["watermark"] == "2021-01-20 17:00:00"
+
+    state["watermark"] = "2021-01-19 00:00:00"
+    state_path.write_text(json.dumps(state))
+    snapshot = client.sync(table="activity", store_path=store_path)
+    assert "stale" not in snapshot["active"].values
+    assert sorted(snapshot["sys_id"]) == sorted(expected["sys_id"])
+    assert sorted(path.name for path in (tmp_path / "store").iterdir()) == [
+        "activity.json", "activity.watermark.json"]
+
+    with pytest.raises(ValueError, match="NQ"):
+        client.sync(table="activity", store_path=store_path,
+                    query="active=true^NQactive=false")
+
+
+def test_async_table_client():
+    client = TableAPIClient(endpoint=get_local_endpoint())
+    expected = client.query(table="activity", query="active=true", batch_size=3)
+    async_client = AsyncTableAPIClient(endpoint=get_async_local_endpoint())
+    result = asyncio.run(async_client.query(table="activity", query="active=true", batch_size=3))
+    pd.testing.assert_frame_equal(result, expected)
+
+
+def test_async_aggregate_client():
+    async_client = AsyncAggregateAPIClient(endpoint=get_async_local_endpoint())
+    result = asyncio.run(async_client.query(
+        table="activity", group_by=["activity_type"],
+        query=f"person={PERSON_TEST_SYS_IDS[0]}^active=true", display_value=True))
+    expected = read_count_result()
+    TestCase().assertDictEqual(expected, result)
+
+
+class FakeResponse:
+    def __init__(self, body: bytes):
+        self.body = body
+
+    async def read(self) -> bytes:
+        return self.body
+
+
+class FakeSession:
+    """
+    Stands in for an aiohttp.ClientSession, answering from the local dataset. The first
+    connection_errors requests fail to connect.
+    """
+    def __init__(self, base_url: str, connection_errors: int = 0):
+        self.base_url = base_url
+        self.connection_errors = connection_errors
+        self.local_endpoint = get_local_endpoint()
+        self.requests: List[Tuple[str, str, Dict]] = []
+
+    @asynccontextmanager
+    async def request(self, method: str, url: str, headers: Dict, data: str = None):
+        import aiohttp
+        self.requests.append((method, url, headers))
+        if self.connection_errors > 0:
+            self.connection_errors -= 1
+            raise aiohttp.ClientConnectionError("Connection refused")
+        result = self.local_endpoint.get(url[len(self.base_url):])
+        yield FakeResponse(json.dumps(result).encode("utf-8"))
+
+    async def close(self):
+        pass
+
+
+def test_async_endpoint(monkeypatch):
+    aiohttp = pytest.importorskip("aiohttp")
+    base_url = "https://example.servicenowservices.com"
+    session = FakeSession(base_url, connection_errors=1)
+    monkeypatch.setattr(aiohttp, "ClientSession", lambda **kwargs: session)
+    monkeypatch.setattr(aiohttp, "TCPConnector", lambda **kwargs: None)
+    url = str(TableQueryBuilder(table="activity", limit=1))
+    result = asyncio.run(runner.make_async_request(
+        session, "user", "password", "GET", f"{base_url}{url}", backoff_factor=0))
+    assert result == get_local_endpoint().get(url)
+    # The connection error was retried, with basic auth both times.
+    assert [request[:2] for request in session.requests] == [("GET", f"{base_url}{url}")] * 2
+    assert all(request[2]["authorization"].startswith("Basic ")
+               for request in session.requests)
+
+    async def _query():
+        async with AsyncServicenowRestEndpoint(
+                base_url=base_url, username="user", password="password",
+                credentials_from_env=False) as endpoint:
+            return await AsyncTableAPIClient(endpoint=endpoint).query(
+                table="activity", query="active=true", batch_size=3)
+    expected = TableAPIClient(endpoint=get_local_endpoint()).query(
+        table="activity", query="active=true", batch_size=3)
+    pd.testing.assert_frame_equal(asyncio.run(_query()), expected)
+
+
+def test_caching_endpoint(tmp_path):
+    endpoint = CachingServicenowRestEndpoint(get_local_endpoint())
+    client = TableAPIClient(endpoint=endpoint)
+    expected = TableAPIClient(endpoint=get_local_endpoint()).query(
+        table="activity", query="active=true")
+    pd.testing.assert_frame_equal(client.query(table="activity", query="active=true"), expected)
+    pd.testing.assert_frame_equal(client.query(table="activity", query="active=true"), expected)
+    assert endpoint.cache_stats() == {"hits": 2, "misses": 2, "entries": 2}
+
+    evicting = CachingServicenowRestEndpoint(get_local_endpoint(), max_entries=1)
+    evicting.get("/api/now/table/activity?sysparm_limit=1")
+    evicting.get("/api/now/table/activity?sysparm_limit=2")
+    evicting.get("/api/now/table/activity?sysparm_limit=1")
+    assert evicting.cache_stats() == {"hits": 0, "misses": 3, "entries": 1}
+
+    expired = CachingServicenowRestEndpoint(get_local_endpoint(), ttl_seconds=0)
+    expired.get("/api/now/table/activity?sysparm_limit=1")
+    expired.get("/api/now/table/activity?sysparm_limit=1")
+    assert (expired.hits, expired.misses) == (0, 2)
+
+    on_disk = CachingServicenowRestEndpoint(get_local_endpoint(), cache_directory=str(tmp_path))
+    result = on_disk.get("/api/now/table/activity?sysparm_limit=1")
+    reloaded = CachingServicenowRestEndpoint(get_local_endpoint(), cache_directory=str(tmp_path))
+    assert reloaded.get("/api/now/table/activity?sysparm_limit=1") == result
+    assert (reloaded.hits, reloaded.misses) == (1, 0)
+
+    # Expired entries are deleted from the cache directory.
+    expiring = CachingServicenowRestEndpoint(
+        get_local_endpoint(), ttl_seconds=0, cache_directory=str(tmp_path))
+    resource = "/api/now/table/activity?sysparm_limit=1"
+    assert expiring._load(expiring._cache_key(resource), "activity") is None
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_caching_endpoint_writes(tmp_path):
+    endpoint = CachingServicenowRestEndpoint(get_local_endpoint())
+    # The cache connects as the wrapped endpoint.
+    assert (endpoint.base_url, endpoint.username) == (
+        endpoint.endpoint.base_url, endpoint.endpoint.username)
+    activity_url = str(TableQueryBuilder(table="activity", limit=1))
+    sys_id = endpoint.get(activity_url)["result"][0]["sys_id"]["value"]
+    record_url = str(TableQueryBuilder(table="activity", query=f"sys_id={sys_id}"))
+    person_url = str(TableQueryBuilder(table="person", limit=1))
+    endpoint.get(record_url)
+    endpoint.get(person_url)
+
+    # A PUT expires what was cached for its table, and only for its table.
+    endpoint.put(str(UpdateQueryBuilder(table="activity", sys_id=sys_id)),
+                 {"active": "changed once"})
+    assert endpoint.get(record_url)["result"][0]["active"]["value"] == "changed once"
+    endpoint.get(person_url)
+    assert (endpoint.hits, endpoint.misses) == (1, 4)
+
+    # So do the writes in a batch API request.
+    batch_query = BatchQueryBuilder()
+    batch_query.add_request(
+        "PUT", str(UpdateQueryBuilder(table="activity", sys_id=sys_id)),
+        {"active": "changed twice"})
+    endpoint.batch(batch_query)
+    assert endpoint.get(record_url)["result"][0]["active"]["value"] == "changed twice"
+    assert (endpoint.hits, endpoint.misses) == (1, 5)
+
+    # Users sharing a cache directory don't get each other's results.
+    (first_user, second_user) = (get_local_endpoint(), get_local_endpoint())
+    first_user.username = "first"
+    second_user.username = "second"
+    CachingServicenowRestEndpoint(first_user, cache_directory=str(tmp_path)).get(person_url)
+    other = CachingServicenowRestEndpoint(second_user, cache_directory=str(tmp_path))
+    other.get(person_url)
+    assert (other.hits, other.misses) == (0, 1)
+
+
+def test_bulk_update_executor(tmp_path):
+    sys_ids = list(TableAPIClient(endpoint=get_local_endpoint()).query(
+        table="activity", fields=["sys_id"])["sys_id"])
+    update_ops = [
+        {
+            "table": "activity",
+            "resource": str(UpdateQueryBuilder(table="activity", sys_id=sys_id)),
+            "obj": {"sys_id": sys_id, "active": "false"},
+        }
+        for sys_id in sys_ids]
+    journal_path = str(tmp_path / "journal.jsonl")
+    endpoint = RecordingEndpoint(put_failures={sys_ids[0]: 1, sys_ids[1]: 100})
+    report = BulkUpdateExecutor(
+        endpoint, max_workers=4, rate_per_second=None, max_retries=2, backoff_seconds=0,
+        journal_path=journal_path).run(update_ops)
+    assert list(report["sys_id"]) == sys_ids
+    assert list(report["status"]) == ["updated", "failed"] + ["updated"] * (len(sys_ids) - 2)
+    assert list(report["attempts"]) == [2, 3] + [1] * (len(sys_ids) - 2)
+    assert "Try again" in report["error"][1]
+    assert len(endpoint.puts) == len(sys_ids) + 3
+
+    # Running again with the same journal only sends the update that didn't land.
+    endpoint.put_failures = {}
+    endpoint.puts = []
+    report = BulkUpdateExecutor(
+        endpoint, rate_per_second=None, journal_path=journal_path).run(update_ops)
+    assert list(report["status"]) == ["skipped", "updated"] + ["skipped"] * (len(sys_ids) - 2)
+    assert endpoint.puts == [(update_ops[1]["resource"], update_ops[1]["obj"])]
+
+
+def test_token_bucket():
+    bucket = TokenBucket(rate_per_second=50, burst=5)
+    start = time.monotonic()
+    for _ in range(15):
+        bucket.acquire()
+    # The first 5 are a burst, the other 10 have to wait for 1/50 of a second each.
+    assert time.monotonic() - start >= 0.19
+
+
+def test_get_records_by_sys_id():
+    expected = TableAPIClient(endpoint=get_local_endpoint()).query(table="activity")
+    sys_ids = list(expected["sys_id"])
+    endpoint = RecordingEndpoint()
+    result = TableAPIClient(endpoint=endpoint).get_records_by_sys_id(
+        "activity", sys_ids + sys_ids[:2], max_workers=3, max_query_length=100)
+    # Two sys_ids fit in 100 characters, and there is no count query.
+    assert len(endpoint.urls) == (len(sys_ids) + 1) // 2
+    assert all("stats" not in url for url in endpoint.urls)
+    pd.testing.assert_frame_equal(
+        result.loc[sys_ids].reset_index(drop=True), expected.reset_index(drop=True))
+
+    update_client = TableAPIUpdateClient(endpoint=get_local_endpoint())
+    for sys_id in sys_ids[:3]:
+        update_client.queue_update("activity", {"sys_id": sys_id, "active": "false"})
+    original_records = update_client._get_original_records_for_queued_updates(
+        max_query_length=40)
+    assert list(original_records["activity"].loc[sys_ids[:3], "sys_id"]) == sys_ids[:3]
+    update_client.queue_update("activity", {"sys_id": "0" * 32, "active": "false"})
+    with pytest.raises(Exception, match="Could not find records"):
+        update_client._get_original_records_for_queued_updates()
+
+
+def test_exec_updates_skips_unchanged(tmp_path, monkeypatch):
+    table_client = TableAPIClient(endpoint=get_local_endpoint())
+    activities = table_client.query(table="activity").iloc[:3]
+    people = table_client.query(table="person").iloc[:2]
+    endpoint = RecordingEndpoint()
+    update_client = TableAPIUpdateClient(endpoint=endpoint)
+    flipped = "false" if activities["active"].iloc[0] == "true" else "true"
+    update_client.queue_update(
+        "activity", {"sys_id": activities["sys_id"].iloc[0], "active": flipped})
+    # Setting a field to the value it already has doesn't change anything.
+    update_client.queue_update(
+        "activity",
+        {"sys_id": activities["sys_id"].iloc[1], "active": activities["active"].iloc[1]})
+    update_client.queue_update(
+        "activity",
+        {"sys_id": activities["sys_id"].iloc[2], "active": activities["active"].iloc[2],
+         "short_description": "Changed"})
+    update_client.queue_update("person", {"sys_id": people["sys_id"].iloc[0], "name": "New"})
+    update_client.queue_update(
+        "person", {"sys_id": people["sys_id"].iloc[1], "name": people["name"].iloc[1]})
+
+    changes = update_client.diff_queued_updates()
+    assert changes.to_dict("records") == [
+        {"table": "activity", "sys_id": activities["sys_id"].iloc[0], "field": "active",
+         "old_value": activities["active"].iloc[0], "new_value": flipped},
+        {"table": "activity", "sys_id": activities["sys_id"].iloc[2],
+         "field": "short_description", "old_value": None, "new_value": "Changed"},
+        {"table": "person", "sys_id": people["sys_id"].iloc[0], "field": "name",
+         "old_value": people["name"].iloc[0], "new_value": "New"},
+    ]
+
+    monkeypatch.setattr(utils, "query_yes_no", lambda question: True)
+    report = update_client.exec_updates(
+        backup_directory=str(tmp_path), dry_run=False, rate_per_second=None)
+    assert sorted(url for url, _ in endpoint.puts) == sorted([
+        str(UpdateQueryBuilder(table="activity", sys_id=activities["sys_id"].iloc[0])),
+        str(UpdateQueryBuilder(table="activity", sys_id=activities["sys_id"].iloc[2])),
+        str(UpdateQueryBuilder(table="person", sys_id=people["sys_id"].iloc[0])),
+    ])
+    assert list(report["status"]) == ["updated"] * 3 + ["unchanged"] * 2
+    assert list(report["table"]) == ["activity", "activity", "person", "activity", "person"]
+
+
+def test_exec_updates_skips_unchanged_raw_values(tmp_path, monkeypatch):
+    path = copy_dataset_with_localized_datetimes(str(tmp_path), "activity", "sys_created_on")
+    set_choice_labels(path, "activity", "active", {"true": "Active", "false": "Archived"})
+    endpoint = RecordingEndpoint(path=path)
+    activities = utils.link_field_values(TableAPIClient(endpoint=endpoint).query(
+        table="activity", unpack_link_fields=False)).iloc[:2]
+    update_client = TableAPIUpdateClient(endpoint=endpoint)
+    # Setting a date/time or a choice to the value it already has doesn't change anything, even
+    # though the instance shows it differently.
+    update_client.queue_update("activity", {
+        "sys_id": activities["sys_id"].iloc[0],
+        "sys_created_on": activities["sys_created_on"].iloc[0],
+        "active": activities["active"].iloc[0]})
+    update_client.queue_update("activity", {
+        "sys_id": activities["sys_id"].iloc[1], "sys_created_on": "2022-02-02 10:00:00"})
+
+    changes = update_client.diff_queued_updates()
+    assert changes.to_dict("records") == [
+        {"table": "activity", "sys_id": activities["sys_id"].iloc[1], "field": "sys_created_on",
+         "old_value": activities["sys_created_on"].iloc[1], "new_value": "2022-02-02 10:00:00"},
+    ]
+
+    monkeypatch.setattr(utils, "query_yes_no", lambda question: True)
+    report = update_client.exec_updates(
+        backup_directory=str(tmp_path / "backup"), dry_run=False, rate_per_second=None)
+    assert [url for url, _ in endpoint.puts] == [
+        str(UpdateQueryBuilder(table="activity", sys_id=activities["sys_id"].iloc[1]))]
+    assert list(report["status"]) == ["updated", "unchanged"]
+
+
+def test_backup_and_restore(tmp_path, monkeypatch):
+    activities = TableAPIClient(endpoint=get_local_endpoint()).query(table="activity")
+    for backup_format in ["jsonl.gz", "csv"]:
+        with BackupWriter(str(tmp_path / backup_format), backup_format,
+                          updated_fields={"activity": ["active"]}) as backup:
+            backup.write("activity", activities.iloc[:4])
+            backup.write("activity", activities.iloc[4:])
+        (manifest, records) = read_backup(backup.path)
+        assert manifest["tables"]["activity"] == {
+            "file": f"activity.{backup_format}", "rows": len(activities),
+            "updated_fields": ["active"]}
+        pd.testing.assert_frame_equal(
+            records["activity"], activities.reset_index(drop=True).astype(object))
+
+    # Backups started in the same second don't overwrite each other.
+    with BackupWriter(str(tmp_path / "same_second")) as first:
+        with BackupWriter(str(tmp_path / "same_second")) as second:
+            assert first.path != second.path
+
+    # Records that were changed after the backup are put back, the others are left alone.
+    flipped = activities.copy()
+    flipped.loc[flipped.index[:2], "active"] = [
+        "false" if active == "true" else "true" for active in flipped["active"].iloc[:2]]
+    with BackupWriter(str(tmp_path / "flipped"), updated_fields={"activity": ["active"]}) as backup:
+        backup.write("activity", flipped)
+    endpoint = RecordingEndpoint()
+    monkeypatch.setattr(utils, "query_yes_no", lambda question: True)
+    report = TableAPIUpdateClient(endpoint=endpoint).restore_backup(
+        backup.path, str(tmp_path / "before_restore"), dry_run=False, rate_per_second=None)
+    assert sorted(endpoint.puts, key=lambda put: put[0]) == sorted([
+        (str(UpdateQueryBuilder(table="activity", sys_id=sys_id)),
+         {"sys_id": sys_id, "active": active})
+        for sys_id, active in zip(flipped["sys_id"].iloc[:2], flipped["active"].iloc[:2])],
+        key=lambda put: put[0])
+    assert sorted(report["status"]) == ["unchanged"] * (len(activities) - 2) + ["updated"] * 2
+
+    # The restore backed up the records it was about to change.
+    (before_restore_path,) = (tmp_path / "before_restore").iterdir()
+    (_, records) = read_backup(str(before_restore_path))
+    assert sorted(records["activity"]["sys_id"]) == sorted(activities["sys_id"])
+
+
+def test_backup_and_restore_raw_values(tmp_path, monkeypatch):
+    path = copy_dataset_with_localized_datetimes(str(tmp_path), "activity", "sys_created_on")
+    set_choice_labels(path, "activity", "active", {"true": "Active", "false": "Archived"})
+    endpoint = RecordingEndpoint(path=path)
+    table_client = TableAPIClient(endpoint=endpoint)
+    originals = utils.link_field_values(
+        table_client.query(table="activity", unpack_link_fields=False)).iloc[:2]
+
+    monkeypatch.setattr(utils, "query_yes_no", lambda question: True)
+    update_client = TableAPIUpdateClient(endpoint=endpoint)
+    for sys_id, active in zip(originals["sys_id"], originals["active"]):
+        update_client.queue_update("activity", {
+            "sys_id": sys_id, "sys_created_on": "2022-02-02 10:00:00",
+            "active": "false" if active == "true" else "true"})
+    update_client.exec_updates(
+        backup_directory=str(tmp_path / "backup"), dry_run=False, rate_per_second=None)
+
+    # The backup has the stored values, not the localized date/times or the choice labels.
+    (backup_path,) = (tmp_path / "backup").iterdir()
+    (_, records) = read_backup(str(backup_path))
+    pd.testing.assert_frame_equal(
+        records["activity"].set_index("sys_id").loc[
+            originals["sys_id"], ["sys_created_on", "active"]].reset_index(drop=True),
+        originals[["sys_created_on", "active"]].reset_index(drop=True))
+
+    endpoint.puts = []
+    TableAPIUpdateClient(endpoint=endpoint).restore_backup(
+        str(backup_path), str(tmp_path / "before_restore"), dry_run=False, rate_per_second=None)
+    assert sorted(obj["sys_created_on"] for _, obj in endpoint.puts) == sorted(
+        originals["sys_created_on"])
+    restored = utils.link_field_values(table_client.get_records_by_sys_id(
+        "activity", list(originals["sys_id"]), unpack_link_fields=False))
+    pd.testing.assert_frame_equal(
+        restored.loc[originals["sys_id"], ["sys_created_on", "active"]].reset_index(drop=True),
+        originals[["sys_created_on", "active"]].reset_index(drop=True))
+
+
+def test_batch_updates(monkeypatch):
+    endpoint = RecordingEndpoint()
+    table_client = TableAPIClient(endpoint=endpoint)
+    activities = table_client.query(table="activity")
+    people = table_client.query(table="person")
+
+    # Any request can go in a batch.
+    batch_query = BatchQueryBuilder()
+    get_id = batch_query.add_request("GET", str(TableQueryBuilder(table="person", limit=2)))
+    put_id = batch_query.add_request(
+        "PUT", str(UpdateQueryBuilder(table="person", sys_id="0" * 32)), {"name": "Nobody"})
+    responses = endpoint.batch(batch_query)
+    assert responses[get_id] == {
+        "status_code": 200,
+        "body": endpoint.get(str(TableQueryBuilder(table="person", limit=2)))}
+    assert responses[put_id]["status_code"] == 404
+
+    sys_ids = list(activities["sys_id"])
+    update_ops = [
+        {
+            "table": "activity",
+            "resource": str(UpdateQueryBuilder(table="activity", sys_id=sys_id)),
+            "obj": {"sys_id": sys_id, "active": "false", "person": people["sys_id"].iloc[0]},
+        }
+        for sys_id in sys_ids + ["0" * 32]]
+    endpoint.posts = []
+    catalog_loads = []
+    load_fields_catalog = query.load_fields_catalog
+    monkeypatch.setattr(query, "load_fields_catalog", lambda table, schema_directory: (
+        catalog_loads.append(table) or load_fields_catalog(table, schema_directory)))
+    report = BulkUpdateExecutor(
+        endpoint, rate_per_second=None, max_retries=1, backoff_seconds=0,
+        batch_size=4).run(update_ops)
+    assert list(report["status"]) == ["updated"] * len(sys_ids) + ["failed"]
+    assert list(report["attempts"]) == [1] * len(sys_ids) + [2]
+    assert "No Record found" in report["error"].iloc[-1]
+    # One batch per 4 updates, and one more to retry the update that failed.
+    assert len(endpoint.posts) == (len(update_ops) + 3) // 4 + 1
+    # Each schema is read once, not once for every updated reference.
+    assert sorted(catalog_loads) == ["activity", "person"]
+
+    # The updates are visible to queries, with the display value of the new reference.
+    updated = table_client.query(table="activity")
+    assert set(updated["active"]) == {"false"}
+    assert set(updated["person"]) == {people["sys_id"].iloc[0]}
+    assert set(updated["person_display_value"]) == {people["name"].iloc[0]}
+    result = endpoint.get(str(TableQueryBuilder(
+        table="activity", query=f"person.name={people['name'].iloc[0]}", fields=["sys_id"])))
+    assert len(result["result"]) == len(sys_ids)
+    # Only the endpoint that made the updates sees them.
+    assert list(TableAPIClient(endpoint=get_local_endpoint()).query(
+        table="activity")["active"]) == list(activities["active"])
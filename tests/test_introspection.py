@@ -1,10 +1,10 @@
 from servicenow_api_tools.introspection import (
     get_mappings_for_table, introspect_api_for_schema,
-    id_to_name, name_to_id)
+    id_to_name, name_to_id, MappingIndex)
 from servicenow_api_tools.schema.schema import merge_fields_catalog
 from unittest import TestCase
 from .utils import (
-    get_local_endpoint, SCHEMAS_DIR,
+    get_local_endpoint, SCHEMAS_DIR, RecordingEndpoint, copy_dataset_with_localized_datetimes,
     write_result_or_print, read_result, get_introspection_parameters)
 
 
@@ -71,3 +71,40 @@ def test_introspect_api_for_schema_and_update_catalog():
     expected = read_result()
     write_result_or_print(updated_result, expected)
     TestCase().assertDictEqual(updated_result, expected)
+
+
+def test_mapping_index():
+    endpoint = RecordingEndpoint()
+    index = MappingIndex("activity_type", endpoint=endpoint, schemas_dir=SCHEMAS_DIR)
+    pulls = len(endpoint.urls)
+    expected = get_mappings_for_table(
+        "activity_type", endpoint=get_local_endpoint(), schemas_dir=SCHEMAS_DIR)
+    TestCase().assertDictEqual(index.mappings(), expected)
+
+    names = list(expected.values())
+    TestCase().assertDictEqual(
+        index.names_to_ids(names),
+        {name: name_to_id("activity_type", endpoint=get_local_endpoint(),
+                          schemas_dir=SCHEMAS_DIR, name=name) for name in names})
+    TestCase().assertDictEqual(index.ids_to_names(expected.keys()), expected)
+    assert index.id_to_name("ef9a311e507edf450ce82fe4ecedb231") == id_to_name(
+        "activity_type", endpoint=get_local_endpoint(), schemas_dir=SCHEMAS_DIR,
+        id="ef9a311e507edf450ce82fe4ecedb231")
+    assert len(endpoint.urls) == pulls
+
+    # The test dataset has placeholders instead of dates in sys_updated_on, so there is no
+    # watermark and everything comes back.
+    assert index.refresh() == len(expected)
+    TestCase().assertDictEqual(index.mappings(), expected)
+
+
+def test_mapping_index_watermark(tmp_path):
+    endpoint = RecordingEndpoint(path=copy_dataset_with_localized_datetimes(
+        str(tmp_path), "person", "sys_updated_on"))
+    index = MappingIndex("person", endpoint=endpoint, schemas_dir=SCHEMAS_DIR)
+    assert len(index.mappings()) == 10
+    # Only the last row has the latest raw sys_updated_on. A display value watermark would be a
+    # US formatted local time, which every raw value compares greater than.
+    endpoint.urls = []
+    assert index.refresh() == 1
+    assert "sys_updated_on>=2021-01-20 17:00:00" in endpoint.urls[-1]
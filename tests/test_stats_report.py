@@ -2,7 +2,9 @@ import os
 import pandas as pd
 from servicenow_api_tools.reporting import run_stats_report
 from servicenow_api_tools.reporting.build import get_debug_mode, set_debug_mode
-from .utils import get_local_endpoint, write_result_dataframe_or_print, read_result_dataframe
+from .utils import (
+    get_local_endpoint, write_result_dataframe_or_print, read_result_dataframe,
+    RecordingEndpoint)
 
 DATA_TEST_DEFINITION_FILE = os.path.join(
     os.path.dirname(__file__), "reporting", "stats-report-definition.json")
@@ -32,3 +34,28 @@ def test_stats_report_debug_mode():
     write_result_dataframe_or_print(result=results, expected=expected)
     pd.testing.assert_frame_equal(results, expected)
     assert report_name == "Location Breakdown"
+
+
+def test_stats_report_serial():
+    set_debug_mode(False)
+    (_, expected) = run_stats_report(
+        stats_report_definition_file=DATA_TEST_DEFINITION_FILE,
+        endpoint=get_local_endpoint())
+    (_, results) = run_stats_report(
+        stats_report_definition_file=DATA_TEST_DEFINITION_FILE,
+        endpoint=get_local_endpoint(),
+        max_workers=1)
+    results['Date (UTC)'] = 'X'
+    expected['Date (UTC)'] = 'X'
+    pd.testing.assert_frame_equal(results, expected)
+
+
+def test_stats_report_deduplicates_queries():
+    set_debug_mode(False)
+    endpoint = RecordingEndpoint()
+    run_stats_report(
+        stats_report_definition_file=DATA_TEST_DEFINITION_FILE,
+        endpoint=endpoint)
+    # The definition has six operations, but only three different queries.
+    assert len(endpoint.urls) == 3
+    assert len(set(endpoint.urls)) == 3
@@ -44,6 +44,60 @@ def test_parse_sysparm_query():
     assert expected.pretty() == result.pretty()
 
 
+def test_parse_sysparm_query_keyset():
+    query = 'sys_id>=4^sys_id<8^ORDERBYsys_id'
+    expected = Tree('query', [
+        Tree('and', [
+            Tree('query', [
+                Tree('and', [
+                    Tree('query', [
+                        Tree('matcher', [
+                            Tree('greater_than_or_equal', [
+                                Token('FIELD', 'sys_id'),
+                                Token('COMPARISON_VALUE', '4')
+                            ])
+                        ])
+                    ]),
+                    Tree('query', [
+                        Tree('matcher', [
+                            Tree('less_than', [
+                                Token('FIELD', 'sys_id'),
+                                Token('COMPARISON_VALUE', '8')
+                            ])
+                        ])
+                    ])
+                ])
+            ]),
+            Tree('query', [
+                Tree('matcher', [
+                    Tree('order_by', [
+                        Token('FIELD', 'sys_id')
+                    ])
+                ])
+            ])
+        ])
+    ])
+
+    result = parsers.parse_sysparm_query(query)
+    assert expected.pretty() == result.pretty()
+
+
+def test_parse_sysparm_query_new_query():
+    query = 'active>true^NQactive=true^sys_id>4^ORDERBYactive^ORDERBYsys_id'
+    result = parsers.parse_sysparm_query(query)
+    (new_query,) = result.children
+    assert new_query.data == 'new_query'
+    assert [query.data for query in new_query.children] == ['query', 'query']
+    assert [subtree.data for subtree in new_query.children[1].iter_subtrees_topdown()
+            if subtree.data not in ['query', 'and', 'matcher']] == [
+                'is', 'greater_than', 'order_by', 'order_by']
+
+
+def test_parse_sysparm_query_is_cached():
+    query = 'active=true^sys_id>=4'
+    assert parsers.parse_sysparm_query(query) is parsers.parse_sysparm_query(query)
+
+
 def test_parse_sysparm_fields():
     fields = "foo,bar"
     expected = Tree('fields', [
@@ -3,8 +3,14 @@ from typing import Dict, Any
 from unittest import TestCase
 import hashlib
 import json
+import numpy as np
 import os
+import pytest
+import shutil
 import servicenow_api_tools.mock_api_server.query as query
+from servicenow_api_tools.mock_api_server.dataset import (
+    COLUMNAR_SUFFIX, DatasetTable, read_columnar_table, read_json_table, table_name, take,
+    write_columnar_table)
 from .utils import (
     SCHEMAS_DIR, TEST_DATASET, write_result_or_print, read_result,
     write_count_result_or_print, read_count_result,
@@ -127,6 +133,28 @@ def test_not_equal_matcher_limit_offset_table_query():
     _assert_dicts_equal(result, expected)
 
 
+def test_paged_ordered_table_query():
+    runner = query.LocalDatasetQueryRunner(TEST_DATASET, SCHEMAS_DIR)
+    for order in ["ORDERBYactive^ORDERBYDESCperson.name", "ORDERBYDESCactive", ""]:
+        for display_value in ["true", "false", "all"]:
+            everything = runner.query(str(TableQueryBuilder(
+                table="activity", query=order, fields=["sys_id", "person", "person.name"],
+                display_value=display_value)))['result']
+            pages = []
+            for offset in range(0, len(everything), 3):
+                pages.extend(runner.query(str(TableQueryBuilder(
+                    table="activity", query=order, fields=["sys_id", "person", "person.name"],
+                    limit=3, offset=offset, display_value=display_value)))['result'])
+            assert pages == everything
+    # Equal keys stay in table order, whichever way they are sorted.
+    table_order = [record['sys_id'] for record in runner.query(str(TableQueryBuilder(
+        table="activity", query="active=true", fields=["sys_id"])))['result']]
+    for order in ["ORDERBYactive", "ORDERBYDESCactive"]:
+        result = runner.query(str(TableQueryBuilder(
+            table="activity", query=f"active=true^{order}", fields=["sys_id"])))['result']
+        assert [record['sys_id'] for record in result] == table_order
+
+
 def test_fields_table_query():
     table_query = TableQueryBuilder(
         table="activity",
@@ -142,6 +170,21 @@ def test_fields_table_query():
     _assert_dicts_equal(result, expected)
 
 
+def test_multi_hop_dotted_fields_table_query():
+    table_query = TableQueryBuilder(
+        table="activity",
+        query='person.assigned_case.phaseISNOTEMPTY',
+        fields=['sys_id', 'person.assigned_case.location', 'person.assigned_case.location.sys_id'],
+        limit=None,
+        offset=None,
+        display_value="all")
+    runner = query.LocalDatasetQueryRunner(TEST_DATASET, SCHEMAS_DIR)
+    result = runner.query(str(table_query))
+    expected = read_result()
+    write_result_or_print(result, expected)
+    _assert_dicts_equal(result, expected)
+
+
 def test_isnotempty_matcher_table_query():
     table_query = TableQueryBuilder(
         table="person",
@@ -247,3 +290,216 @@ def test_group_by_stats_query():
     expected = read_count_result()
     write_count_result_or_print(result, expected)
     TestCase().assertDictEqual(expected, result)
+
+
+def test_multi_field_group_by_stats_query():
+    stats_query = AggregateQueryBuilder(
+        table="activity",
+        group_by=["activity_type", "person.name", "active"],
+        query="",
+        having="",
+        display_value="all",
+        return_count=True)
+    runner = query.LocalDatasetQueryRunner(TEST_DATASET, SCHEMAS_DIR)
+    result = runner.query(str(stats_query))
+    expected = read_count_result()
+    write_count_result_or_print(result, expected)
+    TestCase().assertDictEqual(expected, result)
+
+
+def test_group_by_having_stats_query():
+    runner = query.LocalDatasetQueryRunner(TEST_DATASET, SCHEMAS_DIR)
+    groups = runner.query(str(AggregateQueryBuilder(
+        table="activity", group_by=["activity_type"], display_value="false")))['result']
+    for having in ["count^sys_id^>^1", "count^sys_id^<=^2", "count^sys_id^=^4"]:
+        threshold = int(having.split("^")[-1])
+        compare = {
+            ">": lambda count: count > threshold,
+            "<=": lambda count: count <= threshold,
+            "=": lambda count: count == threshold}[having.split("^")[2]]
+        result = runner.query(str(AggregateQueryBuilder(
+            table="activity", group_by=["activity_type"], having=having,
+            display_value="false")))['result']
+        assert result == [group for group in groups if compare(group['stats']['count'])]
+        assert result
+    with pytest.raises(Exception, match="requires sysparm_group_by"):
+        runner.query(str(AggregateQueryBuilder(table="activity", having="count^sys_id^>^1")))
+
+
+def test_group_by_same_display_value_stats_query(tmp_path):
+    # Give two people the same name in the activities that link to them.
+    dataset_path = str(tmp_path / "dataset")
+    shutil.copytree(TEST_DATASET, dataset_path)
+    activity_file = os.path.join(dataset_path, "activity.json")
+    with open(activity_file, 'r') as f:
+        activities = json.loads(f.read())
+    people = list(dict.fromkeys(record["person"]["value"] for record in activities["result"]))
+    for record in activities["result"]:
+        if record["person"]["value"] in people[:2]:
+            record["person"]["display_value"] = "Same Name"
+    with open(activity_file, 'w') as f:
+        f.write(json.dumps(activities))
+
+    runner = query.LocalDatasetQueryRunner(dataset_path, SCHEMAS_DIR)
+    counts = {}
+    for display_value in ["true", "false", "all"]:
+        groups = runner.query(str(AggregateQueryBuilder(
+            table="activity", group_by=["person"], display_value=display_value)))['result']
+        counts[display_value] = sorted(group['stats']['count'] for group in groups)
+    assert counts["true"] == counts["false"] == counts["all"]
+    assert len(counts["true"]) == len(people)
+
+
+def test_chained_matchers_table_query():
+    runner = query.LocalDatasetQueryRunner(TEST_DATASET, SCHEMAS_DIR)
+    matchers = [
+        'person.assigned_case.phaseISNOTEMPTY',
+        f'activity_type!={ACTIVITY_TYPE_TEST_SYS_ID}',
+        'person=0ffbadb3f1d53002b38200e7e1f555db^ORperson=052c007cfa0812a3833ddfdf33b74123',
+        'active=false',
+    ]
+
+    def _sys_ids(sysparm_query: str):
+        table_query = TableQueryBuilder(
+            table="activity", query=sysparm_query, fields=["sys_id"], limit=None, offset=None,
+            display_value="false")
+        return {row["sys_id"] for row in runner.query(str(table_query))["result"]}
+
+    expected = set.intersection(*[_sys_ids(matcher) for matcher in matchers])
+    assert expected
+    assert _sys_ids("^".join(matchers)) == expected
+
+
+def test_invalid_field_after_empty_result_table_query():
+    runner = query.LocalDatasetQueryRunner(TEST_DATASET, SCHEMAS_DIR)
+    table_query = TableQueryBuilder(
+        table="activity", query="sys_id=nothing^not_a_fieldISEMPTY", fields=[], limit=None,
+        offset=None, display_value="false")
+    with pytest.raises(KeyError):
+        runner.query(str(table_query))
+
+
+def test_dataset_snapshot(tmp_path):
+    shutil.copytree(TEST_DATASET, tmp_path / "dataset")
+    data_directory = str(tmp_path / "dataset")
+    url = "/api/now/table/activity?sysparm_query=active=true&sysparm_display_value=all"
+    expected = query.LocalDatasetQueryRunner(TEST_DATASET, SCHEMAS_DIR).query(url)
+
+    runner = query.LocalDatasetQueryRunner(data_directory, SCHEMAS_DIR, snapshot=True)
+    assert os.path.exists(os.path.join(data_directory, "activity.json.snapshot"))
+    TestCase().assertDictEqual(runner.query(url), expected)
+
+    # A snapshot that matches the JSON file is used instead of it.
+    activity_file = os.path.join(data_directory, "activity.json")
+    stat = os.stat(activity_file)
+    with open(activity_file, 'r+') as f:
+        f.write(" " * stat.st_size)
+    os.utime(activity_file, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    runner = query.LocalDatasetQueryRunner(data_directory, SCHEMAS_DIR, snapshot=True)
+    TestCase().assertDictEqual(runner.query(url), expected)
+
+    # Once the JSON file changes, it's loaded again.
+    with open(os.path.join(TEST_DATASET, "activity.json"), 'r') as f:
+        activities = json.loads(f.read())
+    activities["result"] = [row for row in activities["result"] if row not in expected["result"]]
+    with open(activity_file, 'w') as f:
+        f.write(json.dumps(activities))
+    runner = query.LocalDatasetQueryRunner(data_directory, SCHEMAS_DIR, snapshot=True)
+    assert runner.query(url) == {"result": []}
+
+    # Snapshots that were never finished are ignored.
+    with open(os.path.join(data_directory, "activity.json.snapshot.12345.tmp"), 'wb') as f:
+        f.write(b"partial")
+    runner = query.LocalDatasetQueryRunner(data_directory, SCHEMAS_DIR, snapshot=True)
+    assert runner.query(url) == {"result": []}
+
+
+def test_dataset_validation(tmp_path):
+    shutil.copytree(TEST_DATASET, tmp_path / "dataset")
+    data_directory = str(tmp_path / "dataset")
+    with open(os.path.join(data_directory, "phase.json"), 'r') as f:
+        phases = json.loads(f.read())
+    del phases["result"][0]["active"]["display_value"]
+    with open(os.path.join(data_directory, "phase.json"), 'w') as f:
+        f.write(json.dumps(phases))
+    with pytest.raises(Exception, match="Column: active has malformed values"):
+        query.LocalDatasetQueryRunner(data_directory, SCHEMAS_DIR)
+    query.LocalDatasetQueryRunner(data_directory, SCHEMAS_DIR, validate=False)
+
+
+def test_columnar_dataset(tmp_path):
+    for data_file in os.listdir(TEST_DATASET):
+        write_columnar_table(
+            str(tmp_path / f"{table_name(data_file)}{COLUMNAR_SUFFIX}"),
+            read_json_table(os.path.join(TEST_DATASET, data_file)))
+    json_runner = query.LocalDatasetQueryRunner(TEST_DATASET, SCHEMAS_DIR)
+    columnar_runner = query.LocalDatasetQueryRunner(str(tmp_path), SCHEMAS_DIR)
+    for url in [
+            str(TableQueryBuilder(
+                table="activity", query="person.assigned_case.phaseISNOTEMPTY^active=true",
+                fields=[], limit=None, offset=None, display_value="all")),
+            str(TableQueryBuilder(
+                table="person", query="sys_id>5^ORDERBYDESCsys_id",
+                fields=["sys_id", "assigned_case.location", "sys_mod_count"], limit=3,
+                offset=1, display_value="true")),
+            str(AggregateQueryBuilder(
+                table="activity", group_by=["activity_type"], query="", having="",
+                display_value="all", return_count=True))]:
+        TestCase().assertDictEqual(columnar_runner.query(url), json_runner.query(url))
+
+
+def test_columnar_dataset_uneven_strings(tmp_path):
+    comments = ["ok"] * 99 + ["x" * 10000]
+    write_columnar_table(str(tmp_path / f"comment{COLUMNAR_SUFFIX}"), DatasetTable(
+        values={"sys_id": np.array([f"{i:032x}" for i in range(100)], dtype=object),
+                "text": np.array(comments, dtype=object)},
+        display_values={"sys_id": np.array([f"{i:032x}" for i in range(100)], dtype=object),
+                        "text": np.array(comments, dtype=object)},
+        links={}))
+    table = read_columnar_table(str(tmp_path / f"comment{COLUMNAR_SUFFIX}"))
+    # Padding every comment to the longest one would take 100 times the space.
+    assert table.values["text"].dtype == object
+    assert os.path.getsize(tmp_path / f"comment{COLUMNAR_SUFFIX}" / "text.value.npy") < 20000
+    assert take(table.values["text"], np.arange(100)).tolist() == comments
+    # Even lengths are still stored fixed width, so they can be memory mapped.
+    assert isinstance(table.values["sys_id"], np.memmap)
+
+
+def test_like_matchers_table_query():
+    runner = query.LocalDatasetQueryRunner(TEST_DATASET, SCHEMAS_DIR)
+    indexed_runner = query.LocalDatasetQueryRunner(
+        TEST_DATASET, SCHEMAS_DIR,
+        trigram_index_fields={"person": ["name"], "activity_type": ["activity_name"]})
+    with open(os.path.join(TEST_DATASET, "person.json"), 'r') as f:
+        people = json.loads(f.read())["result"]
+
+    def _sys_ids(test_runner, table: str, sysparm_query: str):
+        table_query = TableQueryBuilder(
+            table=table, query=sysparm_query, fields=["sys_id"], limit=None, offset=None,
+            display_value="false")
+        return {row["sys_id"] for row in test_runner.query(str(table_query))["result"]}
+
+    for value in ["SON", "s", "Mrs. S", "nobody"]:
+        expected = {person["sys_id"]["value"] for person in people
+                    if value.lower() in person["name"]["value"].lower()}
+        everyone = {person["sys_id"]["value"] for person in people}
+        for test_runner in [runner, indexed_runner]:
+            assert _sys_ids(test_runner, "person", f"nameLIKE{value}") == expected
+            assert _sys_ids(test_runner, "person", f"nameNOTLIKE{value}") == everyone - expected
+
+    escalations = _sys_ids(runner, "activity", "activity_type.activity_nameLIKEmanager")
+    assert escalations
+    assert escalations == _sys_ids(
+        indexed_runner, "activity", "activity_type.activity_nameLIKEmanager")
+    assert escalations == _sys_ids(
+        runner, "activity", "activity_type=ef9a311e507edf450ce82fe4ecedb231")
+
+    # Reference fields match on their display value, not on the sys_id they hold.
+    reference_runner = query.LocalDatasetQueryRunner(
+        TEST_DATASET, SCHEMAS_DIR, trigram_index_fields={"activity": ["activity_type"]})
+    activities = _sys_ids(runner, "activity", "")
+    for test_runner in [runner, reference_runner]:
+        assert _sys_ids(test_runner, "activity", "activity_typeLIKEmanager") == escalations
+        assert _sys_ids(
+            test_runner, "activity", "activity_typeNOTLIKEmanager") == activities - escalations
+        assert _sys_ids(test_runner, "activity", "activity_typeLIKEef9a311e") == set()
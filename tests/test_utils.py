@@ -1,6 +1,8 @@
 import os
+import pandas as pd
 from servicenow_api_tools.clients import utils
-from servicenow_api_tools.utils import remove_prefix, remove_suffix
+from servicenow_api_tools.utils import (
+    api_results_to_dataframe, dataframe_to_api_results, remove_prefix, remove_suffix)
 import unittest
 
 
@@ -118,3 +120,43 @@ class StringUtilsTestCase(unittest.TestCase):
     def test_remove_prefix_false(self):
         self.assertEqual(remove_prefix("/api/now/stats/activity", "/api/now/table/"),
                          "/api/now/stats/activity")
+
+
+class UnpackLinkFieldsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.input_df = pd.DataFrame([
+            {
+                "sys_id": {"display_value": "abc", "value": "abc"},
+                "person": {"display_value": "Jane", "link": "https://x/person/1", "value": "1"},
+                "active": {"display_value": "true", "value": "true"},
+            },
+            {
+                "sys_id": {"display_value": "def", "value": "def"},
+                "person": None,
+                "active": {"display_value": "false", "value": "false"},
+            },
+        ], dtype="object")
+        self.expected = pd.DataFrame({
+            "sys_id": ["abc", "def"],
+            "person": ["1", ""],
+            "active": ["true", "false"],
+            "person_display_value": ["Jane", ""],
+        })
+
+    def test_unpack_link_fields_detected(self):
+        pd.testing.assert_frame_equal(utils.unpack_link_fields(self.input_df), self.expected)
+
+    def test_unpack_link_fields_passed(self):
+        pd.testing.assert_frame_equal(
+            utils.unpack_link_fields(self.input_df, link_fields=["person"]), self.expected)
+
+    def test_api_results_to_unpacked_dataframe(self):
+        results = dataframe_to_api_results(self.input_df)
+        # Records can be missing fields entirely.
+        del results["result"][1]["person"]
+        pd.testing.assert_frame_equal(
+            utils.api_results_to_unpacked_dataframe(results),
+            utils.unpack_link_fields(api_results_to_dataframe(results)))
+        pd.testing.assert_frame_equal(
+            utils.api_results_to_unpacked_dataframe(results), self.expected)
@@ -1,12 +1,16 @@
-from servicenow_api_tools.mock_api_server import ServicenowRestEndpointLocalDataset
+from servicenow_api_tools.mock_api_server import (
+    AsyncServicenowRestEndpointLocalDataset, ServicenowRestEndpointLocalDataset)
 from servicenow_api_tools.reporting.build import get_debug_mode
 import pandas as pd
-from typing import Dict, Any
+from datetime import datetime, timedelta
+from typing import Dict, Any, List, Tuple
 from unittest import TestCase
 import hashlib
 import inspect
 import json
 import os
+import shutil
+import threading
 
 SCHEMAS_DIR = os.path.join(os.path.dirname(__file__), "schemas")
 TEST_DATASET = os.path.join(os.path.dirname(__file__), "dataset")
@@ -38,6 +42,86 @@ def get_local_endpoint() -> ServicenowRestEndpointLocalDataset:
     return ServicenowRestEndpointLocalDataset(path=TEST_DATASET, schema_dir=SCHEMAS_DIR)
 
 
+def get_async_local_endpoint() -> AsyncServicenowRestEndpointLocalDataset:
+    return AsyncServicenowRestEndpointLocalDataset(path=TEST_DATASET, schema_dir=SCHEMAS_DIR)
+
+
+def copy_dataset_with_localized_datetimes(directory: str, table: str, field: str) -> str:
+    """
+    Copies the test dataset into directory, and gives field of table distinct date/time values,
+    three records each, with display values in the US format of a timezone five hours behind UTC,
+    like an instance returns them for such a user. Returns the path of the copy.
+
+    The display values don't sort in the same order as the values, and don't work in queries.
+    """
+    path = os.path.join(directory, "dataset")
+    shutil.copytree(TEST_DATASET, path)
+    table_file = os.path.join(path, f"{table}.json")
+    with open(table_file, 'r') as f:
+        results = json.loads(f.read())
+    start = datetime(2021, 1, 19, 20, 0, 0)
+    for (i, record) in enumerate(results["result"]):
+        value = start + timedelta(hours=7 * (i // 3))
+        record[field] = {
+            "display_value": (value - timedelta(hours=5)).strftime("%m/%d/%Y %I:%M:%S %p"),
+            "value": value.strftime("%Y-%m-%d %H:%M:%S"),
+        }
+    with open(table_file, 'w') as f:
+        f.write(json.dumps(results, indent=4))
+    return path
+
+
+def set_choice_labels(path: str, table: str, field: str, labels: Dict[str, str]):
+    """
+    Gives field of table in the dataset copy at path the display value labels[value], like an
+    instance returns the label of a choice field.
+    """
+    table_file = os.path.join(path, f"{table}.json")
+    with open(table_file, 'r') as f:
+        results = json.loads(f.read())
+    for record in results["result"]:
+        record[field]["display_value"] = labels[record[field]["value"]]
+    with open(table_file, 'w') as f:
+        f.write(json.dumps(results, indent=4))
+
+
+class RecordingEndpoint(ServicenowRestEndpointLocalDataset):
+    """
+    Local dataset endpoint that records the requests it gets, for tests that check which requests
+    a client sends.
+
+    put_failures maps sys_ids to how many PUTs for them fail before one goes through.
+    """
+    def __init__(self, path: str = TEST_DATASET, put_failures: Dict[str, int] = None):
+        super().__init__(path=path, schema_dir=SCHEMAS_DIR)
+        self.put_failures = dict(put_failures or {})
+        self.urls: List[str] = []
+        self.puts: List[Tuple[str, Dict]] = []
+        self.posts: List[str] = []
+        self._lock = threading.Lock()
+
+    def get(self, url: str) -> Dict:
+        with self._lock:
+            self.urls.append(url)
+        return super().get(url)
+
+    def put(self, url: str, obj: Dict) -> Dict:
+        with self._lock:
+            self.puts.append((url, obj))
+            sys_id = obj.get("sys_id", "")
+            failing = self.put_failures.get(sys_id, 0) > 0
+            if failing:
+                self.put_failures[sys_id] -= 1
+        if failing:
+            return {"error": {"message": "Try again"}, "status": "failure"}
+        return super().put(url, obj)
+
+    def post(self, url: str, obj: Dict) -> Dict:
+        with self._lock:
+            self.posts.append(url)
+        return super().post(url, obj)
+
+
 def write_result_dataframe_or_print(result: pd.DataFrame, expected: pd.DataFrame):
     caller_name = inspect.stack()[1].function
     if WRITE_RESULT: